@@ -6,15 +6,28 @@ Advanced Features for Server Management Bot
 """
 
 import asyncio
+import io
+import hashlib
+import heapq
 import json
+import logging
+import os
+import random
 import time
+from array import array
+from collections import deque
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
-import schedule
-from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+logger = logging.getLogger(__name__)
 
 # ===== کلاس‌های کمکی =====
 
@@ -36,55 +49,705 @@ class Alert:
     vm_id: Optional[str]
     timestamp: datetime
     resolved: bool = False
+    key: Optional[str] = None
+    count: int = 1
+    last_seen: Optional[datetime] = None
+    last_notified: Optional[datetime] = None
+    resolved_at: Optional[datetime] = None
+
+@dataclass
+class AlertRule:
+    """قاعده هشدار با هیسترزیس: بالای trigger فعال، زیر clear برطرف می‌شود"""
+    key: str
+    level: str
+    trigger: float
+    clear: float
+    message: str  # با {value} قالب‌بندی می‌شود
+    cooldown: float = 3600.0  # فاصله یادآوری تا زمانی که هشدار فعال است
+    for_checks: int = 1  # تعداد بررسی‌های متوالی لازم برای فعال شدن
+
+# ===== ذخیره سری‌های زمانی متریک‌ها =====
+
+SPARK_CHARS = '▁▂▃▄▅▆▇█'
+
+def sparkline(values: List[float], width: int = 24) -> str:
+    """نمودار متنی کوچک از یک سری مقادیر"""
+    if not values:
+        return ''
+    
+    # کاهش تعداد نقاط به عرض نمودار با میانگین‌گیری
+    if len(values) > width:
+        step = len(values) / width
+        values = [
+            sum(chunk) / len(chunk)
+            for chunk in (values[int(i * step):int((i + 1) * step)] for i in range(width))
+            if chunk
+        ]
+    
+    low, high = min(values), max(values)
+    span = (high - low) or 1.0
+    return ''.join(SPARK_CHARS[int((v - low) / span * (len(SPARK_CHARS) - 1))] for v in values)
+
+class RingBuffer:
+    """بافر حلقوی فشرده (array) برای نقاط (زمان، مقدار)"""
+    
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.timestamps = array('d', [0.0] * capacity)
+        self.values = array('d', [0.0] * capacity)
+        self.head = 0
+        self.size = 0
+    
+    def append(self, timestamp: float, value: float):
+        """افزودن نقطه (قدیمی‌ترین نقطه بازنویسی می‌شود)"""
+        self.timestamps[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+    
+    def oldest(self) -> Optional[float]:
+        """زمان قدیمی‌ترین نقطه موجود"""
+        if not self.size:
+            return None
+        return self.timestamps[(self.head - self.size) % self.capacity]
+    
+    def since(self, start: float, end: float = float('inf')) -> List[tuple]:
+        """نقاط در بازه [start, end) به ترتیب زمانی"""
+        points = []
+        for i in range(self.size):
+            idx = (self.head - self.size + i) % self.capacity
+            ts = self.timestamps[idx]
+            if start <= ts < end:
+                points.append((ts, self.values[idx]))
+        return points
+
+class MetricsStore:
+    """ذخیره متریک‌های میزبان و VM ها: حافظه حلقوی + جداول rollup در SQLite"""
+    
+    # تفکیک‌پذیری (ثانیه) -> مدت نگهداری (ثانیه)
+    RESOLUTIONS = {
+        60: 2 * 86400,
+        300: 30 * 86400,
+        3600: 730 * 86400
+    }
+    
+    # بازه‌هایی تا این طول (ثانیه) از نقاط خام حافظه پاسخ داده می‌شوند
+    RAW_SPAN = 2 * 3600
+    
+    def __init__(self, adb, capacity: int = 720, collect_interval: float = 60.0):
+        self.adb = adb
+        self.capacity = capacity
+        self.collect_interval = collect_interval
+        self._series: Dict[str, RingBuffer] = {}
+        self._rolled_until: Dict[str, float] = {}
+        self._task = None
+    
+    def record(self, series: str, value: float, timestamp: Optional[float] = None):
+        """ثبت یک نقطه در حافظه"""
+        buffer = self._series.get(series)
+        if buffer is None:
+            buffer = self._series[series] = RingBuffer(self.capacity)
+        buffer.append(timestamp or time.time(), float(value))
+    
+    def record_snapshot(self, snapshot):
+        """ثبت نمونه منابع میزبان (listener نمونه‌بردار)"""
+        ts = snapshot.timestamp
+        self.record('host.cpu', snapshot.cpu_percent, ts)
+        self.record('host.ram', snapshot.memory.percent, ts)
+        self.record('host.disk', snapshot.disk.percent, ts)
+        self.record('host.net_rx', snapshot.net_recv_rate, ts)
+        self.record('host.net_tx', snapshot.net_sent_rate, ts)
+    
+    def record_vm(self, vm_id: str, info: Dict, timestamp: Optional[float] = None):
+        """ثبت مصرف یک VM از پاسخ get_vm_info"""
+        fields = {
+            'cpu': 'cpu_usage',
+            'ram': 'ram_usage',
+            'net_rx': 'network_rx',
+            'net_tx': 'network_tx'
+        }
+        for name, key in fields.items():
+            value = info.get(key)
+            if isinstance(value, (int, float)):
+                self.record(f'vm.{vm_id}.{name}', value, timestamp)
+    
+    async def collect(self, api):
+        """جمع‌آوری متریک‌های سرور و VM های روشن از API"""
+        now = time.time()
+        
+        stats = await api.get_server_stats()
+        for key in ('active_vms', 'network_rx', 'network_tx'):
+            if isinstance(stats.get(key), (int, float)):
+                self.record(f'server.{key}', stats[key], now)
+        
+        vms = await api.list_vms()
+        running = [vm['vm_id'] for vm in vms if vm.get('status') == 'running']
+        semaphore = asyncio.Semaphore(10)
+        
+        async def _collect_vm(vm_id):
+            async with semaphore:
+                try:
+                    self.record_vm(vm_id, await api.get_vm_info(vm_id), now)
+                except Exception as e:
+                    logger.warning(f"Failed to collect metrics for VM {vm_id}: {e}")
+        
+        await asyncio.gather(*(_collect_vm(vm_id) for vm_id in running))
+    
+    def _rollup_minutes(self, conn, now: float):
+        """تبدیل نقاط حافظه به rollup یک‌دقیقه‌ای برای دقیقه‌های کامل شده"""
+        current_minute = int(now // 60 * 60)
+        rows = []
+        
+        for series, buffer in self._series.items():
+            start = self._rolled_until.get(series, 0.0)
+            buckets: Dict[int, List[float]] = {}
+            for ts, value in buffer.since(start, current_minute):
+                buckets.setdefault(int(ts // 60 * 60), []).append(value)
+            
+            for bucket, values in buckets.items():
+                rows.append((60, series, bucket, sum(values) / len(values),
+                             min(values), max(values), len(values)))
+            self._rolled_until[series] = current_minute
+        
+        conn.executemany('''
+            INSERT OR REPLACE INTO metrics_rollup (resolution, series, bucket, avg, min, max, count)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+    
+    def _rollup_sync(self, now: float):
+        """اجرای rollup ها و حذف داده‌های منقضی (در thread نویسنده)"""
+        with self.adb.db.transaction() as conn:
+            self._rollup_minutes(conn, now)
+            
+            # ساخت 5m از 1m و 1h از 5m (فقط باکت‌های کامل اخیر بازمحاسبه می‌شوند)
+            for source, target in ((60, 300), (300, 3600)):
+                end = int(now // target * target)
+                start = end - 2 * target
+                conn.execute('''
+                    INSERT OR REPLACE INTO metrics_rollup (resolution, series, bucket, avg, min, max, count)
+                    SELECT ?, series, (bucket / ?) * ?, SUM(avg * count) / SUM(count),
+                           MIN(min), MAX(max), SUM(count)
+                    FROM metrics_rollup
+                    WHERE resolution = ? AND bucket >= ? AND bucket < ?
+                    GROUP BY series, bucket / ?
+                ''', (target, target, target, source, start, end, target))
+            
+            for resolution, retention in self.RESOLUTIONS.items():
+                conn.execute(
+                    'DELETE FROM metrics_rollup WHERE resolution = ? AND bucket < ?',
+                    (resolution, int(now - retention))
+                )
+    
+    async def rollup(self):
+        """نوشتن rollup ها در دیتابیس"""
+        await self.adb.run_write(self._rollup_sync, time.time())
+    
+    async def query(self, series: str, start: float, end: Optional[float] = None) -> List[tuple]:
+        """نقاط (زمان، میانگین، حداقل، حداکثر) در بازه؛ تفکیک‌پذیری بر اساس طول بازه"""
+        end = end or time.time()
+        span = end - start
+        buffer = self._series.get(series)
+        oldest = buffer.oldest() if buffer is not None else None
+        
+        # بازه‌های کوتاه از حافظه؛ بخش قدیمی‌تر از حافظه از rollup یک‌دقیقه‌ای
+        if span <= self.RAW_SPAN and oldest is not None:
+            points = []
+            if oldest > start:
+                points = await self._query_rollup(60, series, start, min(oldest, end))
+            points.extend((ts, value, value, value) for ts, value in buffer.since(max(start, oldest), end))
+            return points
+        
+        resolution = 60 if span <= 2 * 86400 else 300 if span <= 30 * 86400 else 3600
+        return await self._query_rollup(resolution, series, start, end)
+    
+    async def _query_rollup(self, resolution: int, series: str, start: float, end: float) -> List[tuple]:
+        """خواندن باکت‌های rollup در بازه (جستجوی کلید اصلی)"""
+        rows = await self.adb.fetchall('''
+            SELECT bucket, avg, min, max FROM metrics_rollup
+            WHERE resolution = ? AND series = ? AND bucket >= ? AND bucket < ?
+            ORDER BY bucket
+        ''', (resolution, series, int(start), int(end)))
+        return [tuple(row) for row in rows]
+    
+    async def _run(self, api):
+        """حلقه جمع‌آوری و rollup"""
+        while True:
+            try:
+                await self.collect(api)
+            except Exception as e:
+                logger.error(f"Metrics collection failed: {e}")
+            
+            try:
+                await self.rollup()
+            except Exception as e:
+                logger.error(f"Metrics rollup failed: {e}")
+            
+            await asyncio.sleep(self.collect_interval)
+    
+    def start(self, api):
+        """شروع جمع‌آوری دوره‌ای"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(api))
+    
+    async def stop(self):
+        """توقف جمع‌آوری و نوشتن rollup نهایی"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.rollup()
+
+# ===== رندر نمودار =====
+
+def render_chart_png(title: str, series: Dict[str, List[tuple]]) -> bytes:
+    """رسم نمودار خطی PNG از سری‌ها (در process جداگانه اجرا می‌شود)"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+    
+    fig, axes = plt.subplots(len(series), 1, figsize=(8, 1.8 * len(series)), sharex=True, squeeze=False)
+    
+    for ax, (label, points) in zip(axes[:, 0], series.items()):
+        times = [datetime.fromtimestamp(point[0]) for point in points]
+        ax.plot(times, [point[1] for point in points], linewidth=1.2)
+        ax.fill_between(times, [point[2] for point in points], [point[3] for point in points], alpha=0.2)
+        ax.set_ylabel(label, fontsize=8)
+        ax.grid(alpha=0.3)
+    
+    axes[-1, 0].xaxis.set_major_formatter(mdates.DateFormatter('%m-%d %H:%M'))
+    fig.suptitle(title)
+    fig.autofmt_xdate()
+    
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=100, bbox_inches='tight')
+    plt.close(fig)
+    return buffer.getvalue()
+
+class ChartRenderer:
+    """رندر نمودار منابع در process pool با کش تصاویر رندر شده"""
+    
+    WINDOWS = {'1h': 1, '6h': 6, '24h': 24, '7d': 168, '30d': 720}
+    SERIES = (
+        ('cpu', 'CPU %'),
+        ('ram', 'RAM %'),
+        ('net_rx', 'Net RX B/s'),
+        ('net_tx', 'Net TX B/s')
+    )
+    
+    def __init__(self, metrics: 'MetricsStore', cache, workers: int = 2):
+        self.metrics = metrics
+        self.cache = cache
+        self.workers = workers
+        self.available = True
+        self.renders = 0
+        self._pool = None
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+    
+    async def render(self, scope: str, window: str) -> Optional[bytes]:
+        """نمودار PNG برای scope (host یا vm.<id>) و بازه؛ None اگر داده یا matplotlib نباشد"""
+        if not self.available or window not in self.WINDOWS:
+            return None
+        
+        key = (scope, window)
+        png = self.cache.get(key)
+        if png is not None:
+            return png
+        
+        # درخواست‌های هم‌زمان یکسان یک رندر مشترک دارند
+        if key in self._inflight:
+            return await asyncio.shield(self._inflight[key])
+        
+        future = asyncio.ensure_future(self._render(scope, window))
+        self._inflight[key] = future
+        try:
+            png = await asyncio.shield(future)
+        finally:
+            self._inflight.pop(key, None)
+        
+        if png is not None:
+            self.cache.set(key, png)
+        return png
+    
+    async def _render(self, scope: str, window: str) -> Optional[bytes]:
+        """جمع‌آوری داده‌ها و رندر در process pool"""
+        start = time.time() - self.WINDOWS[window] * 3600
+        series = {}
+        for name, label in self.SERIES:
+            points = await self.metrics.query(f'{scope}.{name}', start)
+            if len(points) >= 2:
+                series[label] = points
+        
+        if not series:
+            return None
+        
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        
+        loop = asyncio.get_running_loop()
+        try:
+            png = await loop.run_in_executor(self._pool, render_chart_png, f'{scope} - {window}', series)
+        except ImportError:
+            logger.warning("matplotlib is not installed; charts are disabled")
+            self.available = False
+            return None
+        
+        self.renders += 1
+        return png
+    
+    def close(self):
+        """بستن process pool"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+# ===== ارسال اعلان‌ها =====
+
+class TokenBucket:
+    """محدودکننده نرخ token bucket"""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    async def acquire(self):
+        """صبر تا آزاد شدن یک توکن"""
+        while True:
+            wait = self.blocked_until - time.monotonic()
+            if wait <= 0:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+    
+    def pause(self, seconds: float):
+        """توقف کامل برای مدت مشخص (مثلاً پس از خطای 429)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class NotificationBroadcaster:
+    """ارسال هم‌زمان پیام به چند گیرنده با رعایت محدودیت‌های تلگرام و صف پایدار"""
+    
+    BATCH_SIZE = 200
+    
+    def __init__(self, bot_instance, global_rate: float = 25.0, per_chat_rate: float = 1.0,
+                 concurrency: int = 10, max_attempts: int = 5):
+        self.bot = bot_instance
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.max_attempts = max_attempts
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+    
+    async def broadcast(self, chat_ids: List[int], text: str, parse_mode: Optional[str] = ParseMode.MARKDOWN) -> int:
+        """ثبت پیام در صف خروجی برای تمام گیرندگان"""
+        rows = [(chat_id, text, parse_mode) for chat_id in chat_ids]
+        if not rows:
+            return 0
+        
+        await self.bot.adb.executemany('''
+            INSERT INTO notification_outbox (chat_id, text, parse_mode)
+            VALUES (?, ?, ?)
+        ''', rows)
+        self._wakeup.set()
+        return len(rows)
+    
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, 1)
+        return bucket
+    
+    async def _deliver_chat(self, chat_id: int, rows: List) -> List[tuple]:
+        """ارسال پیام‌های یک گیرنده به ترتیب؛ نتیجه به شکل (id, وضعیت, خطا, تأخیر)"""
+        results = []
+        bucket = self._chat_bucket(chat_id)
+        
+        async with self._semaphore:
+            for index, row in enumerate(rows):
+                await bucket.acquire()
+                await self.global_bucket.acquire()
+                
+                try:
+                    await self.bot.app.bot.send_message(chat_id, row['text'], parse_mode=row['parse_mode'])
+                    results.append((row['id'], 'sent', None, 0))
+                    self.sent += 1
+                
+                except RetryAfter as e:
+                    delay = e.retry_after
+                    if isinstance(delay, timedelta):
+                        delay = delay.total_seconds()
+                    self.rate_limited += 1
+                    self.global_bucket.pause(delay)
+                    bucket.pause(delay)
+                    # بقیه پیام‌های این گیرنده بدون مصرف تلاش به تعویق می‌افتند تا ترتیب حفظ شود
+                    results.append((row['id'], 'retry', str(e), delay))
+                    results.extend((r['id'], 'deferred', None, delay) for r in rows[index + 1:])
+                    break
+                
+                except (Forbidden, BadRequest) as e:
+                    results.append((row['id'], 'failed', str(e), 0))
+                    self.failed += 1
+                
+                except Exception as e:
+                    delay = min(300, 2 ** (row['attempts'] + 1))
+                    results.append((row['id'], 'retry', str(e), delay))
+        
+        return results
+    
+    async def _dispatch_batch(self) -> int:
+        """ارسال یک دسته از پیام‌های موعد رسیده"""
+        rows = await self.bot.adb.fetchall('''
+            SELECT * FROM notification_outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY id LIMIT ?
+        ''', (time.time(), self.BATCH_SIZE))
+        if not rows:
+            return 0
+        
+        by_chat: Dict[int, List] = {}
+        for row in rows:
+            by_chat.setdefault(row['chat_id'], []).append(row)
+        
+        outcomes = await asyncio.gather(*(
+            self._deliver_chat(chat_id, chat_rows) for chat_id, chat_rows in by_chat.items()
+        ))
+        attempts = {row['id']: row['attempts'] for row in rows}
+        now = time.time()
+        
+        sent_ids = []
+        deferred = []
+        updates = []
+        for row_id, status, error, delay in (result for chat in outcomes for result in chat):
+            if status == 'sent':
+                sent_ids.append((row_id,))
+                continue
+            if status == 'deferred':
+                deferred.append((now + delay, row_id))
+                continue
+            if status == 'retry' and attempts[row_id] + 1 >= self.max_attempts:
+                status = 'failed'
+                self.failed += 1
+            updates.append(('pending' if status == 'retry' else 'failed', now + delay, error, row_id))
+        
+        def _apply(conn_db):
+            with conn_db.transaction() as conn:
+                conn.executemany('DELETE FROM notification_outbox WHERE id = ?', sent_ids)
+                conn.executemany('''
+                    UPDATE notification_outbox
+                    SET status = ?, attempts = attempts + 1, next_attempt_at = ?, last_error = ?
+                    WHERE id = ?
+                ''', updates)
+                conn.executemany('UPDATE notification_outbox SET next_attempt_at = ? WHERE id = ?', deferred)
+        
+        await self.bot.adb.run_write(_apply, self.bot.db)
+        return len(rows)
+    
+    async def prune(self, older_than_days: float = 7) -> int:
+        """حذف پیام‌های ناموفق قدیمی از صف (پیام‌های ارسال شده همان لحظه حذف می‌شوند)"""
+        def _prune():
+            with self.bot.db.transaction() as conn:
+                return conn.execute('''
+                    DELETE FROM notification_outbox
+                    WHERE status = 'failed' AND created_at < datetime('now', ?)
+                ''', (f'-{float(older_than_days)} days',)).rowcount
+        
+        removed = await self.bot.adb.run_write(_prune)
+        if removed:
+            logger.info(f"Pruned {removed} failed notifications from the outbox")
+        return removed
+    
+    async def _run(self):
+        """حلقه ارسال: بیدار شدن با پیام جدید یا در موعد تلاش مجدد بعدی"""
+        while True:
+            try:
+                while await self._dispatch_batch():
+                    pass
+            except Exception as e:
+                logger.error(f"Notification dispatch failed: {e}")
+            
+            self._wakeup.clear()
+            timeout = 5.0
+            try:
+                row = await self.bot.adb.fetchone(
+                    "SELECT MIN(next_attempt_at) AS due FROM notification_outbox WHERE status = 'pending'"
+                )
+                if row and row['due'] is not None:
+                    timeout = min(timeout, max(0.05, row['due'] - time.time()))
+            except Exception as e:
+                logger.error(f"Failed to read notification outbox: {e}")
+            
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    def start(self):
+        """شروع ارسال (پیام‌های باقی‌مانده از اجرای قبلی هم ارسال می‌شوند)"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """توقف ارسال؛ پیام‌های ارسال نشده در صف باقی می‌مانند"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    def stats(self) -> Dict:
+        """آمار ارسال"""
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'rate_limited': self.rate_limited
+        }
 
 class AdvancedMonitoring:
     """نظارت پیشرفته بر سیستم"""
     
-    def __init__(self, bot_instance):
+    DEFAULT_RULES = [
+        AlertRule('cpu', 'critical', 90, 80, "مصرف CPU بالا: {value}%", for_checks=2),
+        AlertRule('ram', 'warning', 85, 75, "مصرف RAM بالا: {value}%"),
+        AlertRule('disk', 'critical', 90, 85, "فضای دیسک کم: {value}%"),
+        AlertRule('stopped_vms', 'info', 0, 0, "{value:g} ماشین مجازی متوقف شده", cooldown=6 * 3600),
+    ]
+    
+    EMOJI_MAP = {
+        'info': 'ℹ️',
+        'warning': '⚠️', 
+        'critical': '🚨'
+    }
+    
+    def __init__(self, bot_instance, rules: Optional[List[AlertRule]] = None, max_alerts: int = 500):
         self.bot = bot_instance
-        self.alerts = []
-        self.metrics_history = {}
+        self.alerts = deque(maxlen=max_alerts)
+        self.metrics_history = bot_instance.metrics
+        self.rules = {rule.key: rule for rule in (rules or self.DEFAULT_RULES)}
+        self.active_alerts: Dict[str, Alert] = {}
+        self._breaches: Dict[str, int] = {}
     
     async def check_system_health(self):
         """بررسی سلامت کلی سیستم"""
         try:
-            # بررسی CPU
-            cpu_usage = psutil.cpu_percent(interval=1)
-            if cpu_usage > 90:
-                await self.create_alert(
-                    "critical", 
-                    f"مصرف CPU بالا: {cpu_usage}%"
-                )
-            
-            # بررسی RAM
-            memory = psutil.virtual_memory()
-            if memory.percent > 85:
-                await self.create_alert(
-                    "warning", 
-                    f"مصرف RAM بالا: {memory.percent}%"
-                )
+            # آخرین نمونه منابع (بدون مسدود کردن event loop)
+            snapshot = self.bot.sampler.latest()
             
-            # بررسی دیسک
-            disk = psutil.disk_usage('/')
-            if disk.percent > 90:
-                await self.create_alert(
-                    "critical", 
-                    f"فضای دیسک کم: {disk.percent}%"
-                )
+            values = {
+                'cpu': snapshot.cpu_percent,
+                'ram': snapshot.memory.percent,
+                'disk': snapshot.disk.percent
+            }
             
             # بررسی VM های متوقف شده
             vms = await self.bot.api.list_vms()
-            stopped_vms = [vm for vm in vms if vm['status'] == 'stopped']
+            values['stopped_vms'] = len([vm for vm in vms if vm['status'] == 'stopped'])
             
-            if len(stopped_vms) > 0:
-                await self.create_alert(
-                    "info",
-                    f"{len(stopped_vms)} ماشین مجازی متوقف شده"
-                )
+            await self.evaluate(values)
                 
         except Exception as e:
             logger.error(f"Error in health check: {e}")
     
+    async def evaluate(self, values: Dict[str, float]):
+        """ارزیابی قواعد و ارسال یک اعلان گروهی برای تغییرات"""
+        now = datetime.now()
+        fired, reminders, resolved = [], [], []
+        
+        for key, value in values.items():
+            rule = self.rules.get(key)
+            if rule is None:
+                continue
+            
+            alert = self.active_alerts.get(key)
+            
+            if alert is None:
+                if value <= rule.trigger:
+                    self._breaches.pop(key, None)
+                    continue
+                
+                self._breaches[key] = self._breaches.get(key, 0) + 1
+                if self._breaches[key] < rule.for_checks:
+                    continue
+                
+                alert = Alert(
+                    level=rule.level,
+                    message=rule.message.format(value=value),
+                    vm_id=None,
+                    timestamp=now,
+                    key=key,
+                    last_seen=now,
+                    last_notified=now
+                )
+                self.active_alerts[key] = alert
+                self.alerts.append(alert)
+                fired.append(alert)
+            
+            elif value <= rule.clear:
+                alert.resolved = True
+                alert.resolved_at = now
+                del self.active_alerts[key]
+                self._breaches.pop(key, None)
+                resolved.append(alert)
+            
+            else:
+                alert.count += 1
+                alert.last_seen = now
+                alert.message = rule.message.format(value=value)
+                if (now - alert.last_notified).total_seconds() >= rule.cooldown:
+                    alert.last_notified = now
+                    reminders.append(alert)
+        
+        if fired or reminders or resolved:
+            await self.notify_admins_text(self.format_alert_group(fired, reminders, resolved))
+        
+        for alert in fired:
+            await self.bot.adb.log_activity(0, f"alert_{alert.level}", alert.message)
+        for alert in resolved:
+            await self.bot.adb.log_activity(0, f"alert_resolved_{alert.key}", alert.message)
+    
+    def format_alert_group(self, fired: List[Alert], reminders: List[Alert], resolved: List[Alert]) -> str:
+        """متن یک اعلان گروهی"""
+        sections = []
+        
+        if fired:
+            sections.append("**هشدار جدید:**\n" + "\n".join(
+                f"{self.EMOJI_MAP.get(a.level, '📢')} {a.message}" for a in fired
+            ))
+        if reminders:
+            sections.append("**هنوز فعال:**\n" + "\n".join(
+                f"{self.EMOJI_MAP.get(a.level, '📢')} {a.message} "
+                f"(از {a.timestamp.strftime('%H:%M')}، {a.count} بار)" for a in reminders
+            ))
+        if resolved:
+            sections.append("**برطرف شد:**\n" + "\n".join(
+                f"✅ {a.message} (مدت: {int((a.resolved_at - a.timestamp).total_seconds() // 60)} دقیقه)"
+                for a in resolved
+            ))
+        
+        return (
+            "📢 **وضعیت هشدارهای سیستم**\n\n" + "\n\n".join(sections) +
+            f"\n\n**زمان:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+        )
+    
     async def create_alert(self, level: str, message: str, vm_id: str = None):
         """ایجاد هشدار جدید"""
         alert = Alert(
@@ -100,18 +763,12 @@ class AdvancedMonitoring:
         await self.notify_admins(alert)
         
         # ذخیره در دیتابیس
-        self.bot.db.log_activity(0, f"alert_{level}", message)
+        await self.bot.adb.log_activity(0, f"alert_{level}", message)
     
     async def notify_admins(self, alert: Alert):
         """اعلان به ادمین‌ها"""
-        emoji_map = {
-            'info': 'ℹ️',
-            'warning': '⚠️', 
-            'critical': '🚨'
-        }
-        
         message = f"""
-{emoji_map.get(alert.level, '📢')} **هشدار سیستم**
+{self.EMOJI_MAP.get(alert.level, '📢')} **هشدار سیستم**
 
 **سطح:** {alert.level.upper()}
 **پیام:** {alert.message}
@@ -121,37 +778,940 @@ class AdvancedMonitoring:
         if alert.vm_id:
             message += f"**VM ID:** {alert.vm_id}\n"
         
-        for admin_id in config.ADMIN_USER_IDS:
+        await self.notify_admins_text(message)
+    
+    async def notify_admins_text(self, message: str):
+        """ارسال یک پیام به تمام ادمین‌ها از طریق صف خروجی"""
+        try:
+            await self.bot.broadcaster.broadcast(self.bot.config.ADMIN_USER_IDS, message)
+        except Exception as e:
+            logger.error(f"Failed to queue admin notification: {e}")
+
+@dataclass
+class BackupResult:
+    """نتیجه بکاپ یک VM"""
+    vm_id: str
+    host: str
+    status: str  # ok / failed / deferred / skipped / pending
+    backup_name: str = ''
+    path: str = ''
+    size: int = 0
+    duration: float = 0.0
+    error: Optional[str] = None
+    backup_type: str = 'full'
+    parent_id: Optional[int] = None
+    chain_id: Optional[int] = None
+    fingerprint: Optional[str] = None
+    artifact: Optional['StoredArtifact'] = None
+
+@dataclass
+class BackupRun:
+    """وضعیت یک دور بکاپ گروهی"""
+    started_at: float
+    deadline: float
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+    deferred: int = 0
+    skipped: int = 0
+    pending: int = 0
+    finished_at: Optional[float] = None
+    results: List[BackupResult] = field(default_factory=list)
+    
+    @property
+    def done(self) -> int:
+        return self.completed + self.failed + self.deferred + self.skipped + self.pending
+    
+    def progress(self) -> str:
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return (
+            f"{self.done}/{self.total} "
+            f"(✅ {self.completed} 💤 {self.skipped} ❌ {self.failed} ⏭ {self.deferred} ⏳ {self.pending}) "
+            f"in {elapsed:.0f}s"
+        )
+
+class SharedLock:
+    """قفل async خواندن/نوشتن: چند نگه‌دارنده مشترک یا یک نگه‌دارنده انحصاری (با اولویت انحصاری)"""
+    
+    def __init__(self):
+        self._cond = asyncio.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting_exclusive = 0
+    
+    @asynccontextmanager
+    async def shared(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self._exclusive and not self._waiting_exclusive)
+            self._shared += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._shared -= 1
+                self._cond.notify_all()
+    
+    @asynccontextmanager
+    async def exclusive(self):
+        async with self._cond:
+            self._waiting_exclusive += 1
             try:
-                await self.bot.app.bot.send_message(
-                    admin_id, 
-                    message, 
-                    parse_mode=ParseMode.MARKDOWN
+                await self._cond.wait_for(lambda: not self._exclusive and not self._shared)
+            finally:
+                self._waiting_exclusive -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+@dataclass
+class StoredArtifact:
+    """فایل ذخیره شده در مخزن: checksum کل فایل و لیست chunk ها به ترتیب"""
+    checksum: str
+    size: int
+    chunks: List[tuple]  # (hash, size)
+    new_bytes: int = 0
+
+class BackupStore:
+    """مخزن محلی بکاپ‌ها با آدرس‌دهی محتوا (sha256) و حذف داده تکراری در سطح chunk"""
+    
+    def __init__(self, adb, root: str, chunk_size: int = 4 * 1024 * 1024):
+        self.adb = adb
+        self.root = root
+        self.chunk_size = chunk_size
+        os.makedirs(root, exist_ok=True)
+        self.written_bytes = 0
+        self.deduplicated_bytes = 0
+    
+    def chunk_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+    
+    def _write_chunk(self, data: bytes, total) -> tuple:
+        """هش و نوشتن یک chunk (در thread)؛ chunk موجود دوباره نوشته نمی‌شود"""
+        total.update(data)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return digest, False
+        
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.urandom(4).hex()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return digest, True
+    
+    def _read_chunk(self, digest: str) -> bytes:
+        """خواندن و بررسی یک chunk (در thread)"""
+        with open(self.chunk_path(digest), 'rb') as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"Corrupted backup chunk {digest}")
+        return data
+    
+    async def _put(self, data: bytes, total, chunks: List[tuple]) -> int:
+        loop = asyncio.get_running_loop()
+        digest, created = await loop.run_in_executor(None, self._write_chunk, data, total)
+        chunks.append((digest, len(data)))
+        if created:
+            self.written_bytes += len(data)
+            return len(data)
+        self.deduplicated_bytes += len(data)
+        return 0
+    
+    async def ingest(self, stream) -> StoredArtifact:
+        """ذخیره جریانی یک فایل؛ حافظه مصرفی در حد یک chunk است"""
+        total = hashlib.sha256()
+        chunks: List[tuple] = []
+        buffer = bytearray()
+        size = 0
+        new_bytes = 0
+        
+        async for piece in stream:
+            size += len(piece)
+            buffer.extend(piece)
+            while len(buffer) >= self.chunk_size:
+                new_bytes += await self._put(bytes(buffer[:self.chunk_size]), total, chunks)
+                del buffer[:self.chunk_size]
+        
+        if buffer:
+            new_bytes += await self._put(bytes(buffer), total, chunks)
+        
+        return StoredArtifact(total.hexdigest(), size, chunks, new_bytes)
+    
+    @staticmethod
+    def register(conn, backup_id: int, artifact: StoredArtifact):
+        """ثبت chunk های یک بکاپ در کاتالوگ (داخل تراکنش فراخواننده)"""
+        conn.executemany('''
+            INSERT INTO backup_chunks (hash, size, refcount) VALUES (?, ?, 1)
+            ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1
+        ''', artifact.chunks)
+        conn.executemany(
+            'INSERT INTO chunk_refs (backup_id, seq, hash) VALUES (?, ?, ?)',
+            [(backup_id, seq, digest) for seq, (digest, _) in enumerate(artifact.chunks)]
+        )
+        conn.execute(
+            'UPDATE backups SET checksum = ?, size = ? WHERE id = ?',
+            (artifact.checksum, artifact.size, backup_id)
+        )
+    
+    async def _manifest(self, backup_id: int) -> tuple:
+        backup = await self.adb.fetchone('SELECT checksum FROM backups WHERE id = ?', (backup_id,))
+        rows = await self.adb.fetchall(
+            'SELECT hash FROM chunk_refs WHERE backup_id = ? ORDER BY seq', (backup_id,)
+        )
+        if backup is None or backup['checksum'] is None:
+            raise ValueError(f"Backup {backup_id} is not in the local store")
+        return backup['checksum'], [row['hash'] for row in rows]
+    
+    async def verify(self, backup_id: int) -> bool:
+        """بررسی سلامت تمام chunk ها و checksum کل فایل"""
+        checksum, digests = await self._manifest(backup_id)
+        loop = asyncio.get_running_loop()
+        total = hashlib.sha256()
+        
+        try:
+            for digest in digests:
+                total.update(await loop.run_in_executor(None, self._read_chunk, digest))
+        except (OSError, ValueError) as e:
+            logger.error(f"Backup {backup_id} failed verification: {e}")
+            return False
+        
+        if total.hexdigest() != checksum:
+            logger.error(f"Backup {backup_id} checksum mismatch")
+            return False
+        return True
+    
+    async def stream(self, backup_id: int):
+        """خواندن جریانی بکاپ؛ هر chunk هنگام خواندن دوباره بررسی می‌شود"""
+        _, digests = await self._manifest(backup_id)
+        loop = asyncio.get_running_loop()
+        for digest in digests:
+            yield await loop.run_in_executor(None, self._read_chunk, digest)
+    
+    def _sweep(self, known: set) -> tuple:
+        files = freed = 0
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if name in known:
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                except OSError as e:
+                    logger.warning(f"Failed to remove orphan chunk {path}: {e}")
+                    continue
+                files += 1
+                freed += size
+        return files, freed
+    
+    async def sweep(self) -> tuple:
+        """حذف فایل‌های بدون رکورد در کاتالوگ (کپی نیمه‌کاره، بکاپ به تعویق افتاده، ذخیره ناموفق)؛
+        فقط با قفل انحصاری مخزن اجرا شود چون chunk های ingest در جریان هنوز ثبت نشده‌اند"""
+        rows = await self.adb.fetchall('SELECT hash FROM backup_chunks')
+        known = {row['hash'] for row in rows}
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._sweep, known)
+    
+    async def stats(self) -> Dict:
+        """حجم منطقی و فیزیکی مخزن"""
+        physical = await self.adb.fetchone('SELECT COUNT(*) AS chunks, COALESCE(SUM(size), 0) AS bytes FROM backup_chunks')
+        logical = await self.adb.fetchone('''
+            SELECT COALESCE(SUM(c.size), 0) AS bytes
+            FROM chunk_refs r JOIN backup_chunks c ON c.hash = r.hash
+        ''')
+        return {
+            'chunks': physical['chunks'],
+            'physical_bytes': physical['bytes'],
+            'logical_bytes': logical['bytes'],
+            'written_bytes': self.written_bytes,
+            'deduplicated_bytes': self.deduplicated_bytes
+        }
+
+class BackupOrchestrator:
+    """اجرای موازی بکاپ‌ها با محدودیت هم‌زمانی کلی و به ازای هر host در یک بازه زمانی ثابت"""
+    
+    INSERT_BATCH = 20
+    # وضعیت‌های بکاپ روی Virtualizer هنگام پیگیری بکاپ‌هایی که پاسخ ساختشان نرسید
+    BACKUP_IN_PROGRESS = ('pending', 'queued', 'running', 'creating', 'in_progress')
+    BACKUP_FAILED = ('failed', 'error', 'cancelled')
+    PENDING_TTL = 2 * 86400
+    # فقط شمارنده‌ها و زمان‌هایی که با هر نوشتن روی دیسک تغییر می‌کنند؛ اندازه و وضعیت VM ثابت‌اند
+    FINGERPRINT_FIELDS = (
+        'disk_write_bytes', 'disk_writes', 'snapshot_id', 'last_modified', 'updated_at'
+    )
+    
+    def __init__(self, bot_instance, concurrency: int = 4, per_host: int = 2, window: float = 4 * 3600,
+                 mode: str = 'incremental', full_every: int = 7, max_age_days: float = 7,
+                 store: Optional[BackupStore] = None):
+        self.bot = bot_instance
+        self.store = store
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.window = window
+        self.mode = mode
+        self.full_every = full_every
+        self.max_age_days = max_age_days
+        self.current: Optional[BackupRun] = None
+        self.last: Optional[BackupRun] = None
+        self._reconcile_lock = asyncio.Lock()
+    
+    async def _latest_backups(self) -> Dict[str, Dict]:
+        """آخرین بکاپ هر VM به همراه طول زنجیره آن"""
+        rows = await self.bot.adb.fetchall('''
+            SELECT b.id, b.vm_id, b.backup_name, b.chain_id, b.fingerprint, b.created_at,
+                   (SELECT COUNT(*) FROM backups c WHERE c.chain_id = b.chain_id) AS chain_length
+            FROM backups b
+            WHERE b.id IN (SELECT MAX(id) FROM backups GROUP BY vm_id)
+        ''')
+        return {row['vm_id']: dict(row) for row in rows}
+    
+    def _priorities(self, vms: List[Dict], latest: Dict[str, Dict]) -> List[tuple]:
+        """اولویت: مقدار priority خود VM و سپس قدیمی‌ترین بکاپ (بدون بکاپ = اول)"""
+        return [
+            (
+                (-int(vm.get('priority', 0) or 0), (latest.get(vm['vm_id']) or {}).get('created_at') or ''),
+                vm
+            )
+            for vm in vms
+        ]
+    
+    async def _fingerprint(self, vm_id: str) -> Optional[str]:
+        """خلاصه متادیتای دیسک VM؛ None یعنی اطلاعات کافی برای مقایسه وجود ندارد"""
+        info = await self.bot.api.get_vm_info(vm_id, use_cache=False)
+        fields = {key: info[key] for key in self.FINGERPRINT_FIELDS if key in info}
+        if not fields:
+            return None
+        return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+    
+    def _expired(self, last: Dict) -> bool:
+        """آیا آخرین بکاپ قدیمی‌تر از حداکثر فاصله مجاز بین دو بکاپ است"""
+        try:
+            created = datetime.fromisoformat(str(last['created_at']))
+        except (TypeError, ValueError):
+            return True
+        return datetime.utcnow() - created >= timedelta(days=self.max_age_days)
+    
+    async def _plan(self, vm_id: str, last: Optional[Dict]) -> tuple:
+        """انتخاب نوع بکاپ: full، incremental یا skip (بدون تغییر)"""
+        try:
+            fingerprint = await self._fingerprint(vm_id)
+        except Exception as e:
+            logger.warning(f"Could not fingerprint VM {vm_id}: {e}")
+            fingerprint = None
+        
+        # بکاپ‌های رد شده ردیفی ثبت نمی‌کنند، پس طول زنجیره به تنهایی بکاپ کامل را تضمین نمی‌کند
+        if (self.mode != 'incremental' or last is None
+                or last['chain_length'] >= self.full_every or self._expired(last)):
+            return 'full', fingerprint
+        
+        # اول از Virtualizer درباره بلاک‌های تغییر یافته سؤال می‌شود
+        try:
+            changes = await self.bot.api.get_changed_blocks(vm_id, last['backup_name'])
+            if not changes.get('changed_blocks'):
+                return 'skip', fingerprint
+            return 'incremental', fingerprint
+        except Exception as e:
+            if getattr(e, 'status', None) not in (404, 405, 501):
+                logger.warning(f"Changed-block query failed for VM {vm_id}: {e}")
+        
+        # بدون پشتیبانی changed-block: فقط با یک نشانه واقعی نوشتن رد می‌شود، وگرنه بکاپ کامل
+        if fingerprint is not None and fingerprint == last['fingerprint']:
+            return 'skip', fingerprint
+        return 'full', fingerprint
+    
+    async def _backup_one(self, vm: Dict, host: str, last: Optional[Dict], run: BackupRun) -> BackupResult:
+        vm_id = vm['vm_id']
+        backup_name = f"auto_backup_{vm_id}_{datetime.now().strftime('%Y%m%d_%H%M')}"
+        remaining = run.deadline - time.time()
+        if remaining <= 0:
+            return BackupResult(vm_id, host, 'deferred', backup_name, error='backup window exceeded')
+        
+        started = time.monotonic()
+        try:
+            backup_type, fingerprint = await self._plan(vm_id, last)
+            if backup_type == 'skip':
+                return BackupResult(vm_id, host, 'skipped', backup_name, fingerprint=fingerprint)
+            
+            incremental = backup_type == 'incremental'
+            backup = BackupResult(
+                vm_id, host, 'ok', backup_name,
+                backup_type=backup_type,
+                parent_id=last['id'] if incremental else None,
+                chain_id=last['chain_id'] if incremental else None,
+                fingerprint=fingerprint
+            )
+            try:
+                result = await asyncio.wait_for(
+                    self.bot.api.create_backup(vm_id, backup_name, parent=last['backup_name'] if incremental else None),
+                    run.deadline - time.time()
                 )
-            except Exception as e:
-                logger.error(f"Failed to notify admin {admin_id}: {e}")
+            except asyncio.TimeoutError:
+                # لغو سمت کلاینت بکاپ روی Virtualizer را متوقف نمی‌کند؛ بعداً با نامش پیگیری می‌شود
+                backup.status = 'pending'
+                backup.duration = time.monotonic() - started
+                backup.error = 'backup window exceeded; waiting for Virtualizer to finish'
+                return backup
+            
+            backup.path = result.get('path', '')
+            backup.size = result.get('size', 0) or 0
+            
+            # کپی محلی؛ خطا در این مرحله بکاپ ساخته شده روی Virtualizer را بی‌اعتبار نمی‌کند
+            if self.store is not None:
+                try:
+                    backup.artifact = await asyncio.wait_for(
+                        self.store.ingest(self.bot.api.download_backup(vm_id, backup_name)),
+                        run.deadline - time.time()
+                    )
+                except Exception as e:
+                    backup.error = f"local copy failed: {e!r}"
+                    logger.warning(f"Failed to store backup {backup_name} locally: {e!r}")
+            
+            backup.duration = time.monotonic() - started
+            return backup
+        except asyncio.TimeoutError:
+            return BackupResult(
+                vm_id, host, 'deferred', backup_name,
+                duration=time.monotonic() - started, error='backup window exceeded'
+            )
+        except Exception as e:
+            return BackupResult(
+                vm_id, host, 'failed', backup_name,
+                duration=time.monotonic() - started, error=str(e)
+            )
+    
+    async def _save(self, results: List[BackupResult]):
+        """ثبت دسته‌ای بکاپ‌های موفق و در انتظار؛ هر بکاپ کامل سر زنجیره خودش است"""
+        saved = [r for r in results if r.status == 'ok']
+        pending = [r for r in results if r.status == 'pending']
+        if not saved and not pending:
+            return
+        
+        def _insert():
+            with self.bot.db.transaction() as conn:
+                last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM backups').fetchone()[0]
+                conn.executemany('''
+                    INSERT INTO backups
+                    (vm_id, backup_name, backup_path, size, duration, backup_type, parent_id, chain_id, fingerprint)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', [
+                    (r.vm_id, r.backup_name, r.path, r.size, r.duration,
+                     r.backup_type, r.parent_id, r.chain_id, r.fingerprint)
+                    for r in saved
+                ])
+                
+                # شناسه‌ها به ترتیب درج تخصیص یافته‌اند (قفل نوشتن در دست همین تراکنش است)
+                if any(r.artifact is not None for r in saved):
+                    ids = [row[0] for row in conn.execute('SELECT id FROM backups WHERE id > ? ORDER BY id', (last_id,))]
+                    for backup_id, r in zip(ids, saved):
+                        if r.artifact is not None:
+                            BackupStore.register(conn, backup_id, r.artifact)
+                
+                conn.executemany('DELETE FROM pending_backups WHERE backup_name = ?', [(r.backup_name,) for r in saved])
+                conn.executemany('''
+                    INSERT OR REPLACE INTO pending_backups
+                    (backup_name, vm_id, backup_type, parent_id, chain_id, fingerprint)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', [
+                    (r.backup_name, r.vm_id, r.backup_type, r.parent_id, r.chain_id, r.fingerprint)
+                    for r in pending
+                ])
+                conn.execute("UPDATE backups SET chain_id = id WHERE chain_id IS NULL AND backup_type = 'full'")
+        
+        await self.bot.adb.run_write(_insert)
+    
+    async def reconcile_pending(self) -> set:
+        """پیگیری بکاپ‌هایی که پاسخ ساختشان نرسید؛ خروجی: VM هایی که بکاپشان هنوز در جریان است"""
+        async with self._reconcile_lock:
+            rows = await self.bot.adb.fetchall('''
+                SELECT *, CAST(strftime('%s', 'now') - strftime('%s', created_at) AS REAL) AS age
+                FROM pending_backups
+            ''')
+            if not rows:
+                return set()
+            
+            running = set()
+            finished = []
+            dropped = []
+            for row in rows:
+                try:
+                    info = await self.bot.api.get_backup(row['vm_id'], row['backup_name'])
+                    status = str(info.get('status', '')).lower()
+                except Exception as e:
+                    if getattr(e, 'status', None) == 404:
+                        # درخواست هرگز به Virtualizer نرسیده است
+                        dropped.append(row)
+                        continue
+                    logger.warning(f"Could not check pending backup {row['backup_name']}: {e}")
+                    info, status = None, 'unknown'
+                
+                if status in self.BACKUP_FAILED:
+                    dropped.append(row)
+                elif info is None or status in self.BACKUP_IN_PROGRESS:
+                    if row['age'] >= self.PENDING_TTL:
+                        logger.warning(f"Giving up on pending backup {row['backup_name']} after {row['age'] / 3600:.0f}h")
+                        dropped.append(row)
+                    else:
+                        running.add(row['vm_id'])
+                else:
+                    finished.append(BackupResult(
+                        row['vm_id'], '', 'ok', row['backup_name'],
+                        path=info.get('path', ''),
+                        size=info.get('size', 0) or 0,
+                        backup_type=row['backup_type'],
+                        parent_id=row['parent_id'],
+                        chain_id=row['chain_id'],
+                        fingerprint=row['fingerprint']
+                    ))
+            
+            await self._save(finished)
+            if dropped:
+                await self.bot.adb.executemany(
+                    'DELETE FROM pending_backups WHERE backup_name = ?', [(row['backup_name'],) for row in dropped]
+                )
+            if finished or dropped:
+                logger.info(f"Pending backups: {len(finished)} recorded, {len(dropped)} dropped, {len(running)} still running")
+            return running
+    
+    async def run(self, vms: List[Dict]) -> BackupRun:
+        """بکاپ گرفتن از لیست VM ها؛ VM هایی که در بازه زمانی جا نشوند به دور بعد موکول می‌شوند"""
+        now = time.time()
+        run = BackupRun(started_at=now, deadline=now + self.window, total=len(vms))
+        self.current = run
+        
+        # VM هایی که بکاپ قبلی‌شان هنوز روی Virtualizer در جریان است دوباره صف نمی‌شوند
+        try:
+            in_flight = await self.reconcile_pending()
+        except Exception as e:
+            logger.error(f"Failed to reconcile pending backups: {e}")
+            in_flight = set()
+        waiting = [vm for vm in vms if vm['vm_id'] in in_flight]
+        vms = [vm for vm in vms if vm['vm_id'] not in in_flight]
+        
+        # صف اولویت جداگانه برای هر host تا یک host شلوغ بقیه را معطل نکند
+        latest = await self._latest_backups()
+        queues: Dict[str, List] = {}
+        for seq, (priority, vm) in enumerate(self._priorities(vms, latest)):
+            host = str(vm.get('host') or vm.get('node') or 'default')
+            heapq.heappush(queues.setdefault(host, []), (priority, seq, vm))
+        
+        global_slots = asyncio.Semaphore(self.concurrency)
+        pending: List[BackupResult] = []
+        save_lock = asyncio.Lock()
+        
+        async def record(result: BackupResult):
+            run.results.append(result)
+            if result.status == 'ok':
+                run.completed += 1
+            elif result.status == 'skipped':
+                run.skipped += 1
+            elif result.status == 'pending':
+                run.pending += 1
+            elif result.status == 'failed':
+                run.failed += 1
+                logger.error(f"Failed to backup VM {result.vm_id}: {result.error}")
+            else:
+                run.deferred += 1
+            
+            pending.append(result)
+            if len(pending) >= self.INSERT_BATCH:
+                async with save_lock:
+                    batch = pending[:]
+                    pending.clear()
+                    await self._save(batch)
+            
+            if run.done % 10 == 0 or run.done == run.total:
+                logger.info(f"Backup progress: {run.progress()}")
+        
+        async def host_worker(host: str, queue: List):
+            while queue:
+                _, _, vm = heapq.heappop(queue)
+                async with global_slots:
+                    result = await self._backup_one(vm, host, latest.get(vm['vm_id']), run)
+                await record(result)
+        
+        workers = [
+            host_worker(host, queue)
+            for host, queue in queues.items()
+            for _ in range(min(self.per_host, len(queue)))
+        ]
+        
+        for vm in waiting:
+            run.results.append(BackupResult(
+                vm['vm_id'], str(vm.get('host') or vm.get('node') or 'default'), 'pending',
+                error='previous backup still running on Virtualizer'
+            ))
+            run.pending += 1
+        
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            async with save_lock:
+                await self._save(pending)
+                pending.clear()
+            run.finished_at = time.time()
+            self.current = None
+            self.last = run
+        
+        return run
+    
+    @staticmethod
+    def format_report(run: BackupRun, slowest: int = 5) -> str:
+        """گزارش خلاصه یک دور بکاپ"""
+        lines = [
+            "💾 **گزارش بکاپ خودکار**",
+            "",
+            f"📊 {run.progress()}",
+        ]
+        
+        timed = sorted((r for r in run.results if r.duration), key=lambda r: r.duration, reverse=True)
+        if timed:
+            lines.append("")
+            lines.append("⏱ **کندترین بکاپ‌ها:**")
+            lines.extend(f"• `{r.vm_id}` ({r.host}): {r.duration:.1f}s" for r in timed[:slowest])
+        
+        problems = [r for r in run.results if r.status not in ('ok', 'skipped') or r.error]
+        if problems:
+            lines.append("")
+            lines.append("⚠️ **ناموفق / به تعویق افتاده:**")
+            lines.extend(f"• `{r.vm_id}`: {r.error}" for r in problems[:10])
+        
+        return "\n".join(lines)
+
+@dataclass
+class RetentionPolicy:
+    """سیاست نگه‌داری پدربزرگ-پدر-پسر: تعداد روزها، هفته‌ها و ماه‌هایی که یک بکاپ از آن‌ها حفظ می‌شود"""
+    daily: int = 7
+    weekly: int = 4
+    monthly: int = 6
+    
+    def select_keep(self, rows: List[Dict]) -> set:
+        """شناسه بکاپ‌های ماندنی؛ rows باید از جدید به قدیم مرتب باشد"""
+        keep = set()
+        buckets = (
+            (self.daily, lambda dt: dt.date()),
+            (self.weekly, lambda dt: dt.isocalendar()[:2]),
+            (self.monthly, lambda dt: (dt.year, dt.month)),
+        )
+        
+        for count, bucket_of in buckets:
+            seen = set()
+            for row in rows:
+                if len(seen) >= count:
+                    break
+                bucket = bucket_of(row['created'])
+                if bucket not in seen:
+                    # جدیدترین بکاپ هر بازه نماینده آن است
+                    seen.add(bucket)
+                    keep.add(row['id'])
+        
+        # incremental ها بدون بکاپ‌های قبلی زنجیره‌شان قابل بازیابی نیستند
+        chain_heads: Dict[int, int] = {}
+        for row in rows:
+            if row['id'] in keep and row['chain_id'] is not None:
+                chain_heads[row['chain_id']] = max(chain_heads.get(row['chain_id'], 0), row['id'])
+        for row in rows:
+            if row['chain_id'] in chain_heads and row['id'] <= chain_heads[row['chain_id']]:
+                keep.add(row['id'])
+        
+        return keep
+
+@dataclass
+class RetentionReport:
+    """نتیجه اجرای (یا شبیه‌سازی) سیاست نگه‌داری"""
+    dry_run: bool
+    examined: int = 0
+    deleted: int = 0
+    file_bytes: int = 0
+    store_bytes: int = 0
+    
+    @property
+    def reclaimed_bytes(self) -> int:
+        return self.file_bytes + self.store_bytes
+
+class RetentionEngine:
+    """اعمال سیاست نگه‌داری روی جدول backups و مخزن محلی"""
+    
+    DELETE_BATCH = 500
+    
+    def __init__(self, bot_instance, store: Optional[BackupStore] = None, tiers: Optional[Dict] = None,
+                 overrides: Optional[Dict] = None, unlink_workers: int = 4):
+        self.bot = bot_instance
+        self.store = store
+        self.tiers = {name: RetentionPolicy(**values) for name, values in (tiers or {}).items()}
+        self.tiers.setdefault('default', RetentionPolicy())
+        self.overrides = {vm_id: RetentionPolicy(**values) for vm_id, values in (overrides or {}).items()}
+        self.unlink_workers = unlink_workers
+    
+    def policy_for(self, vm_id: str, tier: Optional[str]) -> RetentionPolicy:
+        """سیاست VM: ابتدا تنظیم اختصاصی VM، سپس سطح کاربر مالک"""
+        if vm_id in self.overrides:
+            return self.overrides[vm_id]
+        return self.tiers.get(tier or 'default', self.tiers['default'])
+    
+    async def plan(self, owners: Optional[Dict[str, int]] = None) -> tuple:
+        """محاسبه بکاپ‌های قابل حذف؛ owners: vm_id -> user_id از لیست VM های Virtualizer"""
+        rows = await self.bot.adb.fetchall('''
+            SELECT id, vm_id, created_at, chain_id, backup_path, size
+            FROM backups
+            ORDER BY vm_id DESC, created_at DESC
+        ''')
+        tiers = {
+            row['telegram_id']: row['retention_tier']
+            for row in await self.bot.adb.fetchall(
+                'SELECT telegram_id, retention_tier FROM users WHERE retention_tier IS NOT NULL'
+            )
+        }
+        owners = owners or {}
+        
+        by_vm: Dict[str, List[Dict]] = {}
+        for row in rows:
+            item = dict(row)
+            item['created'] = datetime.fromisoformat(str(item['created_at']))
+            by_vm.setdefault(item['vm_id'], []).append(item)
+        
+        doomed = []
+        for vm_id, vm_rows in by_vm.items():
+            keep = self.policy_for(vm_id, tiers.get(owners.get(vm_id))).select_keep(vm_rows)
+            doomed.extend(row for row in vm_rows if row['id'] not in keep)
+        
+        return len(rows), doomed
+    
+    @staticmethod
+    def _existing_file_bytes(rows: List[Dict]) -> int:
+        return sum(row['size'] or 0 for row in rows if row['backup_path'] and os.path.isfile(row['backup_path']))
+    
+    @staticmethod
+    def _chunk_refs(conn, ids: List[int]) -> List:
+        """chunk های این بکاپ‌ها به همراه تعداد ارجاع از همین دسته"""
+        placeholders = ','.join('?' * len(ids))
+        return conn.execute(f'''
+            SELECT c.hash, c.size, c.refcount, r.refs
+            FROM (
+                SELECT hash, COUNT(*) AS refs FROM chunk_refs
+                WHERE backup_id IN ({placeholders}) GROUP BY hash
+            ) r
+            JOIN backup_chunks c ON c.hash = r.hash
+        ''', ids).fetchall()
+    
+    def _measure_batch(self, ids: List[int]) -> List:
+        with self.bot.db.connection() as conn:
+            return self._chunk_refs(conn, ids)
+    
+    def _delete_batch(self, ids: List[int]) -> tuple:
+        """حذف یک دسته در یک تراکنش؛ خروجی: (حجم chunk های آزاد شده، chunk های بدون ارجاع)"""
+        placeholders = ','.join('?' * len(ids))
+        
+        with self.bot.db.transaction() as conn:
+            freed = [row for row in self._chunk_refs(conn, ids) if row['refcount'] - row['refs'] <= 0]
+            conn.execute(f'''
+                UPDATE backup_chunks
+                SET refcount = refcount - (
+                    SELECT COUNT(*) FROM chunk_refs r
+                    WHERE r.hash = backup_chunks.hash AND r.backup_id IN ({placeholders})
+                )
+                WHERE hash IN (SELECT hash FROM chunk_refs WHERE backup_id IN ({placeholders}))
+            ''', ids + ids)
+            conn.execute(f'DELETE FROM chunk_refs WHERE backup_id IN ({placeholders})', ids)
+            conn.execute(f'DELETE FROM backups WHERE id IN ({placeholders})', ids)
+            conn.executemany('DELETE FROM backup_chunks WHERE hash = ?', [(row['hash'],) for row in freed])
+        
+        return sum(row['size'] for row in freed), [row['hash'] for row in freed]
+    
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to remove {path}: {e}")
+    
+    async def apply(self, dry_run: bool = False, owners: Optional[Dict[str, int]] = None) -> RetentionReport:
+        """اجرای سیاست؛ در حالت dry_run فقط حجم قابل آزادسازی گزارش می‌شود"""
+        examined, doomed = await self.plan(owners)
+        report = RetentionReport(dry_run=dry_run, examined=examined, deleted=len(doomed))
+        if not doomed:
+            return report
+        
+        loop = asyncio.get_running_loop()
+        report.file_bytes = await loop.run_in_executor(None, self._existing_file_bytes, doomed)
+        
+        paths = [row['backup_path'] for row in doomed if row['backup_path']]
+        pending_refs: Dict[str, List[int]] = {}  # hash -> [size, refcount, refs]
+        for start in range(0, len(doomed), self.DELETE_BATCH):
+            ids = [row['id'] for row in doomed[start:start + self.DELETE_BATCH]]
+            if dry_run:
+                # ارجاع‌های یک chunk ممکن است در چند دسته باشد؛ جمع آن‌ها در پایان مقایسه می‌شود
+                for row in await self.bot.adb.run_read(self._measure_batch, ids):
+                    entry = pending_refs.setdefault(row['hash'], [row['size'], row['refcount'], 0])
+                    entry[2] += row['refs']
+            else:
+                freed_bytes, hashes = await self.bot.adb.run_write(self._delete_batch, ids)
+                report.store_bytes += freed_bytes
+                if self.store is not None:
+                    paths.extend(self.store.chunk_path(digest) for digest in hashes)
+        
+        if dry_run:
+            report.store_bytes = sum(size for size, refcount, refs in pending_refs.values() if refcount - refs <= 0)
+        else:
+            # حذف فایل‌ها پس از commit؛ در بدترین حالت فایل یتیم باقی می‌ماند نه رکورد بدون فایل
+            with ThreadPoolExecutor(max_workers=self.unlink_workers) as executor:
+                await asyncio.gather(*(loop.run_in_executor(executor, self._unlink, path) for path in paths))
+        
+        return report
 
 class BackupManager:
     """مدیریت پیشرفته بکاپ"""
     
     def __init__(self, bot_instance):
         self.bot = bot_instance
+        config = bot_instance.config
+        self.store = None
+        if config.BACKUP_STORE_DIR:
+            self.store = BackupStore(bot_instance.adb, config.BACKUP_STORE_DIR, config.BACKUP_CHUNK_SIZE)
+        self.orchestrator = BackupOrchestrator(
+            bot_instance,
+            concurrency=config.BACKUP_CONCURRENCY,
+            per_host=config.BACKUP_PER_HOST_CONCURRENCY,
+            window=config.BACKUP_WINDOW,
+            mode=config.BACKUP_MODE,
+            full_every=config.BACKUP_FULL_EVERY,
+            max_age_days=config.BACKUP_MAX_AGE_DAYS,
+            store=self.store
+        )
+        self.retention = RetentionEngine(
+            bot_instance,
+            store=self.store,
+            tiers=config.BACKUP_RETENTION_TIERS,
+            overrides=config.BACKUP_RETENTION_OVERRIDES
+        )
+        # dedup در ingest به وجود فایل chunk تکیه دارد و ارجاع آن دیرتر در _save ثبت می‌شود و
+        # بازیابی chunk ها را در طول ارسال می‌خواند؛ بکاپ و بازیابی مشترک، نگه‌داری انحصاری
+        self.store_lock = SharedLock()
     
     async def auto_backup_all_vms(self):
-        """بکاپ خودکار تمام VM ها"""
+        """بکاپ خودکار تمام VM های روشن"""
         try:
             vms = await self.bot.api.list_vms()
+            running = [vm for vm in vms if vm['status'] == 'running']
             
-            for vm in vms:
-                if vm['status'] == 'running':
-                    backup_name = f"auto_backup_{vm['vm_id']}_{datetime.now().strftime('%Y%m%d_%H%M')}"
-                    
-                    try:
-                        result = await self.bot.api.create_backup(vm['vm_id'], backup_name)
+            async with self.store_lock.shared():
+                run = await self.orchestrator.run(running)
+            logger.info(f"Auto backup finished: {run.progress()}")
+            
+            await self.bot.broadcaster.broadcast(
+                self.bot.config.ADMIN_USER_IDS,
+                self.orchestrator.format_report(run)
+            )
+            return run
                         
-                        # ثبت در دیتابیس
-                        with sqlite3.connect(self.bot.db.db_path) as conn:
-                            cursor = conn.cursor()
+        except Exception as e:
+            logger.error(f"Auto backup failed: {e}")
+    
+    async def reconcile_pending_backups(self):
+        """ثبت بکاپ‌هایی که پس از پایان بازه زمانی روی Virtualizer تمام شده‌اند"""
+        try:
+            await self.orchestrator.reconcile_pending()
+        except Exception as e:
+            logger.error(f"Pending backup reconciliation failed: {e}")
+    
+    async def resolve_chain(self, backup_id: int) -> List[Dict]:
+        """زنجیره لازم برای بازیابی: بکاپ کامل و سپس incremental ها تا بکاپ مورد نظر"""
+        target = await self.bot.adb.fetchone('SELECT chain_id FROM backups WHERE id = ?', (backup_id,))
+        if target is None:
+            return []
+        
+        rows = await self.bot.adb.fetchall('''
+            SELECT * FROM backups
+            WHERE chain_id = ? AND id <= ?
+            ORDER BY id
+        ''', (target['chain_id'], backup_id))
+        return [dict(row) for row in rows]
+    
+    async def restore_backup(self, vm_id: str, backup_id: int) -> Dict:
+        """بازیابی VM از یک بکاپ (کامل یا incremental)"""
+        async with self.store_lock.shared():
+            return await self._restore(vm_id, backup_id)
+    
+    async def _restore(self, vm_id: str, backup_id: int) -> Dict:
+        chain = await self.resolve_chain(backup_id)
+        if not chain:
+            raise ValueError(f"Backup {backup_id} not found")
+        
+        # نسخه‌های محلی قبل از هر ارسالی بررسی می‌شوند تا زنجیره نیمه‌کاره بازیابی نشود
+        stored = [row for row in chain if row.get('checksum') and self.store is not None]
+        for row in stored:
+            if not await self.store.verify(row['id']):
+                raise ValueError(f"Backup {row['backup_name']} failed integrity verification")
+        
+        for row in stored:
+            await self.bot.api.upload_backup(vm_id, row['backup_name'], self.store.stream(row['id']))
+        
+        names = [row['backup_name'] for row in chain]
+        return await self.bot.api.restore_backup(vm_id, names[-1], chain=names if len(names) > 1 else None)
+    
+    async def cleanup_old_backups(self, dry_run: bool = False) -> Optional[RetentionReport]:
+        """حذف بکاپ‌های خارج از سیاست نگه‌داری"""
+        try:
+            # مالک VM ها فقط در Virtualizer ثبت است؛ بدون آن سطح نگه‌داری کاربر معلوم نیست
+            vms = await self.bot.api.list_vms(use_cache=False)
+            owners = {vm['vm_id']: vm.get('user_id') for vm in vms if vm.get('user_id') is not None}
+            
+            async with self.store_lock.exclusive():
+                report = await self.retention.apply(dry_run=dry_run, owners=owners)
+                if self.store is not None and not dry_run:
+                    orphans, orphan_bytes = await self.store.sweep()
+                    report.store_bytes += orphan_bytes
+                    if orphans:
+                        logger.info(f"Removed {orphans} unreferenced chunk files from the backup store")
+            action = "Would remove" if dry_run else "Removed"
+            logger.info(
+                f"{action} {report.deleted}/{report.examined} backups, "
+                f"reclaiming {report.reclaimed_bytes / (1024 ** 3):.2f} GB"
+            )
+            return report
+                
+        except Exception as e:
+            logger.error(f"Backup cleanup failed: {e}")
+
+class UserQuotaManager:
+    """مدیریت کوتا کاربران"""
+    
+    def __init__(self, bot_instance):
+        self.bot = bot_instance
+    
+    def check_user_quota(self, user_id: int, resource_type: str, amount: int) -> bool:
+        """بررسی کوتا کاربر"""
+        user = self.bot.db.get_user(user_id)
+        if not user:
+            return False
+        
+        # محاسبه مصرف فعلی
+        current_usage = self.get_user_resource_usage(user_id)
+        
+        quotas = {
+            'cpu': user.get('max_cpu', 4),
+            'ram': user.get('max_ram', 8192),
+            'disk': user.get('max_disk', 102400),
+            'vms': user.get('max_vms', 5)
+        }
+        
+        if resource_type in quotas:
+            return current_usage.get(resource_type, 0) + amount <= quotas[resource_type]
+        
+        return True
+    
+    def get_user_resource_usage(self, user_id: int) -> Dict:
+        """محاسبه مصرف منابع کاربر"""
+        try:
+            with self.bot.db.connection() as conn:
+                cursor = conn.cursor()
+                
                 cursor.execute('''
                     SELECT SUM(cpu) as total_cpu, SUM(ram) as total_ram, 
                            SUM(disk) as total_disk, COUNT(*) as total_vms
@@ -172,6 +1732,252 @@ class BackupManager:
             logger.error(f"Failed to get user resource usage: {e}")
             return {'cpu': 0, 'ram': 0, 'disk': 0, 'vms': 0}
 
+# ===== زمان‌بندی =====
+
+class IntervalTrigger:
+    """اجرا در فواصل ثابت"""
+    
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+    
+    def next_after(self, ts: float) -> float:
+        return ts + self.seconds
+    
+    def __str__(self):
+        return f"every {self.seconds:g}s"
+
+class CronTrigger:
+    """اجرا بر اساس عبارت cron پنج بخشی (دقیقه ساعت روز ماه روز‌هفته) به وقت محلی"""
+    
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+    
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Invalid cron expression: {expression}")
+        
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(part, low, high) for part, (low, high) in zip(parts, self.FIELDS)
+        )
+        # طبق cron اگر هر دو محدود باشند (با * شروع نشوند)، تطابق با یکی از آن دو کافی است
+        self._day_or = not parts[2].startswith('*') and not parts[4].startswith('*')
+    
+    @staticmethod
+    def _parse(part: str, low: int, high: int) -> frozenset:
+        values = set()
+        for item in part.split(','):
+            range_part, _, step = item.partition('/')
+            if range_part == '*':
+                start, end = low, high
+            elif '-' in range_part:
+                start, end = (int(v) for v in range_part.split('-'))
+            else:
+                # مثل cron، عبارت N/step یعنی از N تا انتهای بازه با همان گام
+                start = int(range_part)
+                end = high if step else start
+            if start < low or end > high or start > end:
+                raise ValueError(f"Cron value out of range: {item}")
+            step = int(step) if step else 1
+            if step < 1:
+                raise ValueError(f"Invalid cron step: {item}")
+            values.update(range(start, end + 1, step))
+        return frozenset(values)
+    
+    def _day_matches(self, dt: datetime) -> bool:
+        # روز هفته cron از یکشنبه = 0 شروع می‌شود
+        day_ok = dt.day in self.days
+        weekday_ok = (dt.weekday() + 1) % 7 in self.weekdays
+        return (day_ok or weekday_ok) if self._day_or else (day_ok and weekday_ok)
+    
+    def next_after(self, ts: float) -> float:
+        dt = datetime.fromtimestamp(ts).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 4)
+        
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self._day_matches(dt):
+                dt = (dt + timedelta(days=1)).replace(hour=0, minute=0)
+            elif dt.hour not in self.hours:
+                dt = (dt + timedelta(hours=1)).replace(minute=0)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt.timestamp()
+        
+        raise ValueError(f"Cron expression never fires: {self.expression}")
+    
+    def __str__(self):
+        return self.expression
+
+@dataclass
+class ScheduledJob:
+    """یک وظیفه زمان‌بندی شده و آمار اجرای آن"""
+    name: str
+    func: Callable
+    trigger: object
+    jitter: float = 0.0
+    misfire: str = 'run_once'  # run_once یا skip
+    timeout: Optional[float] = None
+    next_run: float = 0.0
+    last_run: Optional[float] = None
+    last_status: Optional[str] = None
+    last_duration: float = 0.0
+    max_duration: float = 0.0
+    total_duration: float = 0.0
+    runs: int = 0
+    failures: int = 0
+    overlaps: int = 0
+    missed: int = 0
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+class AsyncScheduler:
+    """زمان‌بند مبتنی بر asyncio با جلوگیری از هم‌پوشانی و ذخیره وضعیت در SQLite"""
+    
+    def __init__(self, adb):
+        self.adb = adb
+        self.jobs: Dict[str, ScheduledJob] = {}
+        self._loops: List[asyncio.Task] = []
+    
+    def add_job(self, name: str, func: Callable, trigger, jitter: float = 0.0,
+                misfire: str = 'run_once', timeout: Optional[float] = None) -> ScheduledJob:
+        """ثبت یک وظیفه؛ func یک تابع async بدون آرگومان است"""
+        if misfire not in ('run_once', 'skip'):
+            raise ValueError(f"Unknown misfire policy: {misfire}")
+        job = ScheduledJob(name, func, trigger, jitter=jitter, misfire=misfire, timeout=timeout)
+        self.jobs[name] = job
+        return job
+    
+    async def _load_state(self):
+        rows = await self.adb.fetchall('SELECT * FROM scheduler_state')
+        for row in rows:
+            job = self.jobs.get(row['job'])
+            if job is not None:
+                job.last_run = row['last_run']
+                job.last_status = row['last_status']
+                job.last_duration = row['last_duration'] or 0.0
+                job.runs = row['runs']
+                job.failures = row['failures']
+    
+    async def _save_state(self, job: ScheduledJob):
+        await self.adb.execute('''
+            INSERT INTO scheduler_state (job, last_run, last_status, last_duration, runs, failures)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(job) DO UPDATE SET
+                last_run = excluded.last_run,
+                last_status = excluded.last_status,
+                last_duration = excluded.last_duration,
+                runs = excluded.runs,
+                failures = excluded.failures
+        ''', (job.name, job.last_run, job.last_status, job.last_duration, job.runs, job.failures))
+    
+    async def _execute(self, job: ScheduledJob, scheduled_at: float):
+        """اجرای یک بار وظیفه و ثبت آمار"""
+        started = time.monotonic()
+        try:
+            if job.timeout:
+                await asyncio.wait_for(job.func(), job.timeout)
+            else:
+                await job.func()
+            job.last_status = 'ok'
+        except Exception as e:
+            job.last_status = f'error: {e}'
+            job.failures += 1
+            logger.error(f"Scheduled job {job.name} failed: {e}")
+        
+        # اجرای لغو شده ثبت نمی‌شود تا پس از راه‌اندازی مجدد به عنوان نوبت جا مانده اجرا شود
+        duration = time.monotonic() - started
+        job.runs += 1
+        job.last_run = scheduled_at
+        job.last_duration = duration
+        job.total_duration += duration
+        job.max_duration = max(job.max_duration, duration)
+        try:
+            await self._save_state(job)
+        except Exception as e:
+            logger.error(f"Failed to persist state of job {job.name}: {e}")
+    
+    def _launch(self, job: ScheduledJob, scheduled_at: float):
+        # اگر اجرای قبلی هنوز تمام نشده، این نوبت رد می‌شود
+        if job.task is not None and not job.task.done():
+            job.overlaps += 1
+            logger.warning(f"Skipping job {job.name}: previous run still in progress")
+            return
+        job.task = asyncio.create_task(self._execute(job, scheduled_at))
+    
+    async def _job_loop(self, job: ScheduledJob):
+        """حلقه یک وظیفه؛ زمان بعدی از زمان برنامه‌ریزی شده محاسبه می‌شود تا drift ایجاد نشود"""
+        now = time.time()
+        
+        if job.last_run is not None:
+            due = job.trigger.next_after(job.last_run)
+            if due < now:
+                job.missed += 1
+                if job.misfire == 'run_once':
+                    logger.info(f"Running missed job {job.name} (was due {datetime.fromtimestamp(due)})")
+                    self._launch(job, now)
+            job.next_run = due if due >= now else job.trigger.next_after(now)
+        else:
+            job.next_run = job.trigger.next_after(now)
+        
+        while True:
+            delay = job.next_run - time.time() + random.uniform(0, job.jitter)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            
+            scheduled_at = job.next_run
+            self._launch(job, scheduled_at)
+            
+            # نوبت‌های عقب افتاده (مثلاً پس از sleep سیستم) یک بار اجرا می‌شوند نه پشت سر هم
+            next_run = job.trigger.next_after(scheduled_at)
+            now = time.time()
+            if next_run <= now:
+                job.missed += 1
+                next_run = job.trigger.next_after(now)
+            job.next_run = next_run
+    
+    async def start(self):
+        """بارگذاری وضعیت قبلی و شروع تمام وظایف"""
+        if self._loops:
+            return
+        try:
+            await self._load_state()
+        except Exception as e:
+            logger.error(f"Failed to load scheduler state: {e}")
+        self._loops = [asyncio.create_task(self._job_loop(job)) for job in self.jobs.values()]
+    
+    async def stop(self):
+        """توقف زمان‌بند و لغو اجراهای در حال انجام"""
+        tasks = self._loops + [job.task for job in self.jobs.values() if job.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loops = []
+        for job in self.jobs.values():
+            job.task = None
+    
+    def stats(self) -> List[Dict]:
+        """آمار اجرای وظایف"""
+        return [
+            {
+                'name': job.name,
+                'trigger': str(job.trigger),
+                'next_run': job.next_run,
+                'last_run': job.last_run,
+                'last_status': job.last_status,
+                'last_duration': job.last_duration,
+                'avg_duration': job.total_duration / job.runs if job.runs else 0.0,
+                'max_duration': job.max_duration,
+                'runs': job.runs,
+                'failures': job.failures,
+                'overlaps': job.overlaps,
+                'missed': job.missed,
+                'running': job.task is not None and not job.task.done()
+            }
+            for job in self.jobs.values()
+        ]
+
 class ScheduledTasks:
     """مدیریت وظایف زمان‌بندی شده"""
     
@@ -180,27 +1986,63 @@ class ScheduledTasks:
         self.monitoring = AdvancedMonitoring(bot_instance)
         self.backup_manager = BackupManager(bot_instance)
     
-    def setup_schedules(self):
+    def setup_schedules(self, scheduler: AsyncScheduler):
         """تنظیم برنامه‌های زمان‌بندی"""
         # بررسی سلامت سیستم هر 5 دقیقه
-        schedule.every(5).minutes.do(
-            lambda: asyncio.create_task(self.monitoring.check_system_health())
+        scheduler.add_job(
+            'health_check', self.monitoring.check_system_health,
+            IntervalTrigger(300), jitter=5, misfire='skip', timeout=120
         )
         
         # بکاپ خودکار روزانه در ساعت 2 شب
-        schedule.every().day.at("02:00").do(
-            lambda: asyncio.create_task(self.backup_manager.auto_backup_all_vms())
+        scheduler.add_job(
+            'auto_backup', self.backup_manager.auto_backup_all_vms,
+            CronTrigger('0 2 * * *'), jitter=60
         )
         
-        # پاکسازی بکاپ‌های قدیمی هفتگی
-        schedule.every().sunday.at("03:00").do(
-            lambda: asyncio.create_task(self.backup_manager.cleanup_old_backups())
+        # پیگیری بکاپ‌هایی که پاسخ ساختشان در بازه زمانی نرسید
+        scheduler.add_job(
+            'backup_reconcile', self.backup_manager.reconcile_pending_backups,
+            IntervalTrigger(3600), jitter=60, misfire='skip'
+        )
+        
+        # اعمال سیاست نگه‌داری بکاپ‌ها روزانه
+        scheduler.add_job(
+            'backup_cleanup', self.backup_manager.cleanup_old_backups,
+            CronTrigger('0 3 * * *'), jitter=60
         )
         
         # گزارش آمار روزانه
-        schedule.every().day.at("09:00").do(
-            lambda: asyncio.create_task(self.send_daily_report())
+        scheduler.add_job(
+            'daily_report', self.send_daily_report,
+            CronTrigger('0 9 * * *')
+        )
+        
+        # پاک‌سازی پیام‌های ناموفق قدیمی صف اعلان‌ها
+        scheduler.add_job(
+            'outbox_prune', self.prune_notification_outbox,
+            CronTrigger('30 4 * * *'), jitter=60
         )
+        
+        # بایگانی لاگ‌های قدیمی روزانه
+        scheduler.add_job(
+            'archive_logs', self.archive_activity_logs,
+            CronTrigger('0 4 * * *'), jitter=60
+        )
+    
+    async def prune_notification_outbox(self):
+        """حذف پیام‌های ناموفق قدیمی از صف اعلان‌ها"""
+        try:
+            await self.bot.broadcaster.prune(self.bot.config.BROADCAST_FAILED_RETENTION_DAYS)
+        except Exception as e:
+            logger.error(f"Notification outbox prune failed: {e}")
+    
+    async def archive_activity_logs(self):
+        """انتقال لاگ‌های قدیمی به فایل‌های بایگانی ماهانه"""
+        try:
+            await self.bot.adb.run_write(self.bot.db.log_archive.archive_old_logs)
+        except Exception as e:
+            logger.error(f"Activity log archival failed: {e}")
     
     async def send_daily_report(self):
         """ارسال گزارش روزانه"""
@@ -209,29 +2051,25 @@ class ScheduledTasks:
             all_vms = await self.bot.api.list_vms()
             active_vms = len([vm for vm in all_vms if vm['status'] == 'running'])
             
-            with sqlite3.connect(self.bot.db.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # کاربران فعال امروز
-                cursor.execute('''
-                    SELECT COUNT(DISTINCT user_id) 
-                    FROM activity_logs 
-                    WHERE DATE(timestamp) = DATE('now')
-                ''')
-                active_users_today = cursor.fetchone()[0]
-                
-                # تعداد VM های ایجاد شده امروز
-                cursor.execute('''
-                    SELECT COUNT(*) 
-                    FROM virtual_machines 
-                    WHERE DATE(created_at) = DATE('now')
-                ''')
-                new_vms_today = cursor.fetchone()[0]
+            # کاربران فعال امروز
+            active_users_today = (await self.bot.adb.fetchone('''
+                SELECT COUNT(DISTINCT user_id) 
+                FROM activity_logs 
+                WHERE timestamp >= DATE('now') AND timestamp < DATE('now', '+1 day')
+            '''))[0]
+            
+            # تعداد VM های ایجاد شده امروز
+            new_vms_today = (await self.bot.adb.fetchone('''
+                SELECT COUNT(*) 
+                FROM virtual_machines 
+                WHERE created_at >= DATE('now') AND created_at < DATE('now', '+1 day')
+            '''))[0]
             
             # آمار سیستم
-            cpu_usage = psutil.cpu_percent()
-            memory = psutil.virtual_memory()
-            disk = psutil.disk_usage('/')
+            snapshot = self.bot.sampler.latest()
+            cpu_usage = snapshot.cpu_percent
+            memory = snapshot.memory
+            disk = snapshot.disk
             
             report = f"""
 📊 **گزارش روزانه سرور**
@@ -251,15 +2089,7 @@ class ScheduledTasks:
             """
             
             # ارسال به ادمین‌ها
-            for admin_id in config.ADMIN_USER_IDS:
-                try:
-                    await self.bot.app.bot.send_message(
-                        admin_id,
-                        report,
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send daily report to {admin_id}: {e}")
+            await self.bot.broadcaster.broadcast(self.bot.config.ADMIN_USER_IDS, report)
                     
         except Exception as e:
             logger.error(f"Failed to generate daily report: {e}")
@@ -381,10 +2211,7 @@ class BotTesting:
     async def test_database(self) -> bool:
         """تست دیتابیس"""
         try:
-            with sqlite3.connect(self.bot.db.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM users")
-                cursor.fetchone()
+            await self.bot.adb.fetchone("SELECT COUNT(*) FROM users")
             return True
         except Exception as e:
             logger.error(f"Database test failed: {e}")
@@ -538,84 +2365,3 @@ async def run_diagnostics():
 if __name__ == "__main__":
     # اجرای تشخیص مشکلات
     asyncio.run(run_diagnostics())
-            cursor.execute('''
-                                INSERT INTO backups (vm_id, backup_name, backup_path, size)
-                                VALUES (?, ?, ?, ?)
-                            ''', (
-                                vm['vm_id'], 
-                                backup_name, 
-                                result.get('path', ''), 
-                                result.get('size', 0)
-                            ))
-                            conn.commit()
-                        
-                        logger.info(f"Auto backup created for VM {vm['vm_id']}")
-                        
-                    except Exception as e:
-                        logger.error(f"Failed to backup VM {vm['vm_id']}: {e}")
-                        
-        except Exception as e:
-            logger.error(f"Auto backup failed: {e}")
-    
-    async def cleanup_old_backups(self, retention_days: int = 30):
-        """حذف بکاپ‌های قدیمی"""
-        try:
-            cutoff_date = datetime.now() - timedelta(days=retention_days)
-            
-            with sqlite3.connect(self.bot.db.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT * FROM backups 
-                    WHERE created_at < ?
-                ''', (cutoff_date,))
-                
-                old_backups = cursor.fetchall()
-                
-                for backup in old_backups:
-                    # حذف فایل بکاپ
-                    if os.path.exists(backup[3]):  # backup_path
-                        os.remove(backup[3])
-                    
-                    # حذف از دیتابیس
-                    cursor.execute('DELETE FROM backups WHERE id = ?', (backup[0],))
-                
-                conn.commit()
-                logger.info(f"Cleaned up {len(old_backups)} old backups")
-                
-        except Exception as e:
-            logger.error(f"Backup cleanup failed: {e}")
-
-class UserQuotaManager:
-    """مدیریت کوتا کاربران"""
-    
-    def __init__(self, bot_instance):
-        self.bot = bot_instance
-    
-    def check_user_quota(self, user_id: int, resource_type: str, amount: int) -> bool:
-        """بررسی کوتا کاربر"""
-        user = self.bot.db.get_user(user_id)
-        if not user:
-            return False
-        
-        # محاسبه مصرف فعلی
-        current_usage = self.get_user_resource_usage(user_id)
-        
-        quotas = {
-            'cpu': user.get('max_cpu', 4),
-            'ram': user.get('max_ram', 8192),
-            'disk': user.get('max_disk', 102400),
-            'vms': user.get('max_vms', 5)
-        }
-        
-        if resource_type in quotas:
-            return current_usage.get(resource_type, 0) + amount <= quotas[resource_type]
-        
-        return True
-    
-    def get_user_resource_usage(self, user_id: int) -> Dict:
-        """محاسبه مصرف منابع کاربر"""
-        try:
-            with sqlite3.connect(self.bot.db.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
\ No newline at end of file
@@ -0,0 +1,185 @@
+"""میکروبنچمارک مسیریابی callback ها و دکمه‌های متنی
+
+مقایسه زنجیره startswith/replace قدیمی button_handler و مقایسه‌های پشت سر هم
+message_handler با CallbackRouter و جدول text_routes. handler ها بدون کار هستند تا
+فقط هزینه مسیریابی، بررسی دسترسی و کدگذاری اندازه‌گیری شود.
+
+اجرا:
+    python benchmarks/bench_callback_routing.py --iterations 200000
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server_management_bot import CallbackRouter, ServerManagementBot  # noqa: E402
+
+ADMIN_ID = 1
+USER_ID = 2
+VM_ID = 'vm-1234'
+LONG_VM_ID = 'vm-' + 'x' * 80
+
+LEGACY_DATA = [
+    'refresh_stats', f'manage_vm_{VM_ID}', f'start_vm_{VM_ID}', f'stop_vm_{VM_ID}',
+    f'restart_vm_{VM_ID}', f'delete_vm_{VM_ID}', f'chart_vm.{VM_ID}_6h', f'vm_stats_{VM_ID}',
+    'create_vm', 'back_to_vms', 'admin_logs_7'
+]
+
+TEXT_LABELS = [
+    "📊 آمار سرور", "💻 ماشین‌های من", "➕ ایجاد VM جدید", "⚙️ تنظیمات",
+    "📋 راهنما", "📞 پشتیبانی", "👑 پنل ادمین", "متن آزاد"
+]
+
+
+def legacy_button_route(data: str, admin: bool):
+    """کپی زنجیره شرط‌های button_handler پیش از CallbackRouter"""
+    if data == "refresh_stats":
+        return 'ss', ''
+    elif data.startswith("manage_vm_"):
+        return 'mv', data.replace("manage_vm_", "")
+    elif data.startswith("start_vm_"):
+        return 'on', data.replace("start_vm_", "")
+    elif data.startswith("stop_vm_"):
+        return 'of', data.replace("stop_vm_", "")
+    elif data.startswith("restart_vm_"):
+        return 'rb', data.replace("restart_vm_", "")
+    elif data.startswith("delete_vm_"):
+        return 'rm', data.replace("delete_vm_", "")
+    elif data.startswith("chart_"):
+        return 'ch', data.replace("chart_", "", 1).rsplit("_", 1)
+    elif data.startswith("vm_stats_"):
+        return 'vs', data.replace("vm_stats_", "")
+    elif data == "create_vm":
+        return 'nv', ''
+    elif data == "back_to_vms":
+        return 'ls', ''
+    elif data.startswith("admin_logs") and admin:
+        return 'lg', int(data.replace("admin_logs_", "")) if data != "admin_logs" else 1
+    return None
+
+
+def legacy_text_route(text: str, admin: bool):
+    """کپی زنجیره مقایسه‌های message_handler پیش از text_routes"""
+    if text == "📊 آمار سرور":
+        return 'server_stats'
+    elif text == "💻 ماشین‌های من":
+        return 'my_vms'
+    elif text == "➕ ایجاد VM جدید":
+        return 'create_vm_command'
+    elif text == "⚙️ تنظیمات":
+        return 'settings_command'
+    elif text == "📋 راهنما":
+        return 'help_command'
+    elif text == "📞 پشتیبانی":
+        return 'support_command'
+    elif text == "👑 پنل ادمین" and admin:
+        return 'admin_panel'
+    return None
+
+
+def build_router():
+    """جدول مسیرهای واقعی ربات با handler های بدون کار"""
+    async def owns_vm(user_id: int, vm_id: str) -> bool:
+        return True
+    
+    router = CallbackRouter(None, lambda user_id: user_id == ADMIN_ID, owns_vm)
+    bot = ServerManagementBot.__new__(ServerManagementBot)
+    bot.router = router
+    bot.setup_routes()
+    
+    async def noop(query, arg):
+        return None
+    
+    for route in router.routes.values():
+        route.handler = noop
+    
+    return router, bot.text_routes
+
+
+def report(name: str, iterations: int, elapsed: float, baseline: float = None):
+    per_op = elapsed / iterations * 1e9
+    line = f"{name:<44} {per_op:9.0f} ns/op"
+    if baseline:
+        line += f"   ({baseline / elapsed:.2f}x vs legacy)"
+    print(line)
+    return elapsed
+
+
+def timed(func, iterations: int) -> float:
+    started = time.perf_counter()
+    func(iterations)
+    return time.perf_counter() - started
+
+
+async def timed_async(func, iterations: int) -> float:
+    started = time.perf_counter()
+    await func(iterations)
+    return time.perf_counter() - started
+
+
+async def main(iterations: int, router: CallbackRouter, text_routes: dict, tokenized: str):
+    compact = [
+        router.encode('ss'), router.encode('mv', VM_ID), router.encode('on', VM_ID),
+        router.encode('of', VM_ID), router.encode('rb', VM_ID), router.encode('rm', VM_ID),
+        router.encode('ch', f'6h:vm.{VM_ID}'), router.encode('vs', VM_ID),
+        router.encode('nv'), router.encode('ls'), router.encode('lg', '7')
+    ]
+    # مسیر lg فقط برای ادمین است و برای کاربر عادی رد می‌شود
+    user_compact = compact[:-1]
+    
+    def run_legacy_buttons(n):
+        for i in range(n):
+            legacy_button_route(LEGACY_DATA[i % len(LEGACY_DATA)], True)
+    
+    async def run_decode(n, data):
+        for i in range(n):
+            await router.decode(data[i % len(data)])
+    
+    async def run_dispatch(n, user_id, data):
+        for i in range(n):
+            await router.dispatch(None, data[i % len(data)], user_id)
+    
+    async def run_token(n):
+        for _ in range(n):
+            await router.decode(tokenized)
+    
+    def run_encode(n):
+        for _ in range(n):
+            router.encode('mv', VM_ID)
+    
+    def run_legacy_text(n):
+        for i in range(n):
+            legacy_text_route(TEXT_LABELS[i % len(TEXT_LABELS)], True)
+    
+    def run_text_table(n):
+        for i in range(n):
+            route = text_routes.get(TEXT_LABELS[i % len(TEXT_LABELS)])
+            if route is not None and route[1]:
+                pass
+    
+    print(f"{iterations} iterations, {len(compact)} callback shapes, {len(TEXT_LABELS)} text labels\n")
+    
+    baseline = report("legacy button_handler if/elif chain", iterations, timed(run_legacy_buttons, iterations))
+    report("router.decode (compact 1|code|arg)", iterations, await timed_async(lambda n: run_decode(n, compact), iterations), baseline)
+    report("router.decode (legacy data, prefix table)", iterations, await timed_async(lambda n: run_decode(n, LEGACY_DATA), iterations), baseline)
+    report("router.decode (~token, cached)", iterations, await timed_async(run_token, iterations))
+    report("router.dispatch (admin, no ownership check)", iterations, await timed_async(lambda n: run_dispatch(n, ADMIN_ID, compact), iterations))
+    report("router.dispatch (user, owns_vm check)", iterations, await timed_async(lambda n: run_dispatch(n, USER_ID, user_compact), iterations))
+    report("router.encode (short arg)", iterations, timed(run_encode, iterations))
+    print()
+    baseline = report("legacy message_handler == chain", iterations, timed(run_legacy_text, iterations))
+    report("text_routes dict lookup", iterations, timed(run_text_table, iterations), baseline)
+    print(f"\nlong vm_id callback_data: {len(tokenized.encode())} bytes (limit {CallbackRouter.MAX_BYTES})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--iterations', type=int, default=200000)
+    router, text_routes = build_router()
+    # توکن خارج از event loop ساخته می‌شود تا فقط در کش حافظه بماند و به دیتابیس نرود
+    tokenized = router.encode('mv', LONG_VM_ID)
+    asyncio.run(main(parser.parse_args().iterations, router, text_routes, tokenized))
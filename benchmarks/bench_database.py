@@ -0,0 +1,121 @@
+"""مقایسه توان پردازش update ها با فراخوانی مستقیم Database و با AsyncDatabase
+
+هر update شبیه‌سازی شده یک SELECT روی users، یک INSERT با commit و یک پاسخ شبکه‌ای
+(asyncio.sleep) دارد. در حالت sync کوئری‌ها روی event loop اجرا می‌شوند و بقیه کاربران
+پشت آن‌ها می‌مانند؛ در حالت async به thread های AsyncDatabase می‌روند.
+
+با WAL و synchronous=NORMAL روی دیسک محلی سریع، هر کوئری چند ده میکروثانیه است و
+هزینه رفت و برگشت thread ها از سود آن بیشتر می‌شود. --disk-latency-ms تأخیر ذخیره‌سازی
+کند (fsync روی دیسک شبکه‌ای، checkpoint، قفل) را با sleep مسدودکننده در همان thread
+اجرای کوئری شبیه‌سازی می‌کند؛ با 0 فقط دیسک واقعی اندازه‌گیری می‌شود.
+
+اجرا:
+    python benchmarks/bench_database.py --users 200 --updates 10 --disk-latency-ms 2
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server_management_bot import AsyncDatabase, Database  # noqa: E402
+
+SELECT_USER = 'SELECT * FROM users WHERE telegram_id = ?'
+INSERT_EVENT = 'INSERT INTO activity_logs (user_id, action, details) VALUES (?, ?, ?)'
+
+
+def percentile(samples, p: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+async def loop_lag(samples: list, interval: float = 0.005):
+    """تأخیر event loop: فاصله بیدار شدن واقعی از زمان مورد انتظار"""
+    while True:
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        samples.append((time.perf_counter() - expected) * 1000)
+
+
+async def run(mode: str, db: Database, adb: AsyncDatabase, users: int, updates: int,
+              reply_latency: float, disk_latency: float) -> dict:
+    latencies = []
+    lag = []
+    
+    def read(user_id: int):
+        time.sleep(disk_latency)
+        return db.fetchone(SELECT_USER, (user_id,))
+    
+    def write(user_id: int, details: str):
+        time.sleep(disk_latency)
+        return db.execute(INSERT_EVENT, (user_id, 'bench', details))
+    
+    async def handle(user_id: int, seq: int):
+        started = time.perf_counter()
+        if mode == 'sync':
+            read(user_id)
+            write(user_id, f'{mode} {seq}')
+        else:
+            await adb.run_read(read, user_id)
+            await adb.run_write(write, user_id, f'{mode} {seq}')
+        # ارسال پاسخ به تلگرام
+        await asyncio.sleep(reply_latency)
+        latencies.append((time.perf_counter() - started) * 1000)
+    
+    async def simulated_user(user_id: int):
+        for seq in range(updates):
+            await handle(user_id, seq)
+    
+    ticker = asyncio.create_task(loop_lag(lag))
+    started = time.perf_counter()
+    await asyncio.gather(*(simulated_user(user_id) for user_id in range(1, users + 1)))
+    elapsed = time.perf_counter() - started
+    ticker.cancel()
+    
+    return {
+        'mode': mode,
+        'updates_per_sec': users * updates / elapsed,
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99),
+        'loop_lag_p99_ms': percentile(lag, 99),
+        'loop_lag_max_ms': max(lag, default=0.0)
+    }
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'), log_archive_dir=os.path.join(tmp, 'archive'))
+        adb = AsyncDatabase(db)
+        db.executemany(
+            'INSERT INTO users (telegram_id, username, full_name) VALUES (?, ?, ?)',
+            [(user_id, f'user{user_id}', f'User {user_id}') for user_id in range(1, args.users + 1)]
+        )
+        
+        try:
+            for mode in ('sync', 'async'):
+                result = await run(
+                    mode, db, adb, args.users, args.updates,
+                    args.reply_latency, args.disk_latency_ms / 1000
+                )
+                print(
+                    f"{result['mode']:>5}: {result['updates_per_sec']:8.0f} updates/s | "
+                    f"latency p50 {result['p50_ms']:7.2f} ms p99 {result['p99_ms']:7.2f} ms | "
+                    f"loop lag p99 {result['loop_lag_p99_ms']:7.2f} ms max {result['loop_lag_max_ms']:7.2f} ms"
+                )
+        finally:
+            adb.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--users', type=int, default=200, help='تعداد کاربران هم‌زمان')
+    parser.add_argument('--updates', type=int, default=10, help='تعداد update هر کاربر')
+    parser.add_argument('--reply-latency', type=float, default=0.02, help='زمان پاسخ شبیه‌سازی شده تلگرام (ثانیه)')
+    parser.add_argument('--disk-latency-ms', type=float, default=2.0, help='تأخیر شبیه‌سازی شده هر کوئری (میلی‌ثانیه)')
+    asyncio.run(main(parser.parse_args()))
@@ -9,24 +9,41 @@ import asyncio
 import logging
 import json
 import sqlite3
+import base64
 import hashlib
+import hmac
+import ipaddress
+import secrets
 import time
+import random
+import queue
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, closing, contextmanager
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 import aiohttp
+from aiohttp import web
 import psutil
 import subprocess
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup,
-    ReplyKeyboardMarkup, KeyboardButton, BotCommand
+    ReplyKeyboardMarkup, KeyboardButton, BotCommand, InputMediaPhoto
 )
 from telegram.ext import (
-    Application, CommandHandler, CallbackQueryHandler,
+    Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler,
     MessageHandler, filters, ContextTypes, ConversationHandler
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 import os
+import signal
 from dataclasses import dataclass
+from advanced_features import (
+    AsyncScheduler, ChartRenderer, MetricsStore, NotificationBroadcaster, ScheduledTasks, sparkline
+)
 
 # تنظیمات اصلی
 logging.basicConfig(
@@ -50,6 +67,62 @@ class Config:
     ADMIN_USER_IDS: List[int] = None
     MAX_VMS_PER_USER: int = 5
     DEFAULT_VM_RESOURCES: Dict = None
+    DB_POOL_SIZE: int = 4
+    LOG_BATCH_SIZE: int = 100
+    LOG_FLUSH_INTERVAL: float = 2.0
+    LOG_MAX_PENDING: int = 10000
+    USER_CACHE_SIZE: int = 10000
+    USER_CACHE_TTL: float = 60.0
+    LOG_ARCHIVE_DIR: str = "log_archive"
+    LOG_HOT_DAYS: int = 30
+    API_CONNECTION_LIMIT: int = 100
+    API_LIMIT_PER_HOST: int = 20
+    API_KEEPALIVE_TIMEOUT: float = 30.0
+    API_DNS_CACHE_TTL: int = 300
+    API_TOTAL_TIMEOUT: float = 30.0
+    API_CONNECT_TIMEOUT: float = 5.0
+    API_READ_TIMEOUT: float = 15.0
+    API_VM_LIST_TTL: float = 10.0
+    API_VM_INFO_TTL: float = 5.0
+    API_MAX_RETRIES: int = 3
+    API_BACKOFF_BASE: float = 0.5
+    API_BACKOFF_MAX: float = 8.0
+    API_BREAKER_THRESHOLD: int = 5
+    API_BREAKER_RECOVERY: float = 30.0
+    SYSTEM_SAMPLE_INTERVAL: float = 5.0
+    METRICS_COLLECT_INTERVAL: float = 60.0
+    CHART_WORKERS: int = 2
+    CHART_CACHE_TTL: float = 30.0
+    RUN_MODE: str = "polling"  # polling یا webhook
+    HTTP_HOST: str = "0.0.0.0"
+    HTTP_PORT: int = 8000
+    WEBHOOK_URL: str = ""  # آدرس عمومی HTTPS، مثلاً https://bot.example.com
+    WEBHOOK_PATH: str = "/telegram"
+    WEBHOOK_SECRET: str = ""  # خالی = تولید تصادفی در هر اجرا
+    WEBHOOK_MAX_CONNECTIONS: int = 40
+    METRICS_TOKEN: str = ""  # خالی = /metrics فقط برای درخواست مستقیم از localhost
+    VM_LIST_PAGE_SIZE: int = 8
+    VM_LIST_SERVER_PAGING: bool = False  # True اگر API پارامترهای offset/limit/status را پشتیبانی کند
+    UPDATE_WORKERS: int = 32
+    UPDATE_MAX_PENDING: int = 1024
+    VM_OP_POLL_INITIAL: float = 1.0
+    VM_OP_POLL_MAX: float = 10.0
+    VM_OP_TIMEOUT: float = 180.0
+    BROADCAST_GLOBAL_RATE: float = 25.0
+    BROADCAST_PER_CHAT_RATE: float = 1.0
+    BROADCAST_CONCURRENCY: int = 10
+    BROADCAST_MAX_ATTEMPTS: int = 5
+    BROADCAST_FAILED_RETENTION_DAYS: float = 7
+    BACKUP_CONCURRENCY: int = 4
+    BACKUP_PER_HOST_CONCURRENCY: int = 2
+    BACKUP_WINDOW: float = 4 * 3600
+    BACKUP_MODE: str = "incremental"  # full یا incremental
+    BACKUP_FULL_EVERY: int = 7
+    BACKUP_MAX_AGE_DAYS: float = 7  # حداکثر فاصله بین دو بکاپ واقعی حتی بدون تغییر دیسک
+    BACKUP_STORE_DIR: str = "backup_store"  # خالی = بدون کپی محلی
+    BACKUP_CHUNK_SIZE: int = 4 * 1024 * 1024
+    BACKUP_RETENTION_TIERS: Dict = None
+    BACKUP_RETENTION_OVERRIDES: Dict = None
     
     def __post_init__(self):
         if self.ADMIN_USER_IDS is None:
@@ -61,19 +134,602 @@ class Config:
                 'disk': 10240,
                 'bandwidth': 1000
             }
+        if self.BACKUP_RETENTION_TIERS is None:
+            self.BACKUP_RETENTION_TIERS = {
+                'default': {'daily': 7, 'weekly': 4, 'monthly': 6},
+                'premium': {'daily': 14, 'weekly': 8, 'monthly': 12}
+            }
+        if self.BACKUP_RETENTION_OVERRIDES is None:
+            self.BACKUP_RETENTION_OVERRIDES = {}
 
 config = Config()
 
+_MISSING = object()
+
+class TTLCache:
+    """کش LRU با زمان انقضا و شمارنده‌های hit/miss"""
+    
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # {key: (expires_at, value)}
+        self._lock = threading.Lock()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @property
+    def version(self) -> int:
+        """با هر invalidate افزایش می‌یابد تا نوشتن‌های قدیمی رد شوند"""
+        return self._version
+    
+    def get(self, key, default=None):
+        """دریافت مقدار در صورت معتبر بودن"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return default
+            
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def get_stale(self, key, default=None):
+        """دریافت مقدار حتی اگر منقضی شده باشد (برای حالت خرابی upstream)"""
+        with self._lock:
+            entry = self._data.get(key)
+            return default if entry is None else entry[1]
+    
+    def set(self, key, value, ttl: Optional[float] = None, version: Optional[int] = None):
+        """ذخیره مقدار؛ اگر version قدیمی باشد نادیده گرفته می‌شود"""
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, key):
+        """حذف یک کلید"""
+        with self._lock:
+            self._version += 1
+            self._data.pop(key, None)
+    
+    def invalidate_where(self, predicate):
+        """حذف تمام کلیدهایی که شرط را برآورده می‌کنند"""
+        with self._lock:
+            self._version += 1
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+    
+    def clear(self):
+        """خالی کردن کش"""
+        with self._lock:
+            self._version += 1
+            self._data.clear()
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def stats(self) -> Dict[str, Any]:
+        """آمار کش"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / total, 3) if total else 0.0
+        }
+
+class ConnectionPool:
+    """استخر اتصال‌های ماندگار SQLite"""
+    
+    def __init__(self, db_path: str, size: int = 4, timeout: float = 30.0):
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        self._readers = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        self._writer = None
+        self._closed = False
+    
+    def _connect(self) -> sqlite3.Connection:
+        """ایجاد اتصال جدید با تنظیمات بهینه"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=256
+        )
+        conn.row_factory = sqlite3.Row
+        
+        # WAL اجازه می‌دهد خواندن‌ها هم‌زمان با نوشتن انجام شوند
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA cache_size=-16000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+        return conn
+    
+    @contextmanager
+    def reader(self):
+        """دریافت یک اتصال خواندنی از استخر"""
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+        
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            conn = self._connect() if can_create else self._readers.get(timeout=self.timeout)
+        
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+    
+    @contextmanager
+    def writer(self):
+        """دریافت تنها اتصال نوشتنی (یک تراکنش)"""
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+        
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            
+            try:
+                yield self._writer
+                self._writer.commit()
+            except Exception:
+                self._writer.rollback()
+                raise
+    
+    def close(self):
+        """بستن تمام اتصال‌ها"""
+        self._closed = True
+        
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+
+class ActivityLogBuffer:
+    """بافر حافظه‌ای لاگ فعالیت‌ها با نوشتن دسته‌ای در activity_logs"""
+    
+    def __init__(self, db: 'Database', batch_size: int = 100,
+                 flush_interval: float = 2.0, max_pending: int = 10000):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        
+        # متریک‌ها
+        self.enqueued = 0
+        self.flushed = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.overflows = 0
+        self.high_water = 0
+        self.last_flush_ms = 0.0
+        
+        self._thread = threading.Thread(target=self._run, name='activity-log-flusher', daemon=True)
+        self._thread.start()
+    
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+    
+    @property
+    def saturated(self) -> bool:
+        """آیا بافر از حد مجاز فراتر رفته است"""
+        return len(self._pending) >= self.max_pending
+    
+    def append(self, user_id: int, action: str, details: str = ""):
+        """افزودن یک رکورد به بافر (بدون دسترسی به دیسک)"""
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        
+        with self._cond:
+            self._pending.append((user_id, action, details, timestamp))
+            self.enqueued += 1
+            size = len(self._pending)
+            self.high_water = max(self.high_water, size)
+            
+            if size >= self.max_pending:
+                self.overflows += 1
+            if size >= self.batch_size:
+                self._cond.notify()
+    
+    def flush(self) -> int:
+        """نوشتن تمام رکوردهای بافر در یک تراکنش"""
+        with self._flush_lock:
+            with self._cond:
+                batch = list(self._pending)
+                self._pending.clear()
+            
+            if not batch:
+                return 0
+            
+            started = time.perf_counter()
+            try:
+                self.db.executemany('''
+                    INSERT INTO activity_logs (user_id, action, details, timestamp)
+                    VALUES (?, ?, ?, ?)
+                ''', batch)
+            except Exception as e:
+                # برگرداندن رکوردها به ابتدای صف برای تلاش بعدی
+                with self._cond:
+                    self._pending.extendleft(reversed(batch))
+                self.failed_batches += 1
+                logger.error(f"Activity log flush failed ({len(batch)} rows): {e}")
+                return 0
+            
+            self.last_flush_ms = (time.perf_counter() - started) * 1000
+            self.flushed += len(batch)
+            self.batches += 1
+            return len(batch)
+    
+    def _run(self):
+        """thread پس‌زمینه برای flush بر اساس اندازه یا زمان"""
+        while True:
+            with self._cond:
+                if not self._closed and len(self._pending) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                closed = self._closed
+            
+            self.flush()
+            
+            if closed:
+                return
+    
+    def close(self):
+        """توقف thread و flush نهایی"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=10)
+        self.flush()
+    
+    def stats(self) -> Dict[str, Any]:
+        """متریک‌های بافر و فشار برگشتی"""
+        return {
+            'pending': self.pending,
+            'high_water': self.high_water,
+            'saturated': self.saturated,
+            'enqueued': self.enqueued,
+            'flushed': self.flushed,
+            'batches': self.batches,
+            'failed_batches': self.failed_batches,
+            'overflows': self.overflows,
+            'last_flush_ms': round(self.last_flush_ms, 2)
+        }
+
+class ActivityLogArchive:
+    """بایگانی ماهانه لاگ‌های قدیمی در دیتابیس‌های جداگانه"""
+    
+    TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+    
+    def __init__(self, db: 'Database', archive_dir: str = "log_archive", hot_days: int = 30):
+        self.db = db
+        self.archive_dir = archive_dir
+        self.hot_days = hot_days
+    
+    def archive_path(self, month: str) -> str:
+        """مسیر فایل بایگانی یک ماه (month به شکل YYYY_MM)"""
+        return os.path.join(self.archive_dir, f"activity_logs_{month}.db")
+    
+    def hot_cutoff(self) -> str:
+        """مرز بین لاگ‌های جدول اصلی و بایگانی (UTC)"""
+        cutoff = datetime.utcnow() - timedelta(days=self.hot_days)
+        return cutoff.strftime(self.TIMESTAMP_FORMAT)
+    
+    @staticmethod
+    def _month_range(month: str):
+        """شروع ماه و شروع ماه بعد به صورت رشته"""
+        year, mon = (int(part) for part in month.split('_'))
+        start = datetime(year, mon, 1)
+        end = datetime(year + (mon == 12), mon % 12 + 1, 1)
+        return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+    
+    def archive_old_logs(self) -> int:
+        """انتقال لاگ‌های قدیمی‌تر از hot_days به فایل‌های ماهانه"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        self.db.flush_logs()
+        cutoff = self.hot_cutoff()
+        
+        months = [
+            row[0] for row in self.db.fetchall(
+                "SELECT DISTINCT strftime('%Y_%m', timestamp) FROM activity_logs WHERE timestamp < ?",
+                (cutoff,)
+            )
+            if row[0]
+        ]
+        
+        moved = 0
+        with self.db.transaction() as conn:
+            conn.commit()
+            for month in months:
+                start, end = self._month_range(month)
+                end = min(end, cutoff)
+                
+                # ATTACH خارج از تراکنش مجاز است
+                conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path(month),))
+                try:
+                    conn.execute('''
+                        CREATE TABLE IF NOT EXISTS archive.activity_logs (
+                            id INTEGER PRIMARY KEY,
+                            user_id INTEGER,
+                            action TEXT,
+                            details TEXT,
+                            timestamp TIMESTAMP
+                        )
+                    ''')
+                    conn.execute(
+                        'CREATE INDEX IF NOT EXISTS archive.idx_archive_timestamp '
+                        'ON activity_logs (timestamp)'
+                    )
+                    conn.execute('BEGIN')
+                    conn.execute('''
+                        INSERT OR IGNORE INTO archive.activity_logs
+                        SELECT id, user_id, action, details, timestamp
+                        FROM main.activity_logs
+                        WHERE timestamp >= ? AND timestamp < ?
+                    ''', (start, end))
+                    moved += conn.execute(
+                        'DELETE FROM main.activity_logs WHERE timestamp >= ? AND timestamp < ?',
+                        (start, end)
+                    ).rowcount
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    conn.execute('DETACH DATABASE archive')
+            
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        
+        if moved:
+            logger.info(f"Archived {moved} activity log rows into {len(months)} monthly files")
+        return moved
+    
+    def _archived_months(self, since: str, until: str) -> List[str]:
+        """ماه‌های بایگانی‌شده‌ای که با بازه زمانی هم‌پوشانی دارند"""
+        months = []
+        year, mon = int(since[:4]), int(since[5:7])
+        while f"{year:04d}-{mon:02d}" <= until[:7]:
+            month = f"{year:04d}_{mon:02d}"
+            if os.path.exists(self.archive_path(month)):
+                months.append(month)
+            year, mon = year + (mon == 12), mon % 12 + 1
+        return months
+    
+    def query(self, since: datetime, until: Optional[datetime] = None,
+              user_id: Optional[int] = None, limit: int = 50) -> List[Dict]:
+        """جستجوی لاگ‌ها در جدول اصلی و در صورت نیاز بایگانی‌ها"""
+        since_ts = since.strftime(self.TIMESTAMP_FORMAT)
+        until_ts = (until or datetime.utcnow() + timedelta(minutes=1)).strftime(self.TIMESTAMP_FORMAT)
+        
+        where = 'timestamp >= ? AND timestamp < ?'
+        params = [since_ts, until_ts]
+        if user_id is not None:
+            where += ' AND user_id = ?'
+            params.append(user_id)
+        sql = f'SELECT * FROM activity_logs WHERE {where} ORDER BY timestamp DESC LIMIT ?'
+        params.append(limit)
+        
+        rows = [dict(row) for row in self.db.fetchall(sql, tuple(params))]
+        
+        # فقط وقتی بازه از مرز جدول اصلی عقب‌تر است سراغ بایگانی برو
+        if len(rows) < limit and since_ts < self.hot_cutoff():
+            for month in reversed(self._archived_months(since_ts, until_ts)):
+                uri = f"file:{self.archive_path(month)}?mode=ro"
+                # with روی خود اتصال فقط commit/rollback می‌کند و آن را نمی‌بندد
+                with closing(sqlite3.connect(uri, uri=True)) as conn:
+                    conn.row_factory = sqlite3.Row
+                    rows.extend(dict(row) for row in conn.execute(sql, tuple(params)))
+                if len(rows) >= limit:
+                    break
+        
+        rows.sort(key=lambda row: row['timestamp'], reverse=True)
+        return rows[:limit]
+
 class Database:
     """مدیریت دیتابیس"""
     
-    def __init__(self, db_path: str):
+    # مهاجرت‌های نسخه‌دار اسکیما: (نسخه، توضیح، دستورات)
+    MIGRATIONS = [
+        (1, "indexes for reporting and cleanup queries", [
+            'CREATE INDEX IF NOT EXISTS idx_activity_logs_timestamp_user ON activity_logs (timestamp, user_id)',
+            'CREATE INDEX IF NOT EXISTS idx_activity_logs_user_timestamp ON activity_logs (user_id, timestamp)',
+            'CREATE INDEX IF NOT EXISTS idx_backups_created_at ON backups (created_at)',
+            'CREATE INDEX IF NOT EXISTS idx_backups_vm_created ON backups (vm_id, created_at)',
+            'CREATE INDEX IF NOT EXISTS idx_vms_user_status ON virtual_machines (user_id, status)',
+            'CREATE INDEX IF NOT EXISTS idx_vms_created_at ON virtual_machines (created_at)',
+        ]),
+        (2, "metrics rollup table", [
+            '''
+            CREATE TABLE IF NOT EXISTS metrics_rollup (
+                resolution INTEGER NOT NULL,
+                series TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                avg REAL,
+                min REAL,
+                max REAL,
+                count INTEGER,
+                PRIMARY KEY (resolution, series, bucket)
+            ) WITHOUT ROWID
+            ''',
+        ]),
+        (3, "persistent notification outbox", [
+            '''
+            CREATE TABLE IF NOT EXISTS notification_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                parse_mode TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_outbox_pending ON notification_outbox (status, next_attempt_at)',
+        ]),
+        (4, "scheduler job state", [
+            '''
+            CREATE TABLE IF NOT EXISTS scheduler_state (
+                job TEXT PRIMARY KEY,
+                last_run REAL,
+                last_status TEXT,
+                last_duration REAL,
+                runs INTEGER NOT NULL DEFAULT 0,
+                failures INTEGER NOT NULL DEFAULT 0
+            )
+            ''',
+        ]),
+        (5, "backup durations", [
+            'ALTER TABLE backups ADD COLUMN duration REAL',
+        ]),
+        (6, "incremental backup chains", [
+            "ALTER TABLE backups ADD COLUMN backup_type TEXT NOT NULL DEFAULT 'full'",
+            'ALTER TABLE backups ADD COLUMN parent_id INTEGER REFERENCES backups (id)',
+            'ALTER TABLE backups ADD COLUMN chain_id INTEGER',
+            'ALTER TABLE backups ADD COLUMN fingerprint TEXT',
+            'UPDATE backups SET chain_id = id WHERE chain_id IS NULL',
+            'CREATE INDEX IF NOT EXISTS idx_backups_chain ON backups (chain_id, id)',
+            'CREATE INDEX IF NOT EXISTS idx_backups_parent ON backups (parent_id)',
+        ]),
+        (7, "content-addressed backup store", [
+            'ALTER TABLE backups ADD COLUMN checksum TEXT',
+            '''
+            CREATE TABLE IF NOT EXISTS backup_chunks (
+                hash TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                refcount INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            ) WITHOUT ROWID
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS chunk_refs (
+                backup_id INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                PRIMARY KEY (backup_id, seq)
+            ) WITHOUT ROWID
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_chunk_refs_hash ON chunk_refs (hash)',
+        ]),
+        (8, "per-user backup retention tier", [
+            'ALTER TABLE users ADD COLUMN retention_tier TEXT',
+        ]),
+        (9, "callback data tokens for long arguments", [
+            '''
+            CREATE TABLE IF NOT EXISTS callback_tokens (
+                token TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            ) WITHOUT ROWID
+            ''',
+        ]),
+        (10, "backups still running on the Virtualizer after a client-side timeout", [
+            '''
+            CREATE TABLE IF NOT EXISTS pending_backups (
+                backup_name TEXT PRIMARY KEY,
+                vm_id TEXT NOT NULL,
+                backup_type TEXT NOT NULL,
+                parent_id INTEGER,
+                chain_id INTEGER,
+                fingerprint TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''',
+        ]),
+    ]
+    
+    # ستون‌هایی که ادمین می‌تواند ویرایش کند
+    EDITABLE_USER_FIELDS = ('username', 'full_name', 'is_admin', 'is_active', 'max_vms', 'retention_tier')
+    
+    def __init__(self, db_path: str, pool_size: int = 4, log_batch_size: int = 100,
+                 log_flush_interval: float = 2.0, log_max_pending: int = 10000,
+                 user_cache_size: int = 10000, user_cache_ttl: float = 60.0,
+                 log_archive_dir: str = "log_archive", log_hot_days: int = 30):
         self.db_path = db_path
+        self.pool = ConnectionPool(db_path, size=pool_size)
+        self.user_cache = TTLCache(maxsize=user_cache_size, ttl=user_cache_ttl)
+        self.log_archive = ActivityLogArchive(self, archive_dir=log_archive_dir, hot_days=log_hot_days)
         self.init_db()
+        self.log_buffer = ActivityLogBuffer(
+            self,
+            batch_size=log_batch_size,
+            flush_interval=log_flush_interval,
+            max_pending=log_max_pending
+        )
+    
+    def connection(self):
+        """اتصال فقط‌خواندنی از استخر"""
+        return self.pool.reader()
+    
+    def transaction(self):
+        """اتصال نوشتنی؛ در پایان commit می‌شود"""
+        return self.pool.writer()
+    
+    def fetchone(self, query: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+        """اجرای کوئری و دریافت یک سطر"""
+        with self.connection() as conn:
+            return conn.execute(query, params).fetchone()
+    
+    def fetchall(self, query: str, params: tuple = ()) -> List[sqlite3.Row]:
+        """اجرای کوئری و دریافت تمام سطرها"""
+        with self.connection() as conn:
+            return conn.execute(query, params).fetchall()
+    
+    def execute(self, query: str, params: tuple = ()) -> int:
+        """اجرای یک دستور نوشتنی و برگرداندن شناسه آخرین سطر"""
+        with self.transaction() as conn:
+            return conn.execute(query, params).lastrowid
+    
+    def executemany(self, query: str, seq_of_params) -> int:
+        """اجرای دسته‌ای یک دستور در یک تراکنش"""
+        with self.transaction() as conn:
+            return conn.executemany(query, seq_of_params).rowcount
+    
+    def flush_logs(self) -> int:
+        """نوشتن فوری لاگ‌های بافر شده"""
+        return self.log_buffer.flush()
+    
+    def close(self):
+        """flush لاگ‌ها و بستن اتصال‌های دیتابیس"""
+        self.log_buffer.close()
+        self.pool.close()
     
     def init_db(self):
         """ایجاد جداول پایه"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             
             # جدول کاربران
@@ -131,134 +787,1376 @@ class Database:
                 )
             ''')
             
+            self._migrate(conn)
+    
+    def _migrate(self, conn: sqlite3.Connection):
+        """اجرای مهاجرت‌های اعمال‌نشده بر اساس PRAGMA user_version"""
+        conn.commit()
+        current = conn.execute('PRAGMA user_version').fetchone()[0]
+        
+        for version, description, statements in self.MIGRATIONS:
+            if version <= current:
+                continue
+            
+            conn.execute('BEGIN')
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {version}')
             conn.commit()
+            logger.info(f"Applied schema migration {version}: {description}")
+    
+    def explain(self, query: str, params: tuple = ()) -> List[str]:
+        """نمایش طرح اجرای کوئری (برای بررسی استفاده از ایندکس‌ها)"""
+        rows = self.fetchall(f'EXPLAIN QUERY PLAN {query}', params)
+        return [row['detail'] for row in rows]
     
     def add_user(self, telegram_id: int, username: str, full_name: str, is_admin: bool = False):
         """افزودن کاربر جدید"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO users 
-                (telegram_id, username, full_name, is_admin, last_activity)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (telegram_id, username, full_name, is_admin, datetime.now()))
-            conn.commit()
+        self.execute('''
+            INSERT OR REPLACE INTO users 
+            (telegram_id, username, full_name, is_admin, last_activity)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (telegram_id, username, full_name, is_admin, datetime.now()))
+        self.user_cache.invalidate(telegram_id)
+    
+    def update_user(self, telegram_id: int, **fields):
+        """ویرایش اطلاعات کاربر توسط ادمین"""
+        unknown = set(fields) - set(self.EDITABLE_USER_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown user fields: {', '.join(sorted(unknown))}")
+        if not fields:
+            return
+        
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        self.execute(
+            f'UPDATE users SET {assignments} WHERE telegram_id = ?',
+            (*fields.values(), telegram_id)
+        )
+        self.user_cache.invalidate(telegram_id)
+    
+    def get_cached_user(self, telegram_id: int):
+        """دریافت کاربر فقط از کش (_MISSING در صورت نبود)"""
+        return self.user_cache.get(telegram_id, _MISSING)
     
     def get_user(self, telegram_id: int) -> Optional[Dict]:
         """دریافت اطلاعات کاربر"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
-            row = cursor.fetchone()
-            return dict(row) if row else None
+        user = self.user_cache.get(telegram_id, _MISSING)
+        if user is not _MISSING:
+            return user
+        
+        version = self.user_cache.version
+        row = self.fetchone('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
+        user = dict(row) if row else None
+        # کاربران ناشناس هم کش می‌شوند تا پیام‌های مکرر به دیسک نرسند
+        self.user_cache.set(telegram_id, user, version=version)
+        return user
     
     def log_activity(self, user_id: int, action: str, details: str = ""):
+        """ثبت فعالیت کاربر (بافر شده، در دسته‌ها نوشته می‌شود)"""
+        self.log_buffer.append(user_id, action, details)
+
+class AsyncDatabase:
+    """رابط غیرهمزمان دیتابیس که کوئری‌ها را خارج از event loop اجرا می‌کند"""
+    
+    def __init__(self, db: Database, read_workers: int = 4):
+        self.db = db
+        self._reader = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix='db-read')
+        # یک thread نوشتنی تا نوشتن‌ها پشت قفل SQLite صف نکشند
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+    
+    async def run_read(self, func, *args, **kwargs):
+        """اجرای یک تابع خواندنی در thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._reader, functools.partial(func, *args, **kwargs))
+    
+    async def run_write(self, func, *args, **kwargs):
+        """اجرای یک تابع نوشتنی در thread نویسنده"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, functools.partial(func, *args, **kwargs))
+    
+    async def get_user(self, telegram_id: int) -> Optional[Dict]:
+        """دریافت اطلاعات کاربر (در صورت hit بدون رفتن به thread)"""
+        user = self.db.get_cached_user(telegram_id)
+        if user is not _MISSING:
+            return user
+        return await self.run_read(self.db.get_user, telegram_id)
+    
+    async def add_user(self, telegram_id: int, username: str, full_name: str, is_admin: bool = False):
+        """افزودن کاربر جدید"""
+        await self.run_write(self.db.add_user, telegram_id, username, full_name, is_admin)
+    
+    async def update_user(self, telegram_id: int, **fields):
+        """ویرایش اطلاعات کاربر"""
+        await self.run_write(self.db.update_user, telegram_id, **fields)
+    
+    async def log_activity(self, user_id: int, action: str, details: str = ""):
         """ثبت فعالیت کاربر"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO activity_logs (user_id, action, details)
-                VALUES (?, ?, ?)
-            ''', (user_id, action, details))
-            conn.commit()
+        self.db.log_activity(user_id, action, details)
+        
+        # فشار برگشتی: اگر بافر پر است، تا flush صبر کن
+        if self.db.log_buffer.saturated:
+            await self.run_write(self.db.flush_logs)
+    
+    async def fetchone(self, query: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+        """اجرای کوئری و دریافت یک سطر"""
+        return await self.run_read(self.db.fetchone, query, params)
+    
+    async def fetchall(self, query: str, params: tuple = ()) -> List[sqlite3.Row]:
+        """اجرای کوئری و دریافت تمام سطرها"""
+        return await self.run_read(self.db.fetchall, query, params)
+    
+    async def execute(self, query: str, params: tuple = ()) -> int:
+        """اجرای یک دستور نوشتنی"""
+        return await self.run_write(self.db.execute, query, params)
+    
+    async def executemany(self, query: str, seq_of_params) -> int:
+        """اجرای دسته‌ای یک دستور نوشتنی"""
+        return await self.run_write(self.db.executemany, query, list(seq_of_params))
+    
+    def close(self):
+        """منتظر ماندن برای کارهای در صف و بستن دیتابیس"""
+        self._reader.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        self.db.close()
+
+class VirtualizerAPIError(Exception):
+    """خطای پایه API ویرچوالایزور"""
+    retryable = False
+
+class VirtualizerHTTPError(VirtualizerAPIError):
+    """پاسخ غیر 200 از API"""
+    
+    def __init__(self, status: int, body: str):
+        super().__init__(f"API Error: {status} - {body}")
+        self.status = status
+        self.body = body
+    
+    @property
+    def retryable(self) -> bool:
+        return self.status >= 500 or self.status == 429
+
+class VirtualizerConnectionError(VirtualizerAPIError):
+    """خطای شبکه یا timeout در اتصال به API"""
+    retryable = True
+
+class CircuitOpenError(VirtualizerAPIError):
+    """مدار باز است و درخواست بدون ارسال رد شد"""
+    retryable = True
+
+class CircuitBreaker:
+    """قطع‌کننده مدار برای جلوگیری از فشار روی backend خراب"""
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+    
+    def allow_request(self) -> bool:
+        """آیا درخواست جدید مجاز است"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                self.rejected += 1
+                return False
+            self.state = self.HALF_OPEN
+        
+        if self.state == self.HALF_OPEN:
+            # در حالت نیمه‌باز فقط یک درخواست آزمایشی
+            if self._probe_in_flight:
+                self.rejected += 1
+                return False
+            self._probe_in_flight = True
+        
+        return True
+    
+    def record_success(self):
+        """ثبت موفقیت و بستن مدار"""
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+    
+    def record_failure(self):
+        """ثبت خطا و باز کردن مدار در صورت رسیدن به آستانه"""
+        self.failures += 1
+        self._probe_in_flight = False
+        
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.times_opened += 1
+                logger.warning(f"Virtualizer circuit opened after {self.failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+    
+    def release(self):
+        """آزاد کردن درخواست آزمایشی لغو شده"""
+        self._probe_in_flight = False
+    
+    def stats(self) -> Dict[str, Any]:
+        """وضعیت مدار"""
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'times_opened': self.times_opened,
+            'rejected': self.rejected
+        }
+
+class LatencyHistogram:
+    """هیستوگرام تأخیر با باکت‌های ثابت (میلی‌ثانیه)"""
+    
+    BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+    
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS_MS)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.errors = 0
+    
+    def observe(self, seconds: float, error: bool = False):
+        """ثبت یک اندازه‌گیری"""
+        ms = seconds * 1000
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        if error:
+            self.errors += 1
+        
+        for i, bound in enumerate(self.BUCKETS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+    
+    def percentile(self, p: float) -> float:
+        """تخمین صدک از روی باکت‌ها (کران بالای باکت)"""
+        if not self.count:
+            return 0.0
+        
+        target = self.count * p / 100
+        seen = 0
+        for bound, count in zip(self.BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= target:
+                return round(min(bound, self.max_ms), 2)
+        return self.max_ms
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """خلاصه هیستوگرام"""
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'avg_ms': round(self.total_ms / self.count, 2) if self.count else 0.0,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'max_ms': round(self.max_ms, 2),
+            'buckets': dict(zip((str(b) for b in self.BUCKETS_MS), self.counts))
+        }
 
 class VirtualizerAPI:
     """کلاس برای ارتباط با API ویرچوالایزور"""
     
-    def __init__(self, api_url: str, api_key: str):
+    # بخش‌هایی از مسیر که بعدشان شناسه می‌آید (برای گروه‌بندی متریک‌ها)
+    ID_SEGMENTS = ('vms', 'backups', 'jobs')
+    
+    def __init__(self, api_url: str, api_key: str, connection_limit: int = 100,
+                 limit_per_host: int = 20, keepalive_timeout: float = 30.0,
+                 dns_cache_ttl: int = 300, total_timeout: float = 30.0,
+                 connect_timeout: float = 5.0, read_timeout: float = 15.0,
+                 vm_list_ttl: float = 10.0, vm_info_ttl: float = 5.0, cache_size: int = 4096,
+                 max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 breaker_threshold: int = 5, breaker_recovery: float = 30.0):
         self.api_url = api_url.rstrip('/')
         self.api_key = api_key
         self.session = None
+        self.connection_limit = connection_limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout,
+            connect=connect_timeout,
+            sock_read=read_timeout
+        )
+        self.latency: Dict[str, LatencyHistogram] = {}
+        
+        # کش خواندنی VM ها: ('vms', user_id) و ('vm', vm_id)
+        self.cache = TTLCache(maxsize=cache_size, ttl=vm_list_ttl)
+        self.vm_list_ttl = vm_list_ttl
+        self.vm_info_ttl = vm_info_ttl
+        
+        # درخواست‌های GET در جریان برای single-flight
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self.singleflight_leaders = 0
+        self.singleflight_coalesced = 0
+        
+        # تلاش مجدد و قطع‌کننده مدار
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_recovery)
+        self.retries = 0
+        self.stale_served = 0
     
     async def init_session(self):
-        """ایجاد session HTTP"""
+        """ایجاد session HTTP با connector قابل تنظیم"""
         if not self.session:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+                use_dns_cache=True
+            )
             self.session = aiohttp.ClientSession(
-                headers={'Authorization': f'Bearer {self.api_key}'}
+                headers={'Authorization': f'Bearer {self.api_key}'},
+                connector=connector,
+                timeout=self.timeout
             )
     
     async def close_session(self):
         """بستن session"""
         if self.session:
             await self.session.close()
+            self.session = None
+    
+    def _endpoint_key(self, method: str, endpoint: str) -> str:
+        """کلید متریک: مسیر بدون query string و با {id} به جای شناسه‌ها"""
+        segments = endpoint.split('?', 1)[0].strip('/').split('/')
+        for i in range(1, len(segments)):
+            if segments[i - 1] in self.ID_SEGMENTS:
+                segments[i] = '{id}'
+        return f"{method} /{'/'.join(segments)}"
     
     async def _make_request(self, method: str, endpoint: str, **kwargs) -> Dict:
-        """ارسال درخواست به API"""
-        await self.init_session()
+        """ارسال درخواست به API (GET های هم‌زمان یکسان یک درخواست مشترک دارند)"""
+        if self.session is None:
+            raise RuntimeError("VirtualizerAPI session is not initialised; call init_session() on startup")
         
+        if method != 'GET':
+            if not self.breaker.allow_request():
+                raise CircuitOpenError("Virtualizer API circuit is open")
+            return await self._send_with_retry(method, endpoint, retries=0, **kwargs)
+        
+        key = (endpoint, repr(sorted(kwargs.items())))
+        task = self._inflight.get(key)
+        
+        if task is None:
+            if not self.breaker.allow_request():
+                raise CircuitOpenError("Virtualizer API circuit is open")
+            
+            task = asyncio.ensure_future(
+                self._send_with_retry(method, endpoint, retries=self.max_retries, **kwargs)
+            )
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            self.singleflight_leaders += 1
+        else:
+            self.singleflight_coalesced += 1
+        
+        # shield تا لغو شدن یک منتظر، درخواست مشترک بقیه را لغو نکند
+        return await asyncio.shield(task)
+    
+    async def _send_with_retry(self, method: str, endpoint: str, retries: int, **kwargs) -> Dict:
+        """ارسال با backoff نمایی تصادفی و به‌روزرسانی وضعیت مدار"""
+        attempt = 0
+        
+        while True:
+            try:
+                result = await self._send(method, endpoint, **kwargs)
+                self.breaker.record_success()
+                return result
+            
+            except VirtualizerAPIError as e:
+                if not e.retryable:
+                    # خطای 4xx یعنی backend پاسخ داده است
+                    self.breaker.record_success()
+                    raise
+                
+                if attempt >= retries:
+                    self.breaker.record_failure()
+                    raise
+                
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                attempt += 1
+                self.retries += 1
+                logger.warning(f"Retrying {method} {endpoint} in {delay:.2f}s (attempt {attempt}): {e}")
+                await asyncio.sleep(delay)
+            
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+    
+    async def _send(self, method: str, endpoint: str, **kwargs) -> Dict:
+        """ارسال واقعی درخواست HTTP و ثبت تأخیر"""
         url = f"{self.api_url}/{endpoint.lstrip('/')}"
+        histogram = self.latency.setdefault(self._endpoint_key(method, endpoint), LatencyHistogram())
+        started = time.perf_counter()
+        failed = True
         
         try:
             async with self.session.request(method, url, **kwargs) as response:
                 if response.status == 200:
-                    return await response.json()
+                    result = await response.json()
+                    failed = False
+                    return result
                 else:
                     error_text = await response.text()
-                    raise Exception(f"API Error: {response.status} - {error_text}")
+                    raise VirtualizerHTTPError(response.status, error_text)
         
-        except Exception as e:
+        except VirtualizerAPIError as e:
             logger.error(f"API Request Error: {e}")
             raise
+        
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"API Request Error: {method} {endpoint}: {e!r}")
+            raise VirtualizerConnectionError(f"API connection error: {e!r}") from e
+        
+        finally:
+            histogram.observe(time.perf_counter() - started, error=failed)
+    
+    @asynccontextmanager
+    async def _transfer(self, method: str, endpoint: str, **kwargs):
+        """درخواست انتقال فایل: بدون سقف زمان کل، فقط timeout اتصال و مکث خواندن"""
+        if self.session is None:
+            raise RuntimeError("VirtualizerAPI session is not initialised; call init_session() on startup")
+        if not self.breaker.allow_request():
+            raise CircuitOpenError("Virtualizer API circuit is open")
+        
+        url = f"{self.api_url}/{endpoint.lstrip('/')}"
+        timeout = aiohttp.ClientTimeout(total=None, connect=self.timeout.connect, sock_read=self.timeout.sock_read)
+        
+        try:
+            async with self.session.request(method, url, timeout=timeout, **kwargs) as response:
+                if response.status != 200:
+                    raise VirtualizerHTTPError(response.status, await response.text())
+                yield response
+            self.breaker.record_success()
+        
+        except VirtualizerAPIError as e:
+            if e.retryable:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            logger.error(f"API Transfer Error: {e}")
+            raise
+        
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.breaker.record_failure()
+            logger.error(f"API Transfer Error: {method} {endpoint}: {e!r}")
+            raise VirtualizerConnectionError(f"API connection error: {e!r}") from e
+        
+        except BaseException:
+            self.breaker.release()
+            raise
+    
+    async def download_backup(self, vm_id: str, backup_name: str, chunk_size: int = 1024 * 1024):
+        """دریافت جریانی فایل بکاپ (بدون نگه‌داشتن کل فایل در حافظه)"""
+        async with self._transfer('GET', f'/vms/{vm_id}/backups/{backup_name}/download') as response:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
+    
+    async def upload_backup(self, vm_id: str, backup_name: str, stream) -> Dict:
+        """ارسال جریانی فایل بکاپ به Virtualizer"""
+        async with self._transfer(
+            'PUT', f'/vms/{vm_id}/backups/{backup_name}/upload',
+            data=stream, headers={'Content-Type': 'application/octet-stream'}
+        ) as response:
+            return await response.json()
+    
+    async def _cached_get(self, key: tuple, endpoint: str, ttl: float, use_cache: bool):
+        """GET با کش؛ در صورت خرابی موقت upstream داده قدیمی برگردانده می‌شود"""
+        if use_cache:
+            cached = self.cache.get(key, _MISSING)
+            if cached is not _MISSING:
+                return cached
+        
+        version = self.cache.version
+        try:
+            result = await self._make_request('GET', endpoint)
+        except VirtualizerAPIError as e:
+            stale = self.cache.get_stale(key, _MISSING) if e.retryable else _MISSING
+            if stale is _MISSING:
+                raise
+            self.stale_served += 1
+            logger.warning(f"Serving stale data for {key}: {e}")
+            return stale
+        
+        self.cache.set(key, result, ttl=ttl, version=version)
+        return result
+    
+    def invalidate_vm(self, vm_id: Optional[str] = None):
+        """حذف اطلاعات کش شده یک VM و تمام لیست‌ها"""
+        if vm_id is not None:
+            self.cache.invalidate(('vm', vm_id))
+        self.cache.invalidate_where(lambda key: key[0] == 'vms')
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """متریک‌های تأخیر هر endpoint و کش"""
+        return {
+            'latency': {key: hist.snapshot() for key, hist in self.latency.items()},
+            'cache': self.cache.stats(),
+            'singleflight': {
+                'requests': self.singleflight_leaders,
+                'coalesced': self.singleflight_coalesced,
+                'inflight': len(self._inflight)
+            },
+            'breaker': self.breaker.stats(),
+            'retries': self.retries,
+            'stale_served': self.stale_served
+        }
     
     async def get_server_stats(self) -> Dict:
         """دریافت آمار سرور"""
         return await self._make_request('GET', '/server/stats')
     
-    async def list_vms(self, user_id: Optional[int] = None) -> List[Dict]:
+    async def list_vms(self, user_id: Optional[int] = None, use_cache: bool = True) -> List[Dict]:
         """لیست ماشین‌های مجازی"""
         endpoint = f'/vms?user_id={user_id}' if user_id else '/vms'
-        return await self._make_request('GET', endpoint)
+        return await self._cached_get(('vms', user_id), endpoint, self.vm_list_ttl, use_cache)
     
     async def create_vm(self, vm_config: Dict) -> Dict:
         """ایجاد ماشین مجازی جدید"""
-        return await self._make_request('POST', '/vms', json=vm_config)
+        result = await self._make_request('POST', '/vms', json=vm_config)
+        self.invalidate_vm()
+        return result
+    
+    async def list_vms_page(self, user_id: Optional[int] = None, status: Optional[str] = None,
+                            offset: int = 0, limit: int = 10) -> Dict:
+        """یک صفحه از لیست VM ها با برش سمت سرور: {'items': [...], 'total': n}"""
+        params = {'offset': offset, 'limit': limit}
+        if user_id:
+            params['user_id'] = user_id
+        if status:
+            params['status'] = status
+        query = '&'.join(f'{key}={value}' for key, value in params.items())
+        return await self._cached_get(
+            ('vms', user_id, status, offset, limit), f'/vms?{query}', self.vm_list_ttl, True
+        )
     
-    async def get_vm_info(self, vm_id: str) -> Dict:
+    async def get_vm_info(self, vm_id: str, use_cache: bool = True) -> Dict:
         """دریافت اطلاعات ماشین مجازی"""
-        return await self._make_request('GET', f'/vms/{vm_id}')
+        return await self._cached_get(('vm', vm_id), f'/vms/{vm_id}', self.vm_info_ttl, use_cache)
     
     async def start_vm(self, vm_id: str) -> Dict:
         """روشن کردن ماشین مجازی"""
-        return await self._make_request('POST', f'/vms/{vm_id}/start')
+        result = await self._make_request('POST', f'/vms/{vm_id}/start')
+        self.invalidate_vm(vm_id)
+        return result
     
     async def stop_vm(self, vm_id: str) -> Dict:
         """خاموش کردن ماشین مجازی"""
-        return await self._make_request('POST', f'/vms/{vm_id}/stop')
+        result = await self._make_request('POST', f'/vms/{vm_id}/stop')
+        self.invalidate_vm(vm_id)
+        return result
     
     async def restart_vm(self, vm_id: str) -> Dict:
         """راه‌اندازی مجدد ماشین مجازی"""
-        return await self._make_request('POST', f'/vms/{vm_id}/restart')
+        result = await self._make_request('POST', f'/vms/{vm_id}/restart')
+        self.invalidate_vm(vm_id)
+        return result
     
     async def delete_vm(self, vm_id: str) -> Dict:
         """حذف ماشین مجازی"""
-        return await self._make_request('DELETE', f'/vms/{vm_id}')
+        result = await self._make_request('DELETE', f'/vms/{vm_id}')
+        self.invalidate_vm(vm_id)
+        return result
     
-    async def create_backup(self, vm_id: str, backup_name: str) -> Dict:
-        """ایجاد بکاپ"""
+    async def create_backup(self, vm_id: str, backup_name: str, parent: Optional[str] = None) -> Dict:
+        """ایجاد بکاپ (با parent به صورت incremental)"""
         data = {'backup_name': backup_name}
-        return await self._make_request('POST', f'/vms/{vm_id}/backup', json=data)
+        if parent:
+            data.update(type='incremental', parent=parent)
+        # نام بکاپ کلید idempotency است تا تکرار همین درخواست بکاپ دوم نسازد
+        return await self._make_request(
+            'POST', f'/vms/{vm_id}/backup', json=data, headers={'Idempotency-Key': backup_name}
+        )
+    
+    async def get_backup(self, vm_id: str, backup_name: str) -> Dict:
+        """وضعیت یک بکاپ با نام آن"""
+        return await self._make_request('GET', f'/vms/{vm_id}/backups/{backup_name}')
+    
+    async def get_changed_blocks(self, vm_id: str, since_backup: str) -> Dict:
+        """بلاک‌های تغییر یافته دیسک از زمان یک بکاپ (در صورت پشتیبانی Virtualizer)"""
+        return await self._make_request('GET', f'/vms/{vm_id}/changed-blocks?since={since_backup}')
     
-    async def restore_backup(self, vm_id: str, backup_id: str) -> Dict:
-        """بازیابی از بکاپ"""
+    async def get_job(self, job_id: str) -> Dict:
+        """وضعیت یک job غیرهم‌زمان Virtualizer"""
+        return await self._make_request('GET', f'/jobs/{job_id}')
+    
+    async def restore_backup(self, vm_id: str, backup_id: str, chain: Optional[List[str]] = None) -> Dict:
+        """بازیابی از بکاپ (chain: بکاپ کامل و incremental ها به ترتیب)"""
         data = {'backup_id': backup_id}
-        return await self._make_request('POST', f'/vms/{vm_id}/restore', json=data)
+        if chain:
+            data['chain'] = chain
+        result = await self._make_request('POST', f'/vms/{vm_id}/restore', json=data)
+        self.invalidate_vm(vm_id)
+        return result
+
+@dataclass
+class SystemSnapshot:
+    """آخرین نمونه منابع سیستم"""
+    timestamp: float
+    cpu_percent: float
+    memory: Any
+    disk: Any
+    net: Any
+    net_sent_rate: float = 0.0
+    net_recv_rate: float = 0.0
+
+class SystemStatsSampler:
+    """نمونه‌برداری پس‌زمینه از منابع سیستم در فواصل ثابت"""
+    
+    def __init__(self, interval: float = 5.0, disk_path: str = '/'):
+        self.interval = interval
+        self.disk_path = disk_path
+        self.snapshot: Optional[SystemSnapshot] = None
+        self.listeners = []
+        self._task = None
+        # اولین فراخوانی بدون interval مبنای محاسبه CPU را تنظیم می‌کند
+        psutil.cpu_percent(interval=None)
+    
+    def sample(self) -> SystemSnapshot:
+        """یک نمونه‌برداری سریع (بدون انتظار)"""
+        now = time.time()
+        net = psutil.net_io_counters()
+        previous = self.snapshot
+        
+        snapshot = SystemSnapshot(
+            timestamp=now,
+            cpu_percent=psutil.cpu_percent(interval=None),
+            memory=psutil.virtual_memory(),
+            disk=psutil.disk_usage(self.disk_path),
+            net=net
+        )
+        
+        if previous is not None and now > previous.timestamp:
+            elapsed = now - previous.timestamp
+            snapshot.net_sent_rate = (net.bytes_sent - previous.net.bytes_sent) / elapsed
+            snapshot.net_recv_rate = (net.bytes_recv - previous.net.bytes_recv) / elapsed
+        
+        self.snapshot = snapshot
+        return snapshot
+    
+    def latest(self) -> SystemSnapshot:
+        """آخرین نمونه موجود"""
+        return self.snapshot or self.sample()
+    
+    async def _run(self):
+        """حلقه نمونه‌برداری با زمان‌بندی بدون drift"""
+        loop = asyncio.get_running_loop()
+        next_run = loop.time()
+        
+        while True:
+            try:
+                snapshot = await loop.run_in_executor(None, self.sample)
+                for listener in self.listeners:
+                    listener(snapshot)
+            except Exception as e:
+                logger.error(f"System stats sampling failed: {e}")
+            
+            next_run += self.interval
+            await asyncio.sleep(max(0.0, next_run - loop.time()))
+    
+    def start(self):
+        """شروع نمونه‌برداری"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """توقف نمونه‌برداری"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+@dataclass
+class TrackedOperation:
+    """یک عملیات VM در انتظار رسیدن به وضعیت هدف"""
+    key: Any
+    vm_id: str
+    action: str
+    target: str
+    on_done: Callable[['TrackedOperation', str, Optional[Dict]], Awaitable]
+    deadline: float
+    next_poll: float
+    delay: float
+    job_id: Optional[str] = None
+    started: float = 0.0
+    # برای restart: وضعیت هدف همان وضعیت فعلی است، پس تا دیدن خود راه‌اندازی مجدد صبر می‌شود
+    require_transition: bool = False
+    transitioned: bool = False
+
+class VMOperationTracker:
+    """پیگیری عملیات‌های VM با یک poller مشترک و backoff نمایی"""
+    
+    JOB_DONE = ('completed', 'done', 'success', 'finished')
+    JOB_FAILED = ('failed', 'error', 'cancelled')
+    
+    def __init__(self, api: 'VirtualizerAPI', initial_delay: float = 1.0, max_delay: float = 10.0,
+                 timeout: float = 180.0):
+        self.api = api
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.operations: Dict[Any, TrackedOperation] = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.polls = 0
+        self.completed = 0
+        self.timed_out = 0
+    
+    def track(self, key, vm_id: str, action: str, target: str, on_done, job_id: Optional[str] = None,
+              require_transition: bool = False):
+        """ثبت عملیات؛ عملیات جدید با همان key (مثلاً همان پیام) جایگزین قبلی می‌شود"""
+        now = time.monotonic()
+        self.operations[key] = TrackedOperation(
+            key=key, vm_id=vm_id, action=action, target=target, on_done=on_done,
+            deadline=now + self.timeout,
+            next_poll=now + self.initial_delay,
+            delay=self.initial_delay,
+            job_id=job_id,
+            started=now,
+            require_transition=require_transition
+        )
+        self._wakeup.set()
+    
+    @staticmethod
+    def _saw_transition(op: TrackedOperation, info: Dict, now: float) -> bool:
+        """وضعیتی غیر از هدف دیده شده یا uptime از شروع عملیات کوتاه‌تر است (VM دوباره بالا آمده)"""
+        if info.get('status') != op.target:
+            return True
+        try:
+            uptime = float(info['uptime'])
+        except (KeyError, TypeError, ValueError):
+            return False
+        return uptime < now - op.started
+    
+    async def _job_state(self, job_id: str) -> Optional[str]:
+        job = await self.api.get_job(job_id)
+        status = str(job.get('status', '')).lower()
+        if status in self.JOB_DONE:
+            return 'done'
+        if status in self.JOB_FAILED:
+            return 'failed'
+        return None
+    
+    async def _poll_due(self, due: List[TrackedOperation]):
+        """یک درخواست وضعیت برای هر VM، مشترک بین تمام عملیات‌های آن VM"""
+        vm_ids = {op.vm_id for op in due if op.job_id is None}
+        job_ids = {op.job_id for op in due if op.job_id is not None}
+        self.polls += len(vm_ids) + len(job_ids)
+        
+        vm_results = await asyncio.gather(
+            *(self.api.get_vm_info(vm_id, use_cache=False) for vm_id in vm_ids), return_exceptions=True
+        )
+        job_results = await asyncio.gather(
+            *(self._job_state(job_id) for job_id in job_ids), return_exceptions=True
+        )
+        infos = dict(zip(vm_ids, vm_results))
+        jobs = dict(zip(job_ids, job_results))
+        now = time.monotonic()
+        
+        for op in due:
+            # عملیات جدیدتری با همان key در حین درخواست‌ها ثبت شده است
+            if self.operations.get(op.key) is not op:
+                continue
+            
+            state = None
+            info = None
+            
+            if op.job_id is not None:
+                state = jobs[op.job_id]
+                if isinstance(state, VirtualizerHTTPError) and state.status == 404:
+                    # Virtualizer بدون API وضعیت job: از این به بعد وضعیت خود VM بررسی می‌شود
+                    op.job_id = None
+                    state = None
+                elif isinstance(state, Exception):
+                    state = None
+            else:
+                info = infos[op.vm_id]
+                if isinstance(info, Exception):
+                    info = None
+                else:
+                    if op.require_transition and not op.transitioned:
+                        op.transitioned = self._saw_transition(op, info, now)
+                    if info.get('status') == op.target and (op.transitioned or not op.require_transition):
+                        state = 'done'
+            
+            if state is None and now >= op.deadline:
+                state = 'timeout'
+            
+            if state is None:
+                op.delay = min(self.max_delay, op.delay * 2)
+                op.next_poll = now + op.delay
+                continue
+            
+            del self.operations[op.key]
+            if state == 'timeout':
+                self.timed_out += 1
+            else:
+                self.completed += 1
+            
+            try:
+                await op.on_done(op, state, info)
+            except Exception as e:
+                logger.error(f"VM operation callback failed for {op.vm_id}: {e}")
+    
+    async def _run(self):
+        """حلقه مشترک: خواب تا نزدیک‌ترین موعد یا ثبت عملیات جدید"""
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            due = [op for op in self.operations.values() if op.next_poll <= now]
+            
+            if due:
+                try:
+                    await self._poll_due(due)
+                except Exception as e:
+                    logger.error(f"VM operation polling failed: {e}")
+                continue
+            
+            timeout = min((op.next_poll for op in self.operations.values()), default=now + 60) - now
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, timeout))
+            except asyncio.TimeoutError:
+                pass
+    
+    def start(self):
+        """شروع poller"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """توقف poller"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """پردازش هم‌زمان update ها با حفظ ترتیب در هر چت و تعداد worker محدود"""
+    
+    def __init__(self, workers: int = 32, max_pending: int = 1024):
+        # سقف BaseUpdateProcessor فقط تعداد update های پذیرفته شده (در صف یا در حال اجرا) است؛
+        # تعداد اجرای هم‌زمان با semaphore جداگانه و پس از قفل چت محدود می‌شود تا
+        # update های منتظر یک چت شلوغ جای worker ها را نگیرند
+        super().__init__(max_pending)
+        self.workers = workers
+        self._worker_slots = asyncio.BoundedSemaphore(workers)
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._chat_waiters: Dict[int, int] = {}
+        self.pending = 0
+        self.running = 0
+        self.processed = 0
+        self.wait_latency = LatencyHistogram()
+        self.handle_latency = LatencyHistogram()
+    
+    @staticmethod
+    def _chat_id(update: object) -> Optional[int]:
+        if isinstance(update, Update) and update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+    
+    @contextmanager
+    def _chat_slot(self, chat_id: Optional[int]):
+        """قفل چت (با حذف قفل‌های بی‌استفاده)"""
+        if chat_id is None:
+            yield None
+            return
+        
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = self._chat_locks[chat_id] = asyncio.Lock()
+        self._chat_waiters[chat_id] = self._chat_waiters.get(chat_id, 0) + 1
+        try:
+            yield lock
+        finally:
+            self._chat_waiters[chat_id] -= 1
+            if not self._chat_waiters[chat_id]:
+                del self._chat_waiters[chat_id]
+                del self._chat_locks[chat_id]
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        queued = time.perf_counter()
+        self.pending += 1
+        started = None
+        
+        try:
+            with self._chat_slot(self._chat_id(update)) as lock:
+                if lock is not None:
+                    await lock.acquire()
+                try:
+                    async with self._worker_slots:
+                        started = time.perf_counter()
+                        self.pending -= 1
+                        self.running += 1
+                        self.wait_latency.observe(started - queued)
+                        failed = True
+                        try:
+                            await coroutine
+                            failed = False
+                        finally:
+                            self.running -= 1
+                            self.processed += 1
+                            self.handle_latency.observe(time.perf_counter() - started, error=failed)
+                finally:
+                    if lock is not None:
+                        lock.release()
+        finally:
+            # لغو شدن پیش از شروع اجرا
+            if started is None:
+                self.pending -= 1
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+    
+    def stats(self) -> Dict[str, Any]:
+        """عمق صف و تأخیرها"""
+        return {
+            'workers': self.workers,
+            'pending': self.pending,
+            'running': self.running,
+            'processed': self.processed,
+            'active_chats': len(self._chat_locks),
+            'queue_wait': self.wait_latency.snapshot(),
+            'handler': self.handle_latency.snapshot()
+        }
+
+class VMListPager:
+    """صفحه‌بندی لیست VM ها: برش سمت سرور در صورت پشتیبانی API، وگرنه ایندکس محلی بر اساس وضعیت"""
+    
+    STATUS_FILTERS = ('all', 'running', 'stopped', 'other')
+    
+    def __init__(self, api: 'VirtualizerAPI', page_size: int = 8, server_paging: bool = False,
+                 index_ttl: float = 60.0):
+        self.api = api
+        self.page_size = page_size
+        self.server_paging = server_paging
+        self._indexes = TTLCache(maxsize=1024, ttl=index_ttl)
+        self._generation = 0
+    
+    async def _index(self, user_id: Optional[int]) -> tuple:
+        """(لیست منبع، VM ها به تفکیک وضعیت، نسخه)؛ تا وقتی لیست کش شده API عوض نشود دوباره ساخته نمی‌شود"""
+        vms = await self.api.list_vms(user_id)
+        entry = self._indexes.get(user_id)
+        if entry is None or entry[0] is not vms:
+            self._generation += 1
+            by_status = {name: [] for name in self.STATUS_FILTERS}
+            by_status['all'] = vms
+            for vm in vms:
+                # وضعیت‌های گذرا یا خطا (creating، error، ...) خاموش حساب نمی‌شوند
+                status = vm.get('status')
+                by_status[status if status in ('running', 'stopped') else 'other'].append(vm)
+            entry = (vms, by_status, self._generation)
+            self._indexes.set(user_id, entry)
+        return entry
+    
+    async def page(self, user_id: Optional[int], status: str, page: int) -> tuple:
+        """(VM های صفحه، شماره صفحه، تعداد کل، تعداد به تفکیک وضعیت یا None، نسخه برای کش رندر یا None)"""
+        page = max(0, page)
+        
+        # API فقط وضعیت‌های مشخص را فیلتر می‌کند؛ «سایر» از ایندکس محلی ساخته می‌شود
+        if self.server_paging and status != 'other':
+            result = await self.api.list_vms_page(
+                user_id, status=None if status == 'all' else status,
+                offset=page * self.page_size, limit=self.page_size
+            )
+            return result.get('items', []), page, result.get('total', 0), None, None
+        
+        _, by_status, generation = await self._index(user_id)
+        items = by_status[status]
+        page = min(page, max(0, (len(items) - 1) // self.page_size))
+        offset = page * self.page_size
+        counts = {name: len(group) for name, group in by_status.items()}
+        return items[offset:offset + self.page_size], page, len(items), counts, generation
+
+@dataclass
+class CallbackRoute:
+    """یک مسیر callback"""
+    code: str
+    handler: Callable
+    vm_id: Optional[Callable[[str], Optional[str]]] = None  # استخراج شناسه VM برای بررسی مالکیت
+    admin: bool = False
+
+class CallbackRouter:
+    """مسیریابی جدولی callback ها با کدگذاری فشرده و نسخه‌دار: 1|کد|آرگومان"""
+    
+    VERSION = '1'
+    SEP = '|'
+    TOKEN_PREFIX = '~'
+    MAX_BYTES = 64
+    
+    def __init__(self, adb: 'AsyncDatabase', is_admin: Callable[[int], bool],
+                 owns_vm: Callable[[int, str], Awaitable[bool]], token_cache_size: int = 10000):
+        self.adb = adb
+        self.is_admin = is_admin
+        self.owns_vm = owns_vm
+        self.routes: Dict[str, CallbackRoute] = {}
+        self.legacy_exact: Dict[str, tuple] = {}
+        self.legacy_prefixes: List[tuple] = []
+        self.tokens = TTLCache(maxsize=token_cache_size, ttl=24 * 3600)
+        self._persisting = set()
+        self.dispatched = 0
+        self.denied = 0
+        self.unknown = 0
+    
+    def register(self, code: str, handler: Callable, vm_id: Optional[Callable] = None, admin: bool = False):
+        """ثبت handler با امضای (query, arg)"""
+        self.routes[code] = CallbackRoute(code, handler, vm_id=vm_id, admin=admin)
+    
+    def register_legacy(self, data: str, code: str, arg=None, prefix: bool = False):
+        """پشتیبانی از callback_data قدیمی پیام‌هایی که قبلاً ارسال شده‌اند"""
+        if prefix:
+            self.legacy_prefixes.append((data, code, arg))
+            self.legacy_prefixes.sort(key=lambda item: len(item[0]), reverse=True)
+        else:
+            self.legacy_exact[data] = (code, arg)
+    
+    @staticmethod
+    def _token(arg: str) -> str:
+        digest = hashlib.sha256(arg.encode('utf-8')).digest()
+        return base64.urlsafe_b64encode(digest)[:16].decode('ascii')
+    
+    def encode(self, code: str, arg: str = '') -> str:
+        """ساخت callback_data؛ آرگومان‌های طولانی با توکن ثابت جایگزین می‌شوند"""
+        data = f"{self.VERSION}{self.SEP}{code}{self.SEP}{arg}"
+        if len(data.encode('utf-8')) <= self.MAX_BYTES:
+            return data
+        
+        token = self._token(arg)
+        if self.tokens.get(token) is None:
+            self.tokens.set(token, arg)
+            self._persist_token(token, arg)
+        return f"{self.VERSION}{self.SEP}{code}{self.SEP}{self.TOKEN_PREFIX}{token}"
+    
+    def _persist_token(self, token: str, arg: str):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = loop.create_task(self.adb.execute(
+            'INSERT OR IGNORE INTO callback_tokens (token, value) VALUES (?, ?)', (token, arg)
+        ))
+        self._persisting.add(task)
+        task.add_done_callback(self._persisting.discard)
+    
+    async def _resolve_token(self, token: str) -> Optional[str]:
+        value = self.tokens.get(token)
+        if value is None:
+            row = await self.adb.fetchone('SELECT value FROM callback_tokens WHERE token = ?', (token,))
+            if row is None:
+                return None
+            value = row['value']
+            self.tokens.set(token, value)
+        return value
+    
+    async def decode(self, data: str) -> Optional[tuple]:
+        """(کد، آرگومان) یا None برای داده ناشناخته"""
+        version, sep, rest = data.partition(self.SEP)
+        if sep and version == self.VERSION:
+            code, _, arg = rest.partition(self.SEP)
+            if arg.startswith(self.TOKEN_PREFIX):
+                arg = await self._resolve_token(arg[len(self.TOKEN_PREFIX):])
+                if arg is None:
+                    return None
+            return code, arg
+        
+        legacy = self.legacy_exact.get(data)
+        if legacy is not None:
+            code, arg = legacy
+            return code, arg or ''
+        
+        for prefix, code, convert in self.legacy_prefixes:
+            if data.startswith(prefix):
+                arg = data[len(prefix):]
+                return code, convert(arg) if convert else arg
+        return None
+    
+    async def dispatch(self, query, data: str, user_id: int) -> bool:
+        """اجرای handler؛ دسترسی ادمین و مالکیت VM همین‌جا یک بار بررسی می‌شود"""
+        decoded = await self.decode(data)
+        route = self.routes.get(decoded[0]) if decoded else None
+        if route is None:
+            self.unknown += 1
+            return False
+        
+        code, arg = decoded
+        admin = self.is_admin(user_id)
+        if route.admin and not admin:
+            self.denied += 1
+            return False
+        
+        if route.vm_id is not None and not admin:
+            vm_id = route.vm_id(arg)
+            if vm_id is not None and not await self.owns_vm(user_id, vm_id):
+                self.denied += 1
+                await query.edit_message_text("⛔ این ماشین مجازی متعلق به شما نیست.")
+                return False
+        
+        self.dispatched += 1
+        await route.handler(query, arg)
+        return True
+
+class BotHTTPServer:
+    """سرور HTTP سبک: دریافت webhook تلگرام و سرویس /health و /metrics روی یک پورت"""
+    
+    SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+    
+    def __init__(self, bot_instance, host: str = '0.0.0.0', port: int = 8000,
+                 webhook_path: Optional[str] = None, secret_token: Optional[str] = None,
+                 metrics_token: Optional[str] = None):
+        self.bot = bot_instance
+        self.host = host
+        self.port = port
+        self.webhook_path = webhook_path
+        self.secret_token = secret_token
+        self.metrics_token = metrics_token
+        self.started_at = time.time()
+        self.webhook_updates = 0
+        self.webhook_rejected = 0
+        self.metrics_rejected = 0
+        self._runner = None
+        
+        self.web_app = web.Application()
+        self.web_app.router.add_get('/health', self.handle_health)
+        self.web_app.router.add_get('/metrics', self.handle_metrics)
+        if webhook_path:
+            self.web_app.router.add_post(webhook_path, self.handle_webhook)
+    
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        """دریافت update و قرار دادن در صف Application"""
+        token = request.headers.get(self.SECRET_HEADER, '')
+        if not self.secret_token or not hmac.compare_digest(token, self.secret_token):
+            self.webhook_rejected += 1
+            return web.Response(status=403)
+        
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.bot.app.bot)
+        except Exception as e:
+            logger.warning(f"Invalid webhook payload: {e}")
+            return web.Response(status=400)
+        
+        await self.bot.app.update_queue.put(update)
+        self.webhook_updates += 1
+        return web.Response()
+    
+    async def handle_health(self, request: web.Request) -> web.Response:
+        """وضعیت سلامت برای healthcheck کانتینر"""
+        breaker = self.bot.api.breaker.stats()['state']
+        running = self.bot.app is not None and self.bot.app.running
+        body = {
+            'status': 'ok' if running else 'starting',
+            'uptime': round(time.time() - self.started_at, 1),
+            'virtualizer_api': breaker,
+            'log_buffer_saturated': self.bot.db.log_buffer.saturated
+        }
+        return web.json_response(body, status=200 if running else 503)
+    
+    def _metrics_allowed(self, request: web.Request) -> bool:
+        """با توکن: Bearer یا ?token=؛ بدون توکن: فقط اتصال مستقیم از loopback (نه از پشت proxy)"""
+        if self.metrics_token:
+            header = request.headers.get('Authorization', '')
+            token = header[7:] if header.startswith('Bearer ') else request.query.get('token', '')
+            return hmac.compare_digest(token, self.metrics_token)
+        
+        if 'X-Forwarded-For' in request.headers or 'Forwarded' in request.headers:
+            return False
+        try:
+            return ipaddress.ip_address(request.remote or '').is_loopback
+        except ValueError:
+            return False
+    
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        """متریک‌ها در قالب متنی Prometheus"""
+        if not self._metrics_allowed(request):
+            self.metrics_rejected += 1
+            return web.Response(status=403)
+        return web.Response(text=self.render_metrics(), content_type='text/plain', charset='utf-8')
+    
+    @staticmethod
+    def _histogram(lines: List[str], name: str, histogram: LatencyHistogram, labels: str = ''):
+        cumulative = 0
+        for bound, count in zip(histogram.BUCKETS_MS, histogram.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else f'{bound / 1000:g}'
+            label = f'{labels},le="{le}"' if labels else f'le="{le}"'
+            lines.append(f'{name}_bucket{{{label}}} {cumulative}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {histogram.total_ms / 1000:.6f}')
+        lines.append(f'{name}_count{suffix} {histogram.count}')
+    
+    def render_metrics(self) -> str:
+        lines: List[str] = []
+        
+        def gauge(name: str, value, help_text: str, kind: str = 'gauge'):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {float(value):g}')
+        
+        gauge('bot_uptime_seconds', time.time() - self.started_at, 'Seconds since the HTTP server started')
+        gauge('bot_webhook_updates_total', self.webhook_updates, 'Updates received via webhook', 'counter')
+        gauge('bot_webhook_rejected_total', self.webhook_rejected, 'Webhook requests with a bad secret', 'counter')
+        gauge('bot_metrics_rejected_total', self.metrics_rejected, 'Unauthorised /metrics requests', 'counter')
+        
+        processor = self.bot.update_processor
+        gauge('bot_updates_pending', processor.pending, 'Updates waiting for a worker')
+        gauge('bot_updates_running', processor.running, 'Updates being handled')
+        gauge('bot_updates_processed_total', processor.processed, 'Updates handled', 'counter')
+        lines.append('# TYPE bot_update_queue_wait_seconds histogram')
+        self._histogram(lines, 'bot_update_queue_wait_seconds', processor.wait_latency)
+        lines.append('# TYPE bot_update_handler_seconds histogram')
+        self._histogram(lines, 'bot_update_handler_seconds', processor.handle_latency)
+        
+        api = self.bot.api
+        lines.append('# TYPE virtualizer_request_seconds histogram')
+        for endpoint, histogram in list(api.latency.items()):
+            self._histogram(lines, 'virtualizer_request_seconds', histogram, f'endpoint="{endpoint}"')
+        cache = api.cache.stats()
+        gauge('virtualizer_cache_hits_total', cache['hits'], 'API cache hits', 'counter')
+        gauge('virtualizer_cache_misses_total', cache['misses'], 'API cache misses', 'counter')
+        gauge('virtualizer_retries_total', api.retries, 'API retries', 'counter')
+        gauge('virtualizer_breaker_open', api.breaker.stats()['state'] == 'open', 'Circuit breaker open')
+        
+        log_stats = self.bot.db.log_buffer.stats()
+        gauge('activity_log_pending', log_stats['pending'], 'Buffered activity log rows')
+        gauge('activity_log_flushed_total', log_stats['flushed'], 'Activity log rows written', 'counter')
+        
+        broadcast = self.bot.broadcaster.stats()
+        gauge('notifications_sent_total', broadcast['sent'], 'Notifications delivered', 'counter')
+        gauge('notifications_failed_total', broadcast['failed'], 'Notifications given up on', 'counter')
+        
+        jobs = self.bot.scheduler.stats()
+        for name, key, kind in (
+            ('scheduler_job_runs_total', 'runs', 'counter'),
+            ('scheduler_job_failures_total', 'failures', 'counter'),
+            ('scheduler_job_last_duration_seconds', 'last_duration', 'gauge'),
+        ):
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{name}{{job="{job["name"]}"}} {float(job[key]):g}' for job in jobs)
+        
+        return '\n'.join(lines) + '\n'
+    
+    async def start(self):
+        """شروع سرور"""
+        self.started_at = time.time()
+        self._runner = web.AppRunner(self.web_app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"HTTP server listening on {self.host}:{self.port}")
+    
+    async def stop(self):
+        """توقف سرور"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
 
 class ServerManagementBot:
     """کلاس اصلی ربات"""
     
+    # فقط انواع update که handler ها استفاده می‌کنند
+    ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+    
     def __init__(self):
-        self.db = Database(config.DATABASE_PATH)
-        self.api = VirtualizerAPI(config.VIRTUALIZER_API_URL, config.VIRTUALIZER_API_KEY)
+        self.config = config
+        self.db = Database(
+            config.DATABASE_PATH,
+            pool_size=config.DB_POOL_SIZE,
+            log_batch_size=config.LOG_BATCH_SIZE,
+            log_flush_interval=config.LOG_FLUSH_INTERVAL,
+            log_max_pending=config.LOG_MAX_PENDING,
+            user_cache_size=config.USER_CACHE_SIZE,
+            user_cache_ttl=config.USER_CACHE_TTL,
+            log_archive_dir=config.LOG_ARCHIVE_DIR,
+            log_hot_days=config.LOG_HOT_DAYS
+        )
+        self.adb = AsyncDatabase(self.db)
+        self.api = VirtualizerAPI(
+            config.VIRTUALIZER_API_URL,
+            config.VIRTUALIZER_API_KEY,
+            connection_limit=config.API_CONNECTION_LIMIT,
+            limit_per_host=config.API_LIMIT_PER_HOST,
+            keepalive_timeout=config.API_KEEPALIVE_TIMEOUT,
+            dns_cache_ttl=config.API_DNS_CACHE_TTL,
+            total_timeout=config.API_TOTAL_TIMEOUT,
+            connect_timeout=config.API_CONNECT_TIMEOUT,
+            read_timeout=config.API_READ_TIMEOUT,
+            vm_list_ttl=config.API_VM_LIST_TTL,
+            vm_info_ttl=config.API_VM_INFO_TTL,
+            max_retries=config.API_MAX_RETRIES,
+            backoff_base=config.API_BACKOFF_BASE,
+            backoff_max=config.API_BACKOFF_MAX,
+            breaker_threshold=config.API_BREAKER_THRESHOLD,
+            breaker_recovery=config.API_BREAKER_RECOVERY
+        )
+        self.sampler = SystemStatsSampler(config.SYSTEM_SAMPLE_INTERVAL)
+        self.update_processor = PerChatUpdateProcessor(config.UPDATE_WORKERS, config.UPDATE_MAX_PENDING)
+        self.vm_pager = VMListPager(
+            self.api,
+            page_size=config.VM_LIST_PAGE_SIZE,
+            server_paging=config.VM_LIST_SERVER_PAGING
+        )
+        self.vm_list_pages = TTLCache(maxsize=512, ttl=config.API_VM_LIST_TTL)
+        self.router = CallbackRouter(self.adb, self.is_admin, self.owns_vm)
+        self.setup_routes()
+        webhook = config.RUN_MODE == 'webhook'
+        self.http = BotHTTPServer(
+            self,
+            host=config.HTTP_HOST,
+            port=config.HTTP_PORT,
+            webhook_path=config.WEBHOOK_PATH if webhook else None,
+            secret_token=(config.WEBHOOK_SECRET or secrets.token_urlsafe(32)) if webhook else None,
+            metrics_token=config.METRICS_TOKEN or None
+        )
+        self.vm_ops = VMOperationTracker(
+            self.api,
+            initial_delay=config.VM_OP_POLL_INITIAL,
+            max_delay=config.VM_OP_POLL_MAX,
+            timeout=config.VM_OP_TIMEOUT
+        )
+        self.metrics = MetricsStore(self.adb, collect_interval=config.METRICS_COLLECT_INTERVAL)
+        self.sampler.listeners.append(self.metrics.record_snapshot)
+        self.charts = ChartRenderer(
+            self.metrics,
+            TTLCache(maxsize=128, ttl=config.CHART_CACHE_TTL),
+            workers=config.CHART_WORKERS
+        )
+        self.broadcaster = NotificationBroadcaster(
+            self,
+            global_rate=config.BROADCAST_GLOBAL_RATE,
+            per_chat_rate=config.BROADCAST_PER_CHAT_RATE,
+            concurrency=config.BROADCAST_CONCURRENCY,
+            max_attempts=config.BROADCAST_MAX_ATTEMPTS
+        )
+        self.scheduler = AsyncScheduler(self.adb)
+        self.tasks = ScheduledTasks(self)
+        self.tasks.setup_schedules(self.scheduler)
         self.app = None
     
     def is_admin(self, user_id: int) -> bool:
         """بررسی مجوز ادمین"""
         return user_id in config.ADMIN_USER_IDS
     
-    def is_authorized(self, user_id: int) -> bool:
+    async def is_authorized(self, user_id: int) -> bool:
         """بررسی مجوز دسترسی"""
-        user = self.db.get_user(user_id)
+        user = await self.adb.get_user(user_id)
         return user and (user['is_active'] or self.is_admin(user_id))
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -266,7 +2164,7 @@ class ServerManagementBot:
         user = update.effective_user
         
         # ثبت کاربر در دیتابیس
-        self.db.add_user(
+        await self.adb.add_user(
             user.id, 
             user.username or "", 
             user.full_name or "",
@@ -308,19 +2206,20 @@ class ServerManagementBot:
             reply_markup=reply_markup
         )
         
-        self.db.log_activity(user.id, "start_bot")
+        await self.adb.log_activity(user.id, "start_bot")
     
     async def server_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """نمایش آمار سرور"""
-        if not self.is_authorized(update.effective_user.id):
+        if not await self.is_authorized(update.effective_user.id):
             await update.message.reply_text("⛔ شما مجوز دسترسی ندارید.")
             return
         
         try:
             # آمار سیستم محلی
-            cpu_percent = psutil.cpu_percent(interval=1)
-            memory = psutil.virtual_memory()
-            disk = psutil.disk_usage('/')
+            snapshot = self.sampler.latest()
+            cpu_percent = snapshot.cpu_percent
+            memory = snapshot.memory
+            disk = snapshot.disk
             
             # آمار از API ویرچوالایزور
             api_stats = await self.api.get_server_stats()
@@ -345,7 +2244,10 @@ class ServerManagementBot:
 آخرین بروزرسانی: {datetime.now().strftime('%Y-%m-%d %H:%M')}
             """
             
-            keyboard = [[InlineKeyboardButton("🔄 بروزرسانی", callback_data="refresh_stats")]]
+            keyboard = [[
+                InlineKeyboardButton("🔄 بروزرسانی", callback_data=self.router.encode('ss')),
+                InlineKeyboardButton("📈 نمودار", callback_data=self.router.encode('ch', '1h:host'))
+            ]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             await update.message.reply_text(
@@ -360,44 +2262,14 @@ class ServerManagementBot:
     
     async def my_vms(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """نمایش ماشین‌های مجازی کاربر"""
-        if not self.is_authorized(update.effective_user.id):
+        if not await self.is_authorized(update.effective_user.id):
             await update.message.reply_text("⛔ شما مجوز دسترسی ندارید.")
             return
         
         try:
-            user_id = update.effective_user.id
-            vms = await self.api.list_vms(user_id)
-            
-            if not vms:
-                await update.message.reply_text(
-                    "📭 شما هیچ ماشین مجازی ندارید.\n\n"
-                    "برای ایجاد VM جدید از دکمه 'ایجاد VM جدید' استفاده کنید."
-                )
-                return
-            
-            vms_text = "💻 **ماشین‌های مجازی شما:**\n\n"
-            
-            keyboard = []
-            for vm in vms:
-                status_emoji = "▶️" if vm['status'] == 'running' else "⏸️"
-                vms_text += f"{status_emoji} **{vm['name']}**\n"
-                vms_text += f"   🏷️ ID: `{vm['vm_id']}`\n"
-                vms_text += f"   🖥️ CPU: {vm['cpu']} Core\n"
-                vms_text += f"   🧠 RAM: {vm['ram']} MB\n"
-                vms_text += f"   🌐 IP: {vm.get('ip_address', 'تخصیص نیافته')}\n\n"
-                
-                keyboard.append([
-                    InlineKeyboardButton(
-                        f"مدیریت {vm['name']}", 
-                        callback_data=f"manage_vm_{vm['vm_id']}"
-                    )
-                ])
-            
-            keyboard.append([InlineKeyboardButton("➕ ایجاد VM جدید", callback_data="create_vm")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
+            text, reply_markup = await self.render_vm_list('user', update.effective_user.id, 'all', 0)
             await update.message.reply_text(
-                vms_text,
+                text,
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=reply_markup
             )
@@ -406,6 +2278,97 @@ class ServerManagementBot:
             await update.message.reply_text(f"❌ خطا در دریافت لیست VM ها: {str(e)}")
             logger.error(f"VMs list error: {e}")
     
+    async def render_vm_list(self, scope: str, user_id: Optional[int], status: str, page: int) -> tuple:
+        """متن و کیبورد یک صفحه از لیست VM ها (scope: user یا admin)؛ صفحات رندر شده کش می‌شوند"""
+        if status not in VMListPager.STATUS_FILTERS:
+            status = 'all'
+        owner = None if scope == 'admin' else user_id
+        items, page, total, counts, generation = await self.vm_pager.page(owner, status, page)
+        
+        # با برش سمت سرور نسخه‌ای در کار نیست؛ کش API خودش تازگی را تضمین می‌کند
+        cache_key = (scope, owner, status, page, generation) if generation is not None else None
+        cached = self.vm_list_pages.get(cache_key) if cache_key else None
+        if cached is not None:
+            return cached
+        
+        code = 'la' if scope == 'admin' else 'lp'
+        pages = max(1, -(-total // self.vm_pager.page_size))
+        
+        if not total and status == 'all' and scope == 'user':
+            text = (
+                "📭 شما هیچ ماشین مجازی ندارید.\n\n"
+                "برای ایجاد VM جدید از دکمه زیر استفاده کنید."
+            )
+            keyboard = [[InlineKeyboardButton("➕ ایجاد VM جدید", callback_data=self.router.encode('nv'))]]
+            result = (text, InlineKeyboardMarkup(keyboard))
+            if cache_key:
+                self.vm_list_pages.set(cache_key, result)
+            return result
+        
+        title = "💻 **تمام ماشین‌های مجازی:**" if scope == 'admin' else "💻 **ماشین‌های مجازی شما:**"
+        lines = [f"{title} ({total})", ""]
+        keyboard = []
+        
+        for vm in items:
+            status_emoji = {'running': "▶️", 'stopped': "⏸️"}.get(vm['status'], "❔")
+            lines.append(f"{status_emoji} **{vm['name']}**")
+            lines.append(f"   🏷️ ID: `{vm['vm_id']}`")
+            if scope == 'admin':
+                lines.append(f"   👤 کاربر: `{vm.get('user_id', '-')}`")
+            lines.append(f"   🖥️ CPU: {vm['cpu']} Core | 🧠 RAM: {vm['ram']} MB")
+            lines.append(f"   🌐 IP: {vm.get('ip_address', 'تخصیص نیافته')}")
+            lines.append("")
+            
+            keyboard.append([
+                InlineKeyboardButton(
+                    f"مدیریت {vm['name']}",
+                    callback_data=self.router.encode('mv', vm['vm_id'])
+                )
+            ])
+        
+        if not items:
+            lines.append("📭 ماشینی با این وضعیت وجود ندارد.")
+        
+        if pages > 1:
+            nav = []
+            if page > 0:
+                nav.append(InlineKeyboardButton("◀️", callback_data=self.router.encode(code, f"{status}:{page - 1}")))
+            nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=self.router.encode(code, f"{status}:{page}")))
+            if page < pages - 1:
+                nav.append(InlineKeyboardButton("▶️", callback_data=self.router.encode(code, f"{status}:{page + 1}")))
+            keyboard.append(nav)
+        
+        labels = {'all': "همه", 'running': "▶️ روشن", 'stopped': "⏸️ خاموش", 'other': "❔ سایر"}
+        keyboard.append([
+            InlineKeyboardButton(
+                f"{'• ' if name == status else ''}{label}"
+                + (f" ({counts[name]})" if counts else ""),
+                callback_data=self.router.encode(code, f"{name}:0")
+            )
+            for name, label in labels.items()
+            # دکمه «سایر» فقط وقتی VM ای در آن باشد (یا تعدادها معلوم نباشد)
+            if name != 'other' or not counts or counts['other'] or status == 'other'
+        ])
+        
+        if scope == 'user':
+            keyboard.append([InlineKeyboardButton("➕ ایجاد VM جدید", callback_data=self.router.encode('nv'))])
+        
+        result = ("\n".join(lines), InlineKeyboardMarkup(keyboard))
+        if cache_key:
+            self.vm_list_pages.set(cache_key, result)
+        return result
+    
+    async def vm_list_page_callback(self, query, arg: str, scope: str = 'user'):
+        """تغییر صفحه یا فیلتر لیست VM ها"""
+        status, _, page = arg.partition(':')
+        text, reply_markup = await self.render_vm_list(scope, query.from_user.id, status, int(page or 0))
+        try:
+            await query.edit_message_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+        except BadRequest as e:
+            # کلیک روی دکمه صفحه جاری یا فیلتر فعلی پیام را تغییر نمی‌دهد
+            if 'not modified' not in str(e).lower():
+                raise
+    
     async def vm_management_menu(self, vm_id: str, chat_id: int, message_id: int = None):
         """منوی مدیریت ماشین مجازی"""
         try:
@@ -428,24 +2391,24 @@ class ServerManagementBot:
             
             if vm_info['status'] == 'running':
                 keyboard.append([
-                    InlineKeyboardButton("⏸️ توقف", callback_data=f"stop_vm_{vm_id}"),
-                    InlineKeyboardButton("🔄 ریستارت", callback_data=f"restart_vm_{vm_id}")
+                    InlineKeyboardButton("⏸️ توقف", callback_data=self.router.encode('of', vm_id)),
+                    InlineKeyboardButton("🔄 ریستارت", callback_data=self.router.encode('rb', vm_id))
                 ])
             else:
                 keyboard.append([
-                    InlineKeyboardButton("▶️ شروع", callback_data=f"start_vm_{vm_id}")
+                    InlineKeyboardButton("▶️ شروع", callback_data=self.router.encode('on', vm_id))
                 ])
             
             keyboard.extend([
                 [
-                    InlineKeyboardButton("📊 آمار", callback_data=f"vm_stats_{vm_id}"),
-                    InlineKeyboardButton("⚙️ تنظیمات", callback_data=f"vm_settings_{vm_id}")
+                    InlineKeyboardButton("📊 آمار", callback_data=self.router.encode('vs', vm_id)),
+                    InlineKeyboardButton("⚙️ تنظیمات", callback_data=self.router.encode('vt', vm_id))
                 ],
                 [
-                    InlineKeyboardButton("💾 بکاپ", callback_data=f"vm_backup_{vm_id}"),
-                    InlineKeyboardButton("🗑️ حذف", callback_data=f"delete_vm_{vm_id}")
+                    InlineKeyboardButton("💾 بکاپ", callback_data=self.router.encode('vb', vm_id)),
+                    InlineKeyboardButton("🗑️ حذف", callback_data=self.router.encode('rm', vm_id))
                 ],
-                [InlineKeyboardButton("🔙 برگشت", callback_data="back_to_vms")]
+                [InlineKeyboardButton("🔙 برگشت", callback_data=self.router.encode('ls'))]
             ])
             
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -481,55 +2444,52 @@ class ServerManagementBot:
         data = query.data
         user_id = query.from_user.id
         
-        if not self.is_authorized(user_id):
+        if not await self.is_authorized(user_id):
             await query.edit_message_text("⛔ شما مجوز دسترسی ندارید.")
             return
         
         try:
-            if data == "refresh_stats":
-                await self.server_stats_callback(query)
-            
-            elif data.startswith("manage_vm_"):
-                vm_id = data.replace("manage_vm_", "")
-                await self.vm_management_menu(vm_id, query.message.chat_id, query.message.message_id)
-            
-            elif data.startswith("start_vm_"):
-                vm_id = data.replace("start_vm_", "")
-                await self.start_vm_callback(query, vm_id)
-            
-            elif data.startswith("stop_vm_"):
-                vm_id = data.replace("stop_vm_", "")
-                await self.stop_vm_callback(query, vm_id)
-            
-            elif data.startswith("restart_vm_"):
-                vm_id = data.replace("restart_vm_", "")
-                await self.restart_vm_callback(query, vm_id)
-            
-            elif data.startswith("delete_vm_"):
-                vm_id = data.replace("delete_vm_", "")
-                await self.delete_vm_callback(query, vm_id)
-            
-            elif data == "create_vm":
-                await self.create_vm_start(query)
-            
-            elif data == "back_to_vms":
-                await self.my_vms_callback(query)
+            await self.router.dispatch(query, data, user_id)
                 
         except Exception as e:
             await query.edit_message_text(f"❌ خطا: {str(e)}")
             logger.error(f"Button handler error: {e}")
     
+    def track_vm_operation(self, query, vm_id: str, action: str, target: str, result: Optional[Dict]):
+        """به‌روزرسانی منوی VM در پس‌زمینه پس از رسیدن به وضعیت هدف"""
+        chat_id = query.message.chat_id
+        message_id = query.message.message_id
+        
+        async def on_done(op: TrackedOperation, state: str, info: Optional[Dict]):
+            if state == 'done':
+                await self.vm_management_menu(vm_id, chat_id, message_id)
+                return
+            
+            text = (
+                f"❌ عملیات {action} روی VM ناموفق بود."
+                if state == 'failed' else
+                f"⌛ عملیات {action} هنوز تمام نشده است؛ وضعیت را بعداً بررسی کنید."
+            )
+            keyboard = [[InlineKeyboardButton("🔄 مشاهده وضعیت", callback_data=self.router.encode('mv', vm_id))]]
+            await self.app.bot.edit_message_text(
+                text, chat_id=chat_id, message_id=message_id,
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+        
+        job_id = (result or {}).get('job_id') or (result or {}).get('task_id')
+        self.vm_ops.track(
+            (chat_id, message_id), vm_id, action, target, on_done,
+            job_id=job_id, require_transition=action == 'restart'
+        )
+    
     async def start_vm_callback(self, query, vm_id: str):
         """روشن کردن VM"""
         try:
-            await self.api.start_vm(vm_id)
-            await query.edit_message_text("✅ ماشین مجازی در حال روشن شدن...")
-            
-            # بروزرسانی منو بعد از 3 ثانیه
-            await asyncio.sleep(3)
-            await self.vm_management_menu(vm_id, query.message.chat_id, query.message.message_id)
+            result = await self.api.start_vm(vm_id)
+            await query.edit_message_text("⏳ ماشین مجازی در حال روشن شدن...")
+            self.track_vm_operation(query, vm_id, 'start', 'running', result)
             
-            self.db.log_activity(query.from_user.id, f"start_vm_{vm_id}")
+            await self.adb.log_activity(query.from_user.id, f"start_vm_{vm_id}")
             
         except Exception as e:
             await query.edit_message_text(f"❌ خطا در روشن کردن VM: {str(e)}")
@@ -537,13 +2497,11 @@ class ServerManagementBot:
     async def stop_vm_callback(self, query, vm_id: str):
         """خاموش کردن VM"""
         try:
-            await self.api.stop_vm(vm_id)
-            await query.edit_message_text("✅ ماشین مجازی در حال خاموش شدن...")
+            result = await self.api.stop_vm(vm_id)
+            await query.edit_message_text("⏳ ماشین مجازی در حال خاموش شدن...")
+            self.track_vm_operation(query, vm_id, 'stop', 'stopped', result)
             
-            await asyncio.sleep(3)
-            await self.vm_management_menu(vm_id, query.message.chat_id, query.message.message_id)
-            
-            self.db.log_activity(query.from_user.id, f"stop_vm_{vm_id}")
+            await self.adb.log_activity(query.from_user.id, f"stop_vm_{vm_id}")
             
         except Exception as e:
             await query.edit_message_text(f"❌ خطا در خاموش کردن VM: {str(e)}")
@@ -551,13 +2509,11 @@ class ServerManagementBot:
     async def restart_vm_callback(self, query, vm_id: str):
         """راه‌اندازی مجدد VM"""
         try:
-            await self.api.restart_vm(vm_id)
-            await query.edit_message_text("✅ ماشین مجازی در حال راه‌اندازی مجدد...")
-            
-            await asyncio.sleep(5)
-            await self.vm_management_menu(vm_id, query.message.chat_id, query.message.message_id)
+            result = await self.api.restart_vm(vm_id)
+            await query.edit_message_text("⏳ ماشین مجازی در حال راه‌اندازی مجدد...")
+            self.track_vm_operation(query, vm_id, 'restart', 'running', result)
             
-            self.db.log_activity(query.from_user.id, f"restart_vm_{vm_id}")
+            await self.adb.log_activity(query.from_user.id, f"restart_vm_{vm_id}")
             
         except Exception as e:
             await query.edit_message_text(f"❌ خطا در راه‌اندازی مجدد VM: {str(e)}")
@@ -567,30 +2523,18 @@ class ServerManagementBot:
         text = update.message.text
         user_id = update.effective_user.id
         
-        if not self.is_authorized(user_id):
+        if not await self.is_authorized(user_id):
             await update.message.reply_text("⛔ شما مجوز دسترسی ندارید.")
             return
         
-        if text == "📊 آمار سرور":
-            await self.server_stats(update, context)
-        
-        elif text == "💻 ماشین‌های من":
-            await self.my_vms(update, context)
-        
-        elif text == "➕ ایجاد VM جدید":
-            await self.create_vm_command(update, context)
-        
-        elif text == "⚙️ تنظیمات":
-            await self.settings_command(update, context)
-        
-        elif text == "📋 راهنما":
-            await self.help_command(update, context)
-        
-        elif text == "📞 پشتیبانی":
-            await self.support_command(update, context)
+        route = self.text_routes.get(text)
+        if route is None:
+            return
         
-        elif text == "👑 پنل ادمین" and self.is_admin(user_id):
-            await self.admin_panel(update, context)
+        handler, admin_only = route
+        if admin_only and not self.is_admin(user_id):
+            return
+        await handler(update, context)
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """راهنمای استفاده"""
@@ -601,6 +2545,7 @@ class ServerManagementBot:
 • `/start` - شروع ربات
 • `/stats` - آمار سرور
 • `/myvms` - لیست ماشین‌های مجازی
+• `/history` - تاریخچه منابع سرور
 • `/createvm` - ایجاد VM جدید
 • `/help` - این راهنما
 
@@ -625,52 +2570,184 @@ class ServerManagementBot:
         
         await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
     
+    async def owns_vm(self, user_id: int, vm_id: str) -> bool:
+        """بررسی مالکیت VM با همان لیست کش شده‌ای که «ماشین‌های من» نشان می‌دهد"""
+        try:
+            vms = await self.api.list_vms(user_id)
+        except Exception as e:
+            logger.warning(f"Ownership check for VM {vm_id} failed for user {user_id}: {e}")
+            return False
+        return any(str(vm.get('vm_id')) == str(vm_id) for vm in vms)
+    
+    async def chart_callback(self, query, arg: str):
+        """callback نمودار: آرگومان به شکل بازه:scope"""
+        window, _, scope = arg.partition(':')
+        # خطای نمودار نباید متن آمار یا نمودار قبلی را با پیام خطا جایگزین کند
+        try:
+            await self.send_chart(query, scope, window)
+        except Exception as e:
+            logger.error(f"Chart {scope}/{window} failed: {e!r}")
+            await query.message.reply_text("❌ ساخت نمودار ناموفق بود.")
+    
+    @staticmethod
+    def _chart_vm_id(arg: str) -> Optional[str]:
+        scope = arg.partition(':')[2]
+        return scope[3:] if scope.startswith('vm.') else None
+    
+    def setup_routes(self):
+        """جدول مسیرهای callback و دکمه‌های متنی"""
+        vm_arg = lambda arg: arg
+        router = self.router
+        
+        router.register('ss', lambda query, _: self.server_stats_callback(query))
+        router.register(
+            'mv', lambda query, vm_id: self.vm_management_menu(vm_id, query.message.chat_id, query.message.message_id),
+            vm_id=vm_arg
+        )
+        router.register('on', self.start_vm_callback, vm_id=vm_arg)
+        router.register('of', self.stop_vm_callback, vm_id=vm_arg)
+        router.register('rb', self.restart_vm_callback, vm_id=vm_arg)
+        router.register('rm', self.delete_vm_callback, vm_id=vm_arg)
+        router.register('cd', self.confirm_delete_vm_callback, vm_id=vm_arg)
+        router.register('vs', self.vm_stats_callback, vm_id=vm_arg)
+        router.register('ch', self.chart_callback, vm_id=self._chart_vm_id)
+        router.register('nv', lambda query, _: self.create_vm_start(query))
+        router.register('ls', lambda query, _: self.my_vms_callback(query))
+        router.register('lg', lambda query, days: self.admin_logs_callback(query, int(days or 1)), admin=True)
+        router.register('lp', self.vm_list_page_callback)
+        router.register('la', lambda query, arg: self.vm_list_page_callback(query, arg, scope='admin'), admin=True)
+        
+        # callback_data قدیمی روی پیام‌های ارسال شده پیش از این نسخه
+        router.register_legacy('refresh_stats', 'ss')
+        router.register_legacy('create_vm', 'nv')
+        router.register_legacy('back_to_vms', 'ls')
+        router.register_legacy('admin_logs', 'lg', '1')
+        router.register_legacy('admin_vms', 'la', 'all:0')
+        router.register_legacy('admin_logs_', 'lg', prefix=True)
+        router.register_legacy('manage_vm_', 'mv', prefix=True)
+        router.register_legacy('start_vm_', 'on', prefix=True)
+        router.register_legacy('stop_vm_', 'of', prefix=True)
+        router.register_legacy('restart_vm_', 'rb', prefix=True)
+        router.register_legacy('delete_vm_', 'rm', prefix=True)
+        router.register_legacy('confirm_delete_', 'cd', prefix=True)
+        router.register_legacy('vm_stats_', 'vs', prefix=True)
+        router.register_legacy(
+            'chart_', 'ch', prefix=True,
+            arg=lambda rest: '{1}:{0}'.format(*rest.rsplit('_', 1))
+        )
+        
+        self.text_routes = {
+            "📊 آمار سرور": (self.server_stats, False),
+            "💻 ماشین‌های من": (self.my_vms, False),
+            "➕ ایجاد VM جدید": (self.create_vm_command, False),
+            "⚙️ تنظیمات": (self.settings_command, False),
+            "📋 راهنما": (self.help_command, False),
+            "📞 پشتیبانی": (self.support_command, False),
+            "👑 پنل ادمین": (self.admin_panel, True),
+        }
+    
     def setup_handlers(self):
         """تنظیم handlers"""
         self.app.add_handler(CommandHandler("start", self.start_command))
         self.app.add_handler(CommandHandler("stats", self.server_stats))
         self.app.add_handler(CommandHandler("myvms", self.my_vms))
+        self.app.add_handler(CommandHandler("history", self.history_command))
         self.app.add_handler(CommandHandler("help", self.help_command))
         
         self.app.add_handler(CallbackQueryHandler(self.button_handler))
         self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.message_handler))
     
-    async def run(self):
-        """اجرای ربات"""
-        self.app = Application.builder().token(config.BOT_TOKEN).build()
-        self.setup_handlers()
+    async def post_init(self, application: Application):
+        """راه‌اندازی منابع پس از ساخت Application"""
+        await self.api.init_session()
+        self.sampler.start()
+        self.metrics.start(self.api)
+        self.broadcaster.start()
+        self.vm_ops.start()
+        await self.scheduler.start()
+        await self.http.start()
         
         # تنظیم دستورات منو
         commands = [
             BotCommand("start", "شروع ربات"),
             BotCommand("stats", "آمار سرور"),
             BotCommand("myvms", "ماشین‌های مجازی من"),
+            BotCommand("history", "تاریخچه منابع"),
             BotCommand("help", "راهنما"),
         ]
-        await self.app.bot.set_my_commands(commands)
+        await application.bot.set_my_commands(commands)
+    
+    async def post_shutdown(self, application: Application):
+        """آزادسازی منابع هنگام توقف Application"""
+        await self.http.stop()
+        await self.scheduler.stop()
+        await self.vm_ops.stop()
+        await self.broadcaster.stop()
+        await self.sampler.stop()
+        await self.metrics.stop()
+        self.charts.close()
+        await self.api.close_session()
+    
+    def run(self):
+        """اجرای ربات"""
+        self.app = (
+            Application.builder()
+            .token(config.BOT_TOKEN)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .concurrent_updates(self.update_processor)
+            .build()
+        )
+        self.setup_handlers()
         
         print("🤖 ربات در حال اجرا...")
-        await self.app.run_polling(allowed_updates=Update.ALL_TYPES)
-
-def main():
-    """تابع اصلی"""
-    bot = ServerManagementBot()
+        if config.RUN_MODE == 'webhook':
+            asyncio.run(self.run_webhook())
+        else:
+            self.app.run_polling(allowed_updates=self.ALLOWED_UPDATES)
     
-    try:
-        asyncio.run(bot.run())
-    except KeyboardInterrupt:
-        print("🛑 ربات متوقف شد.")
-    finally:
-        asyncio.run(bot.api.close_session())
+    async def run_webhook(self):
+        """اجرا در حالت webhook با سرور HTTP داخلی"""
+        # بدون آدرس عمومی set_webhook با یک URL نسبی شکست می‌خورد و ربات بی‌صدا هیچ update ای نمی‌گیرد
+        if not config.WEBHOOK_URL.startswith('https://'):
+            raise ValueError(
+                f"RUN_MODE is 'webhook' but WEBHOOK_URL is {config.WEBHOOK_URL or 'empty'}; "
+                "set it to the bot's public https:// address"
+            )
+        
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+        
+        await self.app.initialize()
+        try:
+            await self.post_init(self.app)
+            await self.app.start()
+            await self.app.bot.set_webhook(
+                url=f"{config.WEBHOOK_URL.rstrip('/')}{config.WEBHOOK_PATH}",
+                secret_token=self.http.secret_token,
+                allowed_updates=self.ALLOWED_UPDATES,
+                max_connections=config.WEBHOOK_MAX_CONNECTIONS
+            )
+            await stop.wait()
+        finally:
+            if self.app.running:
+                await self.app.stop()
+            await self.post_shutdown(self.app)
+            await self.app.shutdown()
 
     async def create_vm_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """شروع فرآیند ایجاد VM جدید"""
-        if not self.is_authorized(update.effective_user.id):
+        if not await self.is_authorized(update.effective_user.id):
             await update.message.reply_text("⛔ شما مجوز دسترسی ندارید.")
             return
         
         # بررسی حد مجاز VM
-        user = self.db.get_user(update.effective_user.id)
+        user = await self.adb.get_user(update.effective_user.id)
         user_vms = await self.api.list_vms(update.effective_user.id)
         
         if len(user_vms) >= user.get('max_vms', config.MAX_VMS_PER_USER):
@@ -741,11 +2818,11 @@ def main():
     
     async def settings_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """تنظیمات کاربر"""
-        if not self.is_authorized(update.effective_user.id):
+        if not await self.is_authorized(update.effective_user.id):
             await update.message.reply_text("⛔ شما مجوز دسترسی ندارید.")
             return
         
-        user = self.db.get_user(update.effective_user.id)
+        user = await self.adb.get_user(update.effective_user.id)
         
         settings_text = f"""
 ⚙️ **تنظیمات حساب کاربری**
@@ -845,12 +2922,8 @@ def main():
             all_vms = await self.api.list_vms()
             active_vms = len([vm for vm in all_vms if vm['status'] == 'running'])
             
-            with sqlite3.connect(self.db.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM users WHERE is_active = 1")
-                active_users = cursor.fetchone()[0]
-                cursor.execute("SELECT COUNT(*) FROM users")
-                total_users = cursor.fetchone()[0]
+            active_users = (await self.adb.fetchone("SELECT COUNT(*) FROM users WHERE is_active = 1"))[0]
+            total_users = (await self.adb.fetchone("SELECT COUNT(*) FROM users"))[0]
             
             admin_text = f"""
 👑 **پنل مدیریت سیستم**
@@ -873,7 +2946,7 @@ def main():
             keyboard = [
                 [
                     InlineKeyboardButton("👥 مدیریت کاربران", callback_data="admin_users"),
-                    InlineKeyboardButton("💻 مدیریت VM ها", callback_data="admin_vms")
+                    InlineKeyboardButton("💻 مدیریت VM ها", callback_data=self.router.encode('la', 'all:0'))
                 ],
                 [
                     InlineKeyboardButton("📊 گزارشات", callback_data="admin_reports"),
@@ -881,7 +2954,7 @@ def main():
                 ],
                 [
                     InlineKeyboardButton("🔧 ابزارهای سیستم", callback_data="admin_tools"),
-                    InlineKeyboardButton("📝 لاگ سیستم", callback_data="admin_logs")
+                    InlineKeyboardButton("📝 لاگ سیستم", callback_data=self.router.encode('lg', '1'))
                 ],
                 [
                     InlineKeyboardButton("🔄 بروزرسانی", callback_data="admin_refresh")
@@ -902,9 +2975,10 @@ def main():
     async def server_stats_callback(self, query):
         """بروزرسانی آمار سرور"""
         try:
-            cpu_percent = psutil.cpu_percent(interval=1)
-            memory = psutil.virtual_memory()
-            disk = psutil.disk_usage('/')
+            snapshot = self.sampler.latest()
+            cpu_percent = snapshot.cpu_percent
+            memory = snapshot.memory
+            disk = snapshot.disk
             
             api_stats = await self.api.get_server_stats()
             
@@ -928,7 +3002,10 @@ def main():
 آخرین بروزرسانی: {datetime.now().strftime('%Y-%m-%d %H:%M')}
             """
             
-            keyboard = [[InlineKeyboardButton("🔄 بروزرسانی", callback_data="refresh_stats")]]
+            keyboard = [[
+                InlineKeyboardButton("🔄 بروزرسانی", callback_data=self.router.encode('ss')),
+                InlineKeyboardButton("📈 نمودار", callback_data=self.router.encode('ch', '1h:host'))
+            ]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             await query.edit_message_text(
@@ -943,42 +3020,9 @@ def main():
     async def my_vms_callback(self, query):
         """نمایش لیست VM ها از طریق callback"""
         try:
-            user_id = query.from_user.id
-            vms = await self.api.list_vms(user_id)
-            
-            if not vms:
-                await query.edit_message_text(
-                    "📭 شما هیچ ماشین مجازی ندارید.\n\n"
-                    "برای ایجاد VM جدید از دکمه زیر استفاده کنید.",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("➕ ایجاد VM جدید", callback_data="create_vm")
-                    ]])
-                )
-                return
-            
-            vms_text = "💻 **ماشین‌های مجازی شما:**\n\n"
-            
-            keyboard = []
-            for vm in vms:
-                status_emoji = "▶️" if vm['status'] == 'running' else "⏸️"
-                vms_text += f"{status_emoji} **{vm['name']}**\n"
-                vms_text += f"   🏷️ ID: `{vm['vm_id']}`\n"
-                vms_text += f"   🖥️ CPU: {vm['cpu']} Core\n"
-                vms_text += f"   🧠 RAM: {vm['ram']} MB\n"
-                vms_text += f"   🌐 IP: {vm.get('ip_address', 'تخصیص نیافته')}\n\n"
-                
-                keyboard.append([
-                    InlineKeyboardButton(
-                        f"مدیریت {vm['name']}", 
-                        callback_data=f"manage_vm_{vm['vm_id']}"
-                    )
-                ])
-            
-            keyboard.append([InlineKeyboardButton("➕ ایجاد VM جدید", callback_data="create_vm")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
+            text, reply_markup = await self.render_vm_list('user', query.from_user.id, 'all', 0)
             await query.edit_message_text(
-                vms_text,
+                text,
                 parse_mode=ParseMode.MARKDOWN,
                 reply_markup=reply_markup
             )
@@ -1011,8 +3055,8 @@ def main():
             
             keyboard = [
                 [
-                    InlineKeyboardButton("✅ بله، حذف کن", callback_data=f"confirm_delete_{vm_id}"),
-                    InlineKeyboardButton("❌ لغو", callback_data=f"manage_vm_{vm_id}")
+                    InlineKeyboardButton("✅ بله، حذف کن", callback_data=self.router.encode('cd', vm_id)),
+                    InlineKeyboardButton("❌ لغو", callback_data=self.router.encode('mv', vm_id))
                 ]
             ]
             
@@ -1027,6 +3071,148 @@ def main():
         except Exception as e:
             await query.edit_message_text(f"❌ خطا در دریافت اطلاعات VM: {str(e)}")
     
+    async def confirm_delete_vm_callback(self, query, vm_id: str):
+        """حذف VM پس از تأیید کاربر"""
+        try:
+            await self.api.delete_vm(vm_id)
+            await self.adb.log_activity(query.from_user.id, f"delete_vm_{vm_id}")
+            
+            keyboard = [[InlineKeyboardButton("🔙 برگشت", callback_data=self.router.encode('ls'))]]
+            await query.edit_message_text(
+                f"✅ ماشین مجازی `{vm_id}` حذف شد.",
+                parse_mode=ParseMode.MARKDOWN,
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+            
+        except Exception as e:
+            await query.edit_message_text(f"❌ خطا در حذف VM: {str(e)}")
+    
+    async def format_history(self, prefix: str, hours: float) -> str:
+        """متن تاریخچه منابع با نمودار متنی برای یک میزبان یا VM"""
+        start = time.time() - hours * 3600
+        series_labels = [
+            ('cpu', '🖥️ CPU', '%'),
+            ('ram', '🧠 RAM', '%'),
+            ('net_rx', '📥 دریافتی', ' B/s'),
+            ('net_tx', '📤 ارسالی', ' B/s')
+        ]
+        if prefix == 'host':
+            series_labels.insert(2, ('disk', '💾 دیسک', '%'))
+        
+        lines = []
+        for name, label, unit in series_labels:
+            points = await self.metrics.query(f'{prefix}.{name}', start)
+            if not points:
+                continue
+            averages = [point[1] for point in points]
+            lines.append(
+                f"{label}: `{sparkline(averages)}`\n"
+                f"   میانگین {sum(averages) / len(averages):.1f}{unit} | "
+                f"حداکثر {max(point[3] for point in points):.1f}{unit}"
+            )
+        
+        return '\n'.join(lines) or "📭 داده‌ای برای این بازه ثبت نشده است."
+    
+    async def send_chart(self, query, scope: str, window: str):
+        """ارسال نمودار منابع؛ روی پیام نمودار قبلی، همان عکس جایگزین می‌شود"""
+        png = await self.charts.render(scope, window)
+        if png is None:
+            return
+        
+        keyboard = [[
+            InlineKeyboardButton(
+                f"{'• ' if name == window else ''}{name}",
+                callback_data=self.router.encode('ch', f"{name}:{scope}")
+            )
+            for name in ChartRenderer.WINDOWS
+        ]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        caption = f"📈 {scope} - {window}"
+        
+        if query.message.photo:
+            await query.edit_message_media(
+                InputMediaPhoto(png, caption=caption),
+                reply_markup=reply_markup
+            )
+        else:
+            await query.message.reply_photo(png, caption=caption, reply_markup=reply_markup)
+    
+    async def history_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """تاریخچه منابع سرور: /history [ساعت]"""
+        if not await self.is_authorized(update.effective_user.id):
+            await update.message.reply_text("⛔ شما مجوز دسترسی ندارید.")
+            return
+        
+        try:
+            hours = float(context.args[0]) if context.args else 24
+            hours = min(max(hours, 0.1), 24 * 730)
+        except ValueError:
+            await update.message.reply_text("⚠️ استفاده: /history [تعداد ساعت]")
+            return
+        
+        history_text = f"📈 **تاریخچه منابع سرور - {hours:g} ساعت اخیر**\n\n"
+        history_text += await self.format_history('host', hours)
+        
+        await update.message.reply_text(history_text, parse_mode=ParseMode.MARKDOWN)
+    
+    async def vm_stats_callback(self, query, vm_id: str):
+        """آمار و تاریخچه مصرف یک VM"""
+        try:
+            vm_info = await self.api.get_vm_info(vm_id)
+            
+            stats_text = f"📊 **آمار {vm_info['name']}** - یک ساعت اخیر\n\n"
+            stats_text += await self.format_history(f'vm.{vm_id}', 1)
+            
+            keyboard = [[
+                InlineKeyboardButton("📈 نمودار", callback_data=self.router.encode('ch', f'1h:vm.{vm_id}')),
+                InlineKeyboardButton("🔙 برگشت", callback_data=self.router.encode('mv', vm_id))
+            ]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            
+            await query.edit_message_text(
+                stats_text,
+                parse_mode=ParseMode.MARKDOWN,
+                reply_markup=reply_markup
+            )
+            
+        except Exception as e:
+            await query.edit_message_text(f"❌ خطا در دریافت آمار VM: {str(e)}")
+    
+    async def admin_logs_callback(self, query, days: int = 1):
+        """نمایش لاگ سیستم (جدول اصلی و بایگانی)"""
+        try:
+            since = datetime.utcnow() - timedelta(days=days)
+            logs = await self.adb.run_read(self.db.log_archive.query, since, limit=30)
+            
+            logs_text = f"📝 **لاگ سیستم - {days} روز اخیر**\n\n"
+            
+            if not logs:
+                logs_text += "📭 فعالیتی ثبت نشده است."
+            
+            for log in logs:
+                logs_text += f"🕐 {log['timestamp']} | 👤 {log['user_id']}\n"
+                logs_text += f"   `{log['action']}`\n"
+            
+            keyboard = [
+                [
+                    InlineKeyboardButton("1 روز", callback_data=self.router.encode('lg', '1')),
+                    InlineKeyboardButton("7 روز", callback_data=self.router.encode('lg', '7')),
+                    InlineKeyboardButton("30 روز", callback_data=self.router.encode('lg', '30')),
+                    InlineKeyboardButton("90 روز", callback_data=self.router.encode('lg', '90'))
+                ]
+            ]
+            
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            
+            await query.edit_message_text(
+                logs_text,
+                parse_mode=ParseMode.MARKDOWN,
+                reply_markup=reply_markup
+            )
+            
+        except Exception as e:
+            await query.edit_message_text(f"❌ خطا در دریافت لاگ‌ها: {str(e)}")
+    
     async def error_handler(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         """مدیریت خطاها"""
         logger.error(f"Exception while handling an update: {context.error}")
@@ -1036,6 +3222,18 @@ def main():
                 "❌ خطای غیرمنتظره‌ای رخ داد. لطفاً دوباره تلاش کنید."
             )
 
+def main():
+    """تابع اصلی"""
+    bot = ServerManagementBot()
+    
+    try:
+        bot.run()
+    except KeyboardInterrupt:
+        print("🛑 ربات متوقف شد.")
+    finally:
+        # flush نهایی لاگ‌های بافر شده و بستن دیتابیس
+        bot.adb.close()
+
 if __name__ == "__main__":
     # تنظیمات اولیه - لطفاً قبل از اجرا این موارد را تنظیم کنید:
     
@@ -1070,6 +3268,10 @@ if __name__ == "__main__":
         print("❌ خطا: لطفاً ابتدا VIRTUALIZER_API_KEY را تنظیم کنید")
         exit(1)
     
+    if config.RUN_MODE == 'webhook' and not config.WEBHOOK_URL.startswith('https://'):
+        print("❌ خطا: در حالت webhook لطفاً WEBHOOK_URL را با آدرس عمومی https تنظیم کنید")
+        exit(1)
+    
     # راه‌اندازی ربات
     bot = ServerManagementBot()
     main()
\ No newline at end of file
@@ -0,0 +1,98 @@
+"""BackupOrchestrator: بکاپ‌هایی که ساختشان از بازه زمانی گذشت و ثبت دسته‌ای نتایج"""
+
+import asyncio
+
+import pytest
+
+from advanced_features import BackupOrchestrator, BackupStore
+from server_management_bot import AsyncDatabase, Database
+
+
+class FakeAPI:
+    """create_backup برای VM های کند تا پایان بازه جواب نمی‌دهد ولی روی Virtualizer ادامه می‌یابد"""
+    
+    def __init__(self, slow=()):
+        self.slow = set(slow)
+        self.created = []
+        self.backups = {}
+    
+    async def get_vm_info(self, vm_id, use_cache=True):
+        return {'vm_id': vm_id}
+    
+    async def create_backup(self, vm_id, backup_name, parent=None):
+        self.created.append(vm_id)
+        self.backups[backup_name] = {'status': 'running'}
+        if vm_id in self.slow:
+            await asyncio.sleep(10)
+        self.backups[backup_name] = {'status': 'completed', 'path': f'/b/{backup_name}', 'size': 10}
+        return self.backups[backup_name]
+    
+    async def get_backup(self, vm_id, backup_name):
+        return self.backups[backup_name]
+    
+    async def download_backup(self, vm_id, backup_name):
+        yield backup_name.encode()
+
+
+class FakeBot:
+    def __init__(self, db, api):
+        self.db = db
+        self.adb = AsyncDatabase(db)
+        self.api = api
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(str(tmp_path / 'orch.db'), log_archive_dir=str(tmp_path / 'archive'))
+    yield database
+    database.close()
+
+
+def backups(db):
+    return [dict(row) for row in db.fetchall('SELECT * FROM backups ORDER BY id')]
+
+
+def test_timed_out_backup_is_tracked_not_requeued(db):
+    api = FakeAPI(slow={'vm-slow'})
+    bot = FakeBot(db, api)
+    orchestrator = BackupOrchestrator(bot, window=0.2, mode='full')
+    vms = [{'vm_id': 'vm-fast'}, {'vm_id': 'vm-slow'}]
+    
+    run = asyncio.run(orchestrator.run(vms))
+    assert (run.completed, run.pending, run.deferred) == (1, 1, 0)
+    assert [row['vm_id'] for row in backups(db)] == ['vm-fast']
+    assert [row['vm_id'] for row in db.fetchall('SELECT vm_id FROM pending_backups')] == ['vm-slow']
+    
+    # بکاپ هنوز روی Virtualizer در جریان است: درخواست دوم ساخته نمی‌شود
+    api.created.clear()
+    run = asyncio.run(orchestrator.run(vms))
+    assert api.created == ['vm-fast']
+    assert run.pending == 1
+    
+    # پایان بکاپ روی Virtualizer: یک بار ثبت می‌شود و از صف انتظار خارج می‌شود
+    for name in api.backups:
+        api.backups[name] = {'status': 'completed', 'path': f'/b/{name}', 'size': 10}
+    assert asyncio.run(orchestrator.reconcile_pending()) == set()
+    assert [row['vm_id'] for row in backups(db)].count('vm-slow') == 1
+    assert db.fetchall('SELECT * FROM pending_backups') == []
+    bot.adb.close()
+
+
+def test_batched_save_registers_artifacts_on_the_right_rows(db, tmp_path):
+    api = FakeAPI()
+    bot = FakeBot(db, api)
+    store = BackupStore(bot.adb, str(tmp_path / 'chunks'), chunk_size=8)
+    orchestrator = BackupOrchestrator(bot, mode='full', store=store)
+    
+    asyncio.run(orchestrator.run([{'vm_id': f'vm{i}'} for i in range(25)]))
+    rows = backups(db)
+    
+    assert len(rows) == 25
+    assert all(row['chain_id'] == row['id'] for row in rows)
+    for row in rows:
+        chunks = b''.join(
+            open(store.chunk_path(ref['hash']), 'rb').read()
+            for ref in db.fetchall('SELECT hash FROM chunk_refs WHERE backup_id = ? ORDER BY seq', (row['id'],))
+        )
+        assert chunks == row['backup_name'].encode()
+    bot.adb.close()
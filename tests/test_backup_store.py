@@ -0,0 +1,75 @@
+"""مخزن بکاپ: جمع‌آوری chunk های بدون ارجاع و قفل مشترک/انحصاری مخزن"""
+
+import asyncio
+import os
+
+import pytest
+
+from advanced_features import BackupStore, SharedLock
+from server_management_bot import AsyncDatabase, Database
+
+
+async def stream(*pieces):
+    for piece in pieces:
+        yield piece
+
+
+@pytest.fixture
+def store(tmp_path):
+    db = Database(str(tmp_path / 'store.db'), log_archive_dir=str(tmp_path / 'archive'))
+    adb = AsyncDatabase(db)
+    yield BackupStore(adb, str(tmp_path / 'chunks'), chunk_size=4)
+    adb.close()
+
+
+def chunk_files(store):
+    return {name for _, _, names in os.walk(store.root) for name in names}
+
+
+def test_sweep_removes_only_unregistered_chunks(store):
+    async def scenario():
+        kept = await store.ingest(stream(b'AAAABBBB'))
+        # کپی نیمه‌کاره‌ای که هرگز در کاتالوگ ثبت نشد؛ AAAA با بکاپ ثبت شده مشترک است
+        orphan = await store.ingest(stream(b'AAAACCCC'))
+        
+        backup_id = store.adb.db.execute(
+            "INSERT INTO backups (vm_id, backup_name, backup_path, size) VALUES ('vm1', 'b1', '', 8)"
+        )
+        with store.adb.db.transaction() as conn:
+            BackupStore.register(conn, backup_id, kept)
+        
+        files, freed = await store.sweep()
+        return kept, orphan, backup_id, files, freed
+    
+    kept, orphan, backup_id, files, freed = asyncio.run(scenario())
+    
+    assert (files, freed) == (1, 4)
+    assert chunk_files(store) == {digest for digest, _ in kept.chunks}
+    assert orphan.chunks[1][0] not in chunk_files(store)
+    assert asyncio.run(store.verify(backup_id))
+
+
+def test_exclusive_waits_for_shared_holders_and_blocks_new_ones():
+    async def scenario():
+        lock = SharedLock()
+        order = []
+        
+        async def shared(name, hold):
+            async with lock.shared():
+                order.append(f'{name} start')
+                await asyncio.sleep(hold)
+                order.append(f'{name} end')
+        
+        async def exclusive():
+            async with lock.exclusive():
+                order.append('exclusive')
+        
+        backup = asyncio.create_task(shared('backup', 0.05))
+        await asyncio.sleep(0.01)
+        retention = asyncio.create_task(exclusive())
+        await asyncio.sleep(0.01)
+        restore = asyncio.create_task(shared('restore', 0))
+        await asyncio.gather(backup, retention, restore)
+        return order
+    
+    assert asyncio.run(scenario()) == ['backup start', 'backup end', 'exclusive', 'restore start', 'restore end']
@@ -0,0 +1,89 @@
+"""بررسی مالکیت VM در CallbackRouter.dispatch با مسیرهای واقعی ربات"""
+
+import asyncio
+
+import pytest
+
+from server_management_bot import CallbackRouter, ServerManagementBot, VirtualizerHTTPError
+
+ADMIN_ID = 1
+OWNER_ID = 2
+OTHER_ID = 3
+
+
+class FakeAPI:
+    """list_vms مثل Virtualizer: فیلتر بر اساس user_id، شناسه‌ها گاهی عددی"""
+    
+    def __init__(self):
+        self.vms = {OWNER_ID: [{'vm_id': 101, 'name': 'web'}, {'vm_id': 'vm-db', 'name': 'db'}]}
+        self.down = False
+    
+    async def list_vms(self, user_id=None, use_cache=True):
+        if self.down:
+            raise VirtualizerHTTPError(503, 'unavailable')
+        return self.vms.get(user_id, [])
+
+
+class FakeQuery:
+    def __init__(self):
+        self.edits = []
+    
+    async def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+@pytest.fixture
+def bot():
+    instance = ServerManagementBot.__new__(ServerManagementBot)
+    instance.api = FakeAPI()
+    instance.router = CallbackRouter(None, lambda user_id: user_id == ADMIN_ID, instance.owns_vm)
+    instance.setup_routes()
+    
+    instance.handled = []
+    
+    async def record(query, arg):
+        instance.handled.append(arg)
+    
+    for route in instance.router.routes.values():
+        route.handler = record
+    return instance
+
+
+def dispatch(bot, data, user_id):
+    query = FakeQuery()
+    result = asyncio.run(bot.router.dispatch(query, data, user_id))
+    return result, query
+
+
+def test_owner_can_act_on_own_vm_with_numeric_id(bot):
+    result, query = dispatch(bot, bot.router.encode('on', '101'), OWNER_ID)
+    assert result is True
+    assert bot.handled == ['101']
+    assert query.edits == []
+
+
+def test_owner_can_open_chart_of_own_vm(bot):
+    result, _ = dispatch(bot, bot.router.encode('ch', '1h:vm.vm-db'), OWNER_ID)
+    assert result is True
+
+
+def test_non_owner_is_denied(bot):
+    result, query = dispatch(bot, bot.router.encode('rm', 'vm-db'), OTHER_ID)
+    assert result is False
+    assert bot.handled == []
+    assert len(query.edits) == 1
+    assert bot.router.denied == 1
+
+
+def test_admin_skips_ownership_check(bot):
+    bot.api.down = True
+    result, _ = dispatch(bot, bot.router.encode('of', 'vm-db'), ADMIN_ID)
+    assert result is True
+
+
+def test_api_down_denies_and_logs(bot, caplog):
+    bot.api.down = True
+    result, _ = dispatch(bot, bot.router.encode('rb', 'vm-db'), OWNER_ID)
+    assert result is False
+    assert bot.handled == []
+    assert any('Ownership check for VM vm-db failed' in record.message for record in caplog.records)
@@ -0,0 +1,66 @@
+"""سرور HTTP ربات: دسترسی به /metrics و شکست سریع webhook بدون آدرس عمومی"""
+
+import asyncio
+from unittest import mock
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer, make_mocked_request
+
+import server_management_bot
+from server_management_bot import BotHTTPServer, ServerManagementBot
+
+
+def metrics_server(token=None):
+    http = BotHTTPServer(bot_instance=None, metrics_token=token)
+    http.render_metrics = lambda: 'bot_uptime_seconds 1\n'
+    return http
+
+
+async def fetch(http, *requests):
+    """requests: (path, headers) و خروجی کد وضعیت هر کدام"""
+    async with TestClient(TestServer(http.web_app, host='127.0.0.1')) as client:
+        statuses = []
+        for path, headers in requests:
+            response = await client.get(path, headers=headers)
+            statuses.append(response.status)
+        return statuses
+
+
+def test_metrics_without_token_is_loopback_only():
+    http = metrics_server()
+    statuses = asyncio.run(fetch(
+        http,
+        ('/metrics', {}),
+        ('/metrics', {'X-Forwarded-For': '203.0.113.7'}),
+    ))
+    assert statuses == [200, 403]
+    assert http.metrics_rejected == 1
+
+    remote = mock.Mock()
+    remote.get_extra_info.return_value = ('10.0.0.5', 40000)
+    request = make_mocked_request('GET', '/metrics', transport=remote)
+    assert not http._metrics_allowed(request)
+
+
+def test_metrics_token_accepts_bearer_or_query():
+    http = metrics_server('s3cret')
+    statuses = asyncio.run(fetch(
+        http,
+        ('/metrics', {}),
+        ('/metrics', {'Authorization': 'Bearer wrong'}),
+        ('/metrics', {'Authorization': 'Bearer s3cret'}),
+        ('/metrics?token=s3cret', {}),
+    ))
+    assert statuses == [403, 403, 200, 200]
+    assert http.metrics_rejected == 2
+
+
+@pytest.mark.parametrize('url', ['', 'http://bot.example.com'])
+def test_webhook_mode_requires_public_https_url(monkeypatch, url):
+    monkeypatch.setattr(server_management_bot.config, 'WEBHOOK_URL', url)
+    bot = ServerManagementBot.__new__(ServerManagementBot)
+    bot.app = mock.Mock()
+
+    with pytest.raises(ValueError, match='WEBHOOK_URL'):
+        asyncio.run(bot.run_webhook())
+    bot.app.initialize.assert_not_called()
@@ -0,0 +1,76 @@
+"""صف اعلان‌ها: حساب تلاش‌ها هنگام flood-wait و پاک‌سازی پیام‌های ناموفق"""
+
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+from advanced_features import NotificationBroadcaster
+from server_management_bot import AsyncDatabase, Database
+
+
+class FloodedTelegram:
+    """اولین پیام ارسال می‌شود و دومی با 429 رد می‌شود"""
+    
+    def __init__(self):
+        self.sent = []
+    
+    async def send_message(self, chat_id, text, parse_mode=None):
+        if len(self.sent) == 1:
+            raise RetryAfter(30)
+        self.sent.append((chat_id, text))
+
+
+class FakeBot:
+    def __init__(self, db):
+        self.db = db
+        self.adb = AsyncDatabase(db)
+        self.app = type('App', (), {})()
+        self.app.bot = FloodedTelegram()
+
+
+@pytest.fixture
+def bot(tmp_path):
+    db = Database(str(tmp_path / 'outbox.db'), log_archive_dir=str(tmp_path / 'archive'))
+    instance = FakeBot(db)
+    yield instance
+    instance.adb.close()
+
+
+def outbox(bot):
+    return {row['text']: dict(row) for row in bot.db.fetchall('SELECT * FROM notification_outbox')}
+
+
+def test_flood_wait_charges_only_the_rejected_message(bot):
+    broadcaster = NotificationBroadcaster(bot, global_rate=1000, per_chat_rate=1000, max_attempts=2)
+    
+    async def scenario():
+        for text in ('one', 'two', 'three', 'four'):
+            await broadcaster.broadcast([42], text)
+        await broadcaster._dispatch_batch()
+    
+    asyncio.run(scenario())
+    rows = outbox(bot)
+    
+    assert bot.app.bot.sent == [(42, 'one')]
+    assert 'one' not in rows
+    assert rows['two']['attempts'] == 1 and rows['two']['status'] == 'pending'
+    for text in ('three', 'four'):
+        assert rows[text]['attempts'] == 0
+        assert rows[text]['status'] == 'pending'
+        assert rows[text]['next_attempt_at'] == pytest.approx(rows['two']['next_attempt_at'], abs=1)
+
+
+def test_prune_removes_only_old_failed_messages(bot):
+    bot.db.executemany(
+        "INSERT INTO notification_outbox (chat_id, text, status, created_at) VALUES (?, ?, ?, datetime('now', ?))",
+        [
+            (1, 'old failed', 'failed', '-30 days'),
+            (1, 'new failed', 'failed', '-1 days'),
+            (1, 'old pending', 'pending', '-30 days'),
+        ]
+    )
+    broadcaster = NotificationBroadcaster(bot)
+    
+    assert asyncio.run(broadcaster.prune(7)) == 1
+    assert set(outbox(bot)) == {'new failed', 'old pending'}
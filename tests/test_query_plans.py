@@ -0,0 +1,53 @@
+"""بررسی استفاده کوئری‌های گزارش و نگه‌داری از ایندکس‌ها با EXPLAIN QUERY PLAN"""
+
+import pytest
+
+from server_management_bot import Database
+
+ACTIVE_USERS_TODAY = '''
+    SELECT COUNT(DISTINCT user_id)
+    FROM activity_logs
+    WHERE timestamp >= DATE('now') AND timestamp < DATE('now', '+1 day')
+'''
+
+NEW_VMS_TODAY = '''
+    SELECT COUNT(*)
+    FROM virtual_machines
+    WHERE created_at >= DATE('now') AND created_at < DATE('now', '+1 day')
+'''
+
+# جایگزین کوئری حذف بکاپ‌های قدیمی در RetentionEngine.plan
+RETENTION_PLAN = '''
+    SELECT id, vm_id, created_at, chain_id, backup_path, size
+    FROM backups
+    ORDER BY vm_id DESC, created_at DESC
+'''
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(str(tmp_path / 'plans.db'), log_archive_dir=str(tmp_path / 'archive'))
+    yield database
+    database.close()
+
+
+def test_active_users_today_uses_timestamp_index(db):
+    plan = db.explain(ACTIVE_USERS_TODAY)
+    assert any(
+        line.startswith('SEARCH activity_logs') and 'COVERING INDEX idx_activity_logs_timestamp_user' in line
+        for line in plan
+    ), plan
+
+
+def test_new_vms_today_uses_created_at_index(db):
+    plan = db.explain(NEW_VMS_TODAY)
+    assert any(
+        line.startswith('SEARCH virtual_machines') and 'INDEX idx_vms_created_at' in line
+        for line in plan
+    ), plan
+
+
+def test_retention_plan_walks_vm_created_index(db):
+    plan = db.explain(RETENTION_PLAN)
+    assert any('USING INDEX idx_backups_vm_created' in line for line in plan), plan
+    assert not any('TEMP B-TREE' in line for line in plan), plan
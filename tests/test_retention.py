@@ -0,0 +1,110 @@
+"""نگه‌داری بکاپ: مجموعه ماندنی GFS و حذف chunk ها بدون آسیب به بکاپ‌های ماندنی"""
+
+import asyncio
+import os
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from advanced_features import BackupStore, RetentionEngine, RetentionPolicy
+from server_management_bot import AsyncDatabase, Database
+
+NOW = datetime(2026, 10, 17, 2, 0)
+
+
+def daily_rows(days, chain_of=lambda day: None):
+    """بکاپ روزانه از جدید به قدیم؛ شناسه بزرگ‌تر یعنی بکاپ جدیدتر"""
+    return [
+        {'id': days - day, 'created': NOW - timedelta(days=day), 'chain_id': chain_of(day)}
+        for day in range(days)
+    ]
+
+
+def kept_dates(rows, keep):
+    return sorted(row['created'].date() for row in rows if row['id'] in keep)
+
+
+def test_gfs_keeps_pinned_set_for_120_daily_backups():
+    rows = daily_rows(120)
+    keep = RetentionPolicy(daily=7, weekly=4, monthly=6).select_keep(rows)
+
+    assert kept_dates(rows, keep) == [
+        # ماهانه: آخرین بکاپ هر ماه (پیش از 2026-06-20 بکاپی نیست، پس فقط پنج ماه)
+        date(2026, 6, 30), date(2026, 7, 31), date(2026, 8, 31),
+        # هفتگی: یکشنبه، آخرین روز هفته ISO
+        date(2026, 9, 27), date(2026, 9, 30), date(2026, 10, 4), date(2026, 10, 11),
+        # روزانه: هفت روز آخر
+        date(2026, 10, 12), date(2026, 10, 13), date(2026, 10, 14), date(2026, 10, 15),
+        date(2026, 10, 16), date(2026, 10, 17),
+    ]
+
+
+def test_kept_incremental_keeps_its_chain():
+    # هر هفت روز یک full و بقیه incremental روی همان زنجیره
+    rows = daily_rows(21, chain_of=lambda day: 21 - (day // 7) * 7 - 6)
+    keep = RetentionPolicy(daily=1, weekly=0, monthly=0).select_keep(rows)
+
+    newest = rows[0]
+    chain = {row['id'] for row in rows if row['chain_id'] == newest['chain_id'] and row['id'] <= newest['id']}
+    assert keep == chain
+    assert len(keep) == 7
+
+
+class FakeBot:
+    def __init__(self, db):
+        self.db = db
+        self.adb = AsyncDatabase(db)
+
+
+@pytest.fixture
+def bot(tmp_path):
+    db = Database(str(tmp_path / 'retention.db'), log_archive_dir=str(tmp_path / 'archive'))
+    instance = FakeBot(db)
+    yield instance
+    instance.adb.close()
+
+
+async def stream(*pieces):
+    for piece in pieces:
+        yield piece
+
+
+def add_backup(bot, store, day, payload, tmp_path):
+    path = str(tmp_path / f'backup-{day}.tar')
+    with open(path, 'wb') as f:
+        f.write(payload)
+    created = (NOW - timedelta(days=day)).strftime('%Y-%m-%d %H:%M:%S')
+    backup_id = bot.db.execute(
+        'INSERT INTO backups (vm_id, backup_name, backup_path, size, created_at) VALUES (?, ?, ?, ?, ?)',
+        ('vm1', f'b{day}', path, len(payload), created)
+    )
+    artifact = asyncio.run(store.ingest(stream(payload)))
+    with bot.db.transaction() as conn:
+        BackupStore.register(conn, backup_id, artifact)
+    return backup_id, artifact
+
+
+def test_deleting_old_backup_keeps_chunks_shared_with_kept_backup(bot, tmp_path):
+    store = BackupStore(bot.adb, str(tmp_path / 'chunks'), chunk_size=4)
+    # AAAA در هر دو بکاپ مشترک است؛ OLD_ فقط در بکاپ قدیمی
+    old_id, old = add_backup(bot, store, 40, b'AAAAOLD_', tmp_path)
+    new_id, new = add_backup(bot, store, 0, b'AAAANEW_', tmp_path)
+    shared, old_only = old.chunks[0][0], old.chunks[1][0]
+    assert new.chunks[0][0] == shared
+
+    engine = RetentionEngine(bot, store=store, tiers={'default': {'daily': 1, 'weekly': 0, 'monthly': 0}})
+    preview = asyncio.run(engine.apply(dry_run=True))
+    report = asyncio.run(engine.apply())
+
+    assert (report.deleted, report.file_bytes, report.store_bytes) == (1, 8, 4)
+    assert (preview.deleted, preview.reclaimed_bytes) == (report.deleted, report.reclaimed_bytes)
+
+    assert [row['id'] for row in bot.db.fetchall('SELECT id FROM backups')] == [new_id]
+    assert not os.path.exists(tmp_path / 'backup-40.tar')
+    assert os.path.exists(store.chunk_path(shared))
+    assert not os.path.exists(store.chunk_path(old_only))
+    assert bot.db.fetchone('SELECT refcount FROM backup_chunks WHERE hash = ?', (shared,))['refcount'] == 1
+    assert asyncio.run(store.verify(new_id))
+
+    # اجرای دوباره چیزی برای حذف ندارد
+    assert asyncio.run(engine.apply()).deleted == 0
@@ -0,0 +1,101 @@
+"""زمان‌بند: محاسبه نوبت بعدی cron و ماندگاری وضعیت وظایف پس از راه‌اندازی مجدد"""
+
+import asyncio
+import time
+from datetime import datetime
+
+import pytest
+
+from advanced_features import AsyncScheduler, CronTrigger, IntervalTrigger
+from server_management_bot import AsyncDatabase, Database
+
+
+def next_fire(expression, after):
+    return datetime.fromtimestamp(CronTrigger(expression).next_after(after.timestamp()))
+
+
+def test_step_from_value_runs_to_end_of_range():
+    trigger = CronTrigger('5/15 * * * *')
+    assert trigger.minutes == frozenset({5, 20, 35, 50})
+    assert next_fire('5/15 * * * *', datetime(2026, 3, 2, 10, 21)) == datetime(2026, 3, 2, 10, 35)
+    assert next_fire('5/15 * * * *', datetime(2026, 3, 2, 10, 50)) == datetime(2026, 3, 2, 11, 5)
+
+
+def test_star_step_and_range_step():
+    assert CronTrigger('*/20 * * * *').minutes == frozenset({0, 20, 40})
+    assert CronTrigger('0 8-18/4 * * *').hours == frozenset({8, 12, 16})
+    assert next_fire('0 8-18/4 * * *', datetime(2026, 3, 2, 16, 0)) == datetime(2026, 3, 3, 8, 0)
+
+
+def test_ranges_and_lists():
+    # دوشنبه تا جمعه ساعت 9:30
+    assert next_fire('30 9 * * 1-5', datetime(2026, 3, 6, 10, 0)) == datetime(2026, 3, 9, 9, 30)
+    assert next_fire('0 0,12 * * *', datetime(2026, 3, 2, 0, 0)) == datetime(2026, 3, 2, 12, 0)
+
+
+@pytest.mark.parametrize('expression', ['61 * * * *', '* 24 * * *', '5-1 * * * *', '*/0 * * * *', '* * *'])
+def test_invalid_expressions_are_rejected(expression):
+    with pytest.raises(ValueError):
+        CronTrigger(expression)
+
+
+def test_restricted_day_of_month_and_weekday_are_ored():
+    # روز 15 ماه یا هر یکشنبه؛ 2026-03-08 یکشنبه است
+    assert next_fire('0 0 15 * 0', datetime(2026, 3, 2, 12, 0)) == datetime(2026, 3, 8, 0, 0)
+    assert next_fire('0 0 15 * 0', datetime(2026, 3, 14, 12, 0)) == datetime(2026, 3, 15, 0, 0)
+
+
+def test_star_prefixed_day_field_is_anded():
+    # روز‌های فرد ماه که یکشنبه باشند؛ 2026-03-08 زوج است پس نوبت بعدی 2026-03-15 است
+    assert next_fire('0 0 */2 * 0', datetime(2026, 3, 2, 12, 0)) == datetime(2026, 3, 15, 0, 0)
+
+
+def test_month_and_year_rollover():
+    assert next_fire('0 0 1 * *', datetime(2026, 1, 31, 23, 59)) == datetime(2026, 2, 1, 0, 0)
+    assert next_fire('0 0 31 * *', datetime(2026, 1, 31, 0, 0)) == datetime(2026, 3, 31, 0, 0)
+    assert next_fire('59 23 31 12 *', datetime(2026, 12, 31, 23, 59)) == datetime(2027, 12, 31, 23, 59)
+    assert next_fire('0 0 29 2 *', datetime(2026, 3, 1, 0, 0)) == datetime(2028, 2, 29, 0, 0)
+
+
+def test_expression_that_never_fires():
+    with pytest.raises(ValueError):
+        CronTrigger('0 0 31 2 *').next_after(datetime(2026, 1, 1).timestamp())
+
+
+def test_state_persists_across_restarts(tmp_path):
+    db = Database(str(tmp_path / 'scheduler.db'), log_archive_dir=str(tmp_path / 'archive'))
+    adb = AsyncDatabase(db)
+    calls = []
+
+    async def job():
+        calls.append(1)
+        if len(calls) == 2:
+            raise RuntimeError('boom')
+
+    async def run_scheduler(seconds):
+        scheduler = AsyncScheduler(adb)
+        scheduler.add_job('tick', job, IntervalTrigger(0.05))
+        await scheduler.start()
+        await asyncio.sleep(seconds)
+        await scheduler.stop()
+        return scheduler.jobs['tick']
+
+    try:
+        first = asyncio.run(run_scheduler(0.18))
+        assert first.runs == len(calls) >= 2
+        assert first.failures == 1
+
+        row = asyncio.run(adb.fetchone("SELECT * FROM scheduler_state WHERE job = 'tick'"))
+        assert row['runs'] == first.runs and row['failures'] == 1
+
+        # پس از راه‌اندازی مجدد شمارنده‌ها ادامه می‌یابند و نوبت جا مانده یک بار اجرا می‌شود
+        time.sleep(0.12)
+        before = len(calls)
+        second = asyncio.run(run_scheduler(0.02))
+        assert second.missed == 1
+        assert len(calls) == before + 1
+        assert second.runs == first.runs + 1
+        assert second.failures == 1
+        assert second.last_run > first.last_run
+    finally:
+        adb.close()
@@ -0,0 +1,67 @@
+"""آزمون بار PerChatUpdateProcessor با صدها چت مصنوعی: ترتیب هر چت، سقف worker ها و تأخیرها"""
+
+import asyncio
+import random
+from datetime import datetime
+
+from telegram import Chat, Message, Update
+
+from server_management_bot import PerChatUpdateProcessor
+
+CHATS = 300
+UPDATES_PER_CHAT = 5
+WORKERS = 16
+
+
+def fake_update(chat_id: int, seq: int) -> Update:
+    """update پیام متنی از یک چت خصوصی، مثل آنچه تلگرام می‌فرستد"""
+    message = Message(seq, datetime.now(), Chat(chat_id, Chat.PRIVATE), text=f"msg {seq}")
+    return Update(seq * CHATS + chat_id, message=message)
+
+
+async def run_load(chats: int = CHATS, updates_per_chat: int = UPDATES_PER_CHAT, workers: int = WORKERS) -> dict:
+    """ارسال update ها به ترتیب دریافت (چت‌ها در هم) و جمع‌آوری نتایج"""
+    processor = PerChatUpdateProcessor(workers=workers, max_pending=chats * updates_per_chat)
+    seen = {}
+    peak = {'running': 0}
+    
+    async def handler(chat_id: int, seq: int):
+        peak['running'] = max(peak['running'], processor.running)
+        await asyncio.sleep(random.uniform(0.001, 0.01))
+        seen.setdefault(chat_id, []).append(seq)
+    
+    # چت‌ها در هم می‌رسند؛ ترتیب رسیدن update های هر چت همان ترتیبی است که handler باید ببیند
+    arrivals = [(chat_id, seq) for seq in range(updates_per_chat) for chat_id in range(chats)]
+    random.Random(1).shuffle(arrivals)
+    
+    tasks = []
+    for chat_id, seq in arrivals:
+        tasks.append(asyncio.create_task(processor.process_update(fake_update(chat_id, seq), handler(chat_id, seq))))
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    
+    return {'processor': processor, 'seen': seen, 'peak_running': peak['running'], 'arrivals': arrivals}
+
+
+def test_per_chat_order_and_worker_limit():
+    result = asyncio.run(run_load())
+    processor = result['processor']
+    
+    expected = {}
+    for chat_id, seq in result['arrivals']:
+        expected.setdefault(chat_id, []).append(seq)
+    
+    assert result['seen'] == expected
+    assert 0 < result['peak_running'] <= WORKERS
+    
+    stats = processor.stats()
+    assert stats['processed'] == CHATS * UPDATES_PER_CHAT
+    assert stats['pending'] == 0 and stats['running'] == 0
+    assert stats['active_chats'] == 0
+    assert stats['handler']['errors'] == 0
+    
+    print(
+        f"\n{CHATS} chats x {UPDATES_PER_CHAT} updates, {WORKERS} workers: "
+        f"handler p50={stats['handler']['p50_ms']}ms p99={stats['handler']['p99_ms']}ms, "
+        f"queue wait p50={stats['queue_wait']['p50_ms']}ms p99={stats['queue_wait']['p99_ms']}ms"
+    )
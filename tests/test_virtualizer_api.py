@@ -0,0 +1,161 @@
+"""کلاینت Virtualizer در برابر سرور محلی aiohttp: قطع‌کننده مدار، تلاش مجدد و داده قدیمی"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+from aiohttp import web
+
+import server_management_bot
+from server_management_bot import (
+    CircuitBreaker, CircuitOpenError, VirtualizerAPI, VirtualizerHTTPError
+)
+
+
+class FakeVirtualizer:
+    """هر پاسخ از صف failures برداشته می‌شود؛ صف خالی یعنی سرور سالم است"""
+
+    def __init__(self):
+        self.failures = []
+        self.hits = 0
+        self.vms = [{'vm_id': '101', 'status': 'running'}]
+
+    async def handle(self, request):
+        self.hits += 1
+        if self.failures:
+            return web.Response(status=self.failures.pop(0), text='upstream down')
+        if request.path == '/vms':
+            return web.json_response(self.vms)
+        return web.json_response({'ok': True})
+
+
+@asynccontextmanager
+async def virtualizer(**options):
+    backend = FakeVirtualizer()
+    app = web.Application()
+    app.router.add_route('*', '/{tail:.*}', backend.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    options.setdefault('backoff_base', 0.001)
+    api = VirtualizerAPI(f'http://127.0.0.1:{port}', 'test-key', **options)
+    await api.init_session()
+    try:
+        yield api, backend
+    finally:
+        await api.close_session()
+        await runner.cleanup()
+
+
+def test_retries_use_jittered_exponential_backoff(monkeypatch):
+    bounds = []
+
+    def uniform(low, high):
+        bounds.append((low, high))
+        return 0.0
+
+    monkeypatch.setattr(server_management_bot.random, 'uniform', uniform)
+
+    async def scenario():
+        async with virtualizer(max_retries=3, backoff_base=0.5, backoff_max=1.5) as (api, backend):
+            backend.failures = [503, 502, 429]
+            result = await api.get_server_stats()
+            return api, backend, result
+
+    api, backend, result = asyncio.run(scenario())
+
+    assert result == {'ok': True}
+    assert backend.hits == 4
+    assert api.retries == 3
+    # سقف تأخیر هر تلاش دو برابر می‌شود تا backoff_max و مقدار در بازه [0, سقف] تصادفی است
+    assert bounds == [(0, 0.5), (0, 1.0), (0, 1.5)]
+    assert api.breaker.state == CircuitBreaker.CLOSED and api.breaker.failures == 0
+
+
+def test_client_errors_are_not_retried():
+    async def scenario():
+        async with virtualizer(max_retries=3) as (api, backend):
+            backend.failures = [404]
+            with pytest.raises(VirtualizerHTTPError) as error:
+                await api.get_server_stats()
+            return api, backend, error.value
+
+    api, backend, error = asyncio.run(scenario())
+
+    assert error.status == 404
+    assert backend.hits == 1 and api.retries == 0
+    assert api.breaker.failures == 0
+
+
+def test_breaker_opens_after_threshold_and_recovers_through_half_open():
+    async def scenario():
+        async with virtualizer(max_retries=0, breaker_threshold=2, breaker_recovery=0.05) as (api, backend):
+            backend.failures = [500, 500]
+            for _ in range(2):
+                with pytest.raises(VirtualizerHTTPError):
+                    await api.get_server_stats()
+            assert api.breaker.state == CircuitBreaker.OPEN
+
+            # مدار باز: درخواست بدون رسیدن به سرور رد می‌شود
+            with pytest.raises(CircuitOpenError):
+                await api.get_server_stats()
+            assert backend.hits == 2
+
+            # پس از recovery یک درخواست آزمایشی؛ شکست آن مدار را دوباره باز می‌کند
+            await asyncio.sleep(0.06)
+            backend.failures = [500]
+            with pytest.raises(VirtualizerHTTPError):
+                await api.get_server_stats()
+            assert api.breaker.state == CircuitBreaker.OPEN
+            with pytest.raises(CircuitOpenError):
+                await api.get_server_stats()
+
+            # موفقیت درخواست آزمایشی مدار را می‌بندد
+            await asyncio.sleep(0.06)
+            assert await api.get_server_stats() == {'ok': True}
+            assert api.breaker.state == CircuitBreaker.CLOSED
+            assert await api.get_server_stats() == {'ok': True}
+            return api, backend
+
+    api, backend = asyncio.run(scenario())
+
+    assert backend.hits == 5
+    assert api.breaker.stats() == {'state': 'closed', 'failures': 0, 'times_opened': 2, 'rejected': 2}
+
+
+def test_half_open_allows_a_single_probe():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0.0)
+    breaker.record_failure()
+
+    assert breaker.allow_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow_request()
+    breaker.record_success()
+    assert breaker.allow_request() and breaker.allow_request()
+
+
+def test_stale_list_is_served_while_upstream_is_down():
+    async def scenario():
+        async with virtualizer(max_retries=1, vm_list_ttl=0.05) as (api, backend):
+            fresh = await api.list_vms()
+            await asyncio.sleep(0.06)
+
+            backend.failures = [503, 503]
+            stale = await api.list_vms()
+            assert backend.hits == 3
+
+            # خطای غیر قابل تکرار داده قدیمی را پنهان نمی‌کند
+            await asyncio.sleep(0.06)
+            backend.failures = [403]
+            with pytest.raises(VirtualizerHTTPError):
+                await api.list_vms()
+            return api, fresh, stale
+
+    api, fresh, stale = asyncio.run(scenario())
+
+    assert stale == fresh == [{'vm_id': '101', 'status': 'running'}]
+    assert api.stale_served == 1
+    assert api.get_metrics()['stale_served'] == 1
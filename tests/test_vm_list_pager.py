@@ -0,0 +1,69 @@
+"""فیلتر وضعیت لیست VM ها: «خاموش» فقط stopped است و بقیه وضعیت‌ها در «سایر»"""
+
+import asyncio
+
+from server_management_bot import CallbackRouter, ServerManagementBot, TTLCache, VMListPager
+
+USER_ID = 2
+
+
+class FakeAPI:
+    def __init__(self):
+        self.vms = [
+            {'vm_id': f'vm-{status}', 'name': status, 'status': status, 'cpu': 1, 'ram': 1024}
+            for status in ('running', 'stopped', 'error', 'creating', 'stopped')
+        ]
+        self.page_calls = []
+
+    async def list_vms(self, user_id=None, use_cache=True):
+        return self.vms
+
+    async def list_vms_page(self, user_id=None, status=None, offset=0, limit=10):
+        self.page_calls.append(status)
+        items = [vm for vm in self.vms if status is None or vm['status'] == status]
+        return {'items': items[offset:offset + limit], 'total': len(items)}
+
+
+def names(items):
+    return [vm['name'] for vm in items]
+
+
+def test_stopped_filter_matches_only_stopped_vms():
+    pager = VMListPager(FakeAPI(), page_size=10)
+    items, page, total, counts, _ = asyncio.run(pager.page(USER_ID, 'stopped', 0))
+
+    assert names(items) == ['stopped', 'stopped'] and total == 2
+    assert counts == {'all': 5, 'running': 1, 'stopped': 2, 'other': 2}
+
+    items, *_ = asyncio.run(pager.page(USER_ID, 'other', 0))
+    assert names(items) == ['error', 'creating']
+
+
+def test_other_bucket_uses_local_index_with_server_paging():
+    api = FakeAPI()
+    pager = VMListPager(api, page_size=10, server_paging=True)
+
+    items, _, total, counts, _ = asyncio.run(pager.page(USER_ID, 'stopped', 0))
+    assert (names(items), total, counts) == (['stopped', 'stopped'], 2, None)
+
+    items, _, total, _, _ = asyncio.run(pager.page(USER_ID, 'other', 0))
+    assert (names(items), total) == (['error', 'creating'], 2)
+    assert api.page_calls == ['stopped']
+
+
+def filter_row(bot, status):
+    _, markup = asyncio.run(bot.render_vm_list('user', USER_ID, status, 0))
+    return [button.text for button in markup.inline_keyboard[-2]]
+
+
+def test_filter_row_shows_other_only_when_needed():
+    bot = ServerManagementBot.__new__(ServerManagementBot)
+    bot.api = FakeAPI()
+    bot.vm_pager = VMListPager(bot.api, page_size=10)
+    bot.vm_list_pages = TTLCache(maxsize=16, ttl=60)
+    bot.router = CallbackRouter(None, lambda user_id: False, bot.owns_vm)
+
+    assert filter_row(bot, 'other') == ["همه (5)", "▶️ روشن (1)", "⏸️ خاموش (2)", "• ❔ سایر (2)"]
+
+    bot.api.vms = [vm for vm in bot.api.vms if vm['status'] in ('running', 'stopped')]
+    assert filter_row(bot, 'all') == ["• همه (3)", "▶️ روشن (1)", "⏸️ خاموش (2)"]